@@ -0,0 +1,106 @@
+# SPDX-FileCopyrightText: 2020 Luke Granger-Brown
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Kinds of anomaly the state tracker counts.
+SPAWN_CHILD_COUNT = "spawn_child_count"
+UNKNOWN_SPAWNABLE = "unknown_spawnable"
+UNKNOWN_INITIAL_LAYER = "unknown_initial_layer"
+SPAWN_OVER_EXISTING = "spawn_over_existing"
+UNKNOWN_RPC = "unknown_rpc"
+RPC_UNKNOWN_NET_ID = "rpc_unknown_net_id"
+RPC_DEAD_NET_ID = "rpc_dead_net_id"
+RPC_NO_HANDLER = "rpc_no_handler"
+HANDLER_MISSING_OBJECT = "handler_missing_object"
+HANDLER_FAILED = "handler_failed"
+DATA_UNKNOWN_NET_ID = "data_unknown_net_id"
+DATA_DEAD_NET_ID = "data_dead_net_id"
+DATA_NO_LAYER = "data_no_layer"
+DESPAWN_UNKNOWN_NET_ID = "despawn_unknown_net_id"
+GENERATED_PLAYER = "generated_player"
+MURDER_UNKNOWN_NET_ID = "murder_unknown_net_id"
+
+# Seconds between summaries of what was counted.
+DEFAULT_SUMMARY_INTERVAL = 60.0
+
+# (kind, netobj_type name or None, RPC name or None)
+Key = Tuple[str, Optional[str], Optional[str]]
+
+
+def _name(value):
+    return None if value is None else value._name_
+
+
+class Anomalies:
+    # Counts what the state tracker didn't expect, such as RPCs for objects
+    # it didn't see spawn after attaching to a game part way through. Only
+    # the first of each key is logged in full; after that, a summary of the
+    # counts is logged at most once per interval, when something is counted.
+
+    def __init__(self, summary_interval=DEFAULT_SUMMARY_INTERVAL):
+        self.summary_interval = summary_interval
+        self._counts: Dict[Key, int] = {}
+        self._summarised: Dict[Key, int] = {}
+        self._next_summary = time.monotonic() + summary_interval
+
+    def note(self, kind, netobj_type=None, rpc=None, msg=None, *args, exc_info=False):
+        # netobj_type and rpc are enum members; msg and args are only
+        # formatted for the first of each key, which has the traceback of
+        # the exception being handled if exc_info is set.
+        key = (kind, _name(netobj_type), _name(rpc))
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        if not count and msg:
+            logger.warning(
+                msg + " (further ones are counted)", *args, exc_info=exc_info
+            )
+        if time.monotonic() >= self._next_summary:
+            self._summarise()
+
+    def _summarise(self):
+        self._next_summary = time.monotonic() + self.summary_interval
+        counts = dict(self._counts)
+        new = {
+            key: count - self._summarised.get(key, 0)
+            for key, count in counts.items()
+            if count != self._summarised.get(key, 0)
+        }
+        self._summarised = counts
+        if not new:
+            return
+        logger.warning(
+            "Anomalies in the last %gs: %s",
+            self.summary_interval,
+            ", ".join(
+                "{}={}".format("/".join(k for k in key if k), count)
+                for key, count in sorted(new.items(), key=lambda kv: -kv[1])
+            ),
+        )
+
+    def counts(self, kind=None) -> Dict[Key, int]:
+        # Safe to call from any thread.
+        counts = dict(self._counts)
+        if kind is None:
+            return counts
+        return {key: count for key, count in counts.items() if key[0] == kind}
+
+    def total(self, kind=None) -> int:
+        return sum(self.counts(kind).values())
+
+    def prometheus_lines(self):
+        lines = ["# TYPE amongus_anomalies_total counter"]
+        for (kind, netobj_type, rpc), count in sorted(
+            self.counts().items(), key=lambda kv: tuple(k or "" for k in kv[0])
+        ):
+            lines.append(
+                'amongus_anomalies_total{{kind="{}",netobj_type="{}",rpc="{}"}} {}'.format(
+                    kind, netobj_type or "", rpc or "", count
+                )
+            )
+        return lines
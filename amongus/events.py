@@ -0,0 +1,302 @@
+# SPDX-FileCopyrightText: 2020 Luke Granger-Brown
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import dataclasses
+import logging
+import queue
+import sys
+import threading
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# How many events each subscription may have waiting before the oldest are
+# dropped.
+DEFAULT_QUEUE_SIZE = 4096
+
+
+@dataclasses.dataclass(frozen=True)
+class Event:
+    # Something which happened in a game, as of the capture time of the
+    # packet it arrived in. Players are named as they were then.
+    game_id: int
+    captured_at: float
+
+    def render(self) -> str:
+        raise NotImplementedError
+
+
+@dataclasses.dataclass(frozen=True)
+class VoteCast(Event):
+    voter_id: int
+    voter: str
+    # None for a skip.
+    suspect_id: Optional[int]
+    suspect: Optional[str]
+
+    def render(self):
+        return "{} votes for {}".format(
+            self.voter, "[skip]" if self.suspect_id is None else self.suspect
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class VoteNoted(Event):
+    # The chat note everybody sees when somebody votes.
+    voter_id: int
+    voter: str
+
+    def render(self):
+        return "{} voted!".format(self.voter)
+
+
+@dataclasses.dataclass(frozen=True)
+class VoteResult:
+    player_id: int
+    player: str
+    was_reporter: bool
+    is_dead: bool
+    has_voted: bool
+    # None for a skip.
+    voted_for_id: Optional[int]
+    voted_for: Optional[str]
+
+    def render(self):
+        name = self.player
+        if self.was_reporter:
+            name += " (reporter)"
+        if self.is_dead:
+            return "{} is dead".format(name)
+        elif not self.has_voted:
+            return "{} did not vote".format(name)
+        elif self.voted_for_id is None:
+            return "{} voted to skip".format(name)
+        return "{} voted for {}".format(name, self.voted_for)
+
+
+@dataclasses.dataclass(frozen=True)
+class VotingComplete(Event):
+    votes: Tuple[VoteResult, ...]
+    tie: bool
+    # None if nobody was ejected.
+    exiled_id: Optional[int]
+    exiled: Optional[str]
+
+    def render(self):
+        lines = ["Voting complete!", "\tVotes:"]
+        lines.extend("\t\t" + vote.render() for vote in self.votes)
+        lines.extend(["", "\tResults:"])
+        if self.tie:
+            lines.append("\t\t...it was a tie.")
+        elif self.exiled_id is None:
+            lines.append("\t\tSkipped.")
+        else:
+            lines.append("\t\t{} was ejected.".format(self.exiled))
+        return "\n".join(lines)
+
+
+@dataclasses.dataclass(frozen=True)
+class Chat(Event):
+    player_id: int
+    player: str
+    is_dead: bool
+    message: str
+
+    def render(self):
+        return "CHAT: {}{}: {}".format(
+            self.player, " (dead)" if self.is_dead else "", self.message
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class Murder(Event):
+    murderer_id: int
+    murderer: str
+    victim_id: int
+    victim: str
+
+    def render(self):
+        return "{} murdered {}".format(self.murderer, self.victim)
+
+
+@dataclasses.dataclass(frozen=True)
+class Meeting(Event):
+    caller_id: int
+    caller: str
+    # None for the emergency button.
+    body_id: Optional[int]
+    body: Optional[str]
+
+    _suffix = "!"
+
+    def render(self):
+        if self.body_id is None:
+            return "{} pressed the emergency button{}".format(self.caller, self._suffix)
+        return "{} reported {}'s death{}".format(self.caller, self.body, self._suffix)
+
+
+@dataclasses.dataclass(frozen=True)
+class MeetingRequested(Meeting):
+    # REPORT_DEAD_BODY, sent to the host ahead of the meeting starting.
+    _suffix = " (REPORT_DEAD_BODY)!"
+
+
+@dataclasses.dataclass(frozen=True)
+class MeetingStarted(Meeting):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class Vent(Event):
+    player_id: int
+    player: str
+    vent_id: int
+    # False when exiting.
+    entered: bool
+
+    def render(self):
+        return "{} {} vent {}".format(
+            self.player, "entered" if self.entered else "exited", self.vent_id
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class TaskCompleted(Event):
+    player_id: int
+    player: str
+    task_id: int
+
+    def render(self):
+        return "{} completed task {}".format(self.player, self.task_id)
+
+
+@dataclasses.dataclass(frozen=True)
+class Scanner(Event):
+    player_id: int
+    player: str
+    scanner_id: int
+    on: bool
+
+    def render(self):
+        return "SET_SCANNER: id={} on={} (by {})".format(
+            self.scanner_id, self.on, self.player
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class Countdown(Event):
+    # None when the start is cancelled.
+    seconds: Optional[int]
+
+    def render(self):
+        if self.seconds is None:
+            return "Game start cancelled."
+        return "Game start in {}...".format(self.seconds)
+
+
+class Subscription:
+    # One subscriber's bounded queue of events. When it falls behind, the
+    # oldest are dropped.
+
+    def __init__(self, bus, name, queue_size):
+        self.bus = bus
+        self.name = name
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self._dropping = False
+
+    def offer(self, event):
+        # Called from the publishing thread only.
+        try:
+            self.queue.put_nowait(event)
+            self._dropping = False
+            return
+        except queue.Full:
+            pass
+        try:
+            self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        self.dropped += 1
+        if not self._dropping:
+            self._dropping = True
+            logger.warning(
+                "Event subscriber %s fell behind, dropping its oldest events",
+                self.name,
+            )
+        self.queue.put_nowait(event)
+
+    def get(self, timeout=None) -> Event:
+        return self.queue.get(timeout=timeout)
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class EventBus:
+    # Fans the events state handlers emit out to each subscription. Events
+    # are only built while somebody is subscribed.
+
+    def __init__(self):
+        # Replaced rather than changed, so publish() needn't lock.
+        self.subscriptions: List[Subscription] = []
+        self.published = 0
+        self._lock = threading.Lock()
+
+    def subscribe(self, name, queue_size=DEFAULT_QUEUE_SIZE) -> Subscription:
+        subscription = Subscription(self, name, queue_size)
+        with self._lock:
+            self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self.subscriptions = [
+                s for s in self.subscriptions if s is not subscription
+            ]
+
+    def publish(self, event):
+        self.published += 1
+        for subscription in self.subscriptions:
+            subscription.offer(event)
+
+    def prometheus_lines(self):
+        subscriptions = self.subscriptions
+        lines = [
+            "# TYPE amongus_events_total counter",
+            "amongus_events_total {}".format(self.published),
+        ]
+        for metric, kind, value in (
+            ("queued", "gauge", lambda s: s.queue.qsize()),
+            ("dropped_total", "counter", lambda s: s.dropped),
+        ):
+            lines.append("# TYPE amongus_event_subscriber_{} {}".format(metric, kind))
+            for subscription in subscriptions:
+                lines.append(
+                    'amongus_event_subscriber_{}{{subscriber="{}"}} {}'.format(
+                        metric, subscription.name, value(subscription)
+                    )
+                )
+        return lines
+
+
+class TextRenderer:
+    # Writes each event as text, as the state handlers used to print it, from
+    # its own thread.
+
+    def __init__(self, bus, stream=None, queue_size=DEFAULT_QUEUE_SIZE):
+        self.subscription = bus.subscribe("text", queue_size)
+        self.stream = stream or sys.stdout
+        self._thread = threading.Thread(
+            target=self._run, name="events-text", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            event = self.subscription.get()
+            self.stream.write(event.render() + "\n")
+            self.stream.flush()
@@ -0,0 +1,382 @@
+# SPDX-FileCopyrightText: 2020 Luke Granger-Brown
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+import dataclasses
+import logging
+import math
+import os
+import secrets
+import struct
+import time
+from typing import Dict, Mapping, Optional, Tuple
+
+import amongus.runtime
+import amongus.state_tracker
+import amongus.voice
+
+logger = logging.getLogger(__name__)
+
+RoundState = amongus.state_tracker.RoundState
+ROUND_STATES = tuple(RoundState)
+
+# Subscribers with this many bytes of frames unsent are disconnected, and
+# get a fresh snapshot when they reconnect.
+SUBSCRIBER_BUFFER_LIMIT = 1024 * 1024
+
+RECONNECT_BACKOFF_INITIAL = 0.1
+RECONNECT_BACKOFF_MAX = 5.0
+
+# Every frame is a u32 length, then a body starting with its type.
+_FRAME_LENGTH = struct.Struct("<I")
+_FRAME_HELLO = 1
+_FRAME_GAME = 2
+# type, seq; followed by the publisher's epoch in ASCII.
+_HELLO_HEADER = struct.Struct("<BQ")
+# type, version, game_id, whether it's a snapshot; followed by records.
+_GAME_HEADER = struct.Struct("<BQIB")
+
+# Records in a game frame: a u8 tag, then the field. A snapshot is the delta
+# from FeedGame(), and a delta only has the records for what changed.
+_TAG_ROUND_STATE = 1  # u8 index into ROUND_STATES
+_TAG_ALIVE = 2  # names
+_TAG_DEAD = 3  # names
+_TAG_STAGED = 4  # u8 index into ROUND_STATES (or 0xff), f64 time.time() (or NaN)
+_TAG_PLAYER = 5  # u8 player_id, u8 color_id, u8 flags, name
+_TAG_PLAYER_REMOVED = 6  # u8 player_id
+_U8 = struct.Struct("<B")
+_STAGED = struct.Struct("<Bd")
+_PLAYER = struct.Struct("<BBB")
+_NOT_STAGED = 0xFF
+
+_PLAYER_DEAD = 1
+_PLAYER_IMPOSTOR = 2
+_PLAYER_DISCONNECTED = 4
+
+
+@dataclasses.dataclass(frozen=True)
+class FeedPlayer:
+    name: str
+    color_id: int = 0
+    is_dead: bool = False
+    is_impostor: bool = False
+    disconnected: bool = False
+
+
+@dataclasses.dataclass(frozen=True)
+class FeedGame:
+    # Sequence number of the frame that last changed the game.
+    version: int = 0
+    voice: amongus.voice.VoiceState = amongus.voice.VoiceState()
+    # The round state expected next, and the time.time() it is expected at.
+    staged_round_state: Optional[RoundState] = None
+    staged_at: Optional[float] = None
+    players: Mapping[int, FeedPlayer] = dataclasses.field(default_factory=dict)
+
+    def staged(self) -> amongus.voice.Staged:
+        # As VoiceTracker stages it, in this process's time.monotonic().
+        if self.staged_round_state is None:
+            return amongus.voice.NOTHING_STAGED
+        at = None
+        if self.staged_at is not None:
+            at = time.monotonic() + (self.staged_at - time.time())
+        return (
+            dataclasses.replace(self.voice, round_state=self.staged_round_state),
+            at,
+        )
+
+
+def _encode_names(names):
+    parts = [_U8.pack(len(names))]
+    for name in sorted(names):
+        encoded = name.encode("utf8")[:255]
+        parts.append(_U8.pack(len(encoded)) + encoded)
+    return b"".join(parts)
+
+
+def _decode_names(body, offset):
+    (count,) = _U8.unpack_from(body, offset)
+    offset += 1
+    names = []
+    for _ in range(count):
+        (length,) = _U8.unpack_from(body, offset)
+        offset += 1
+        names.append(body[offset : offset + length].decode("utf8"))
+        offset += length
+    return frozenset(names), offset
+
+
+def encode_game(game_id, old, new, snapshot=False):
+    if old is None:
+        old, snapshot = FeedGame(), True
+    records = []
+    if new.voice.round_state != old.voice.round_state:
+        records.append(
+            _U8.pack(_TAG_ROUND_STATE)
+            + _U8.pack(ROUND_STATES.index(new.voice.round_state))
+        )
+    if new.voice.alive_players != old.voice.alive_players:
+        records.append(_U8.pack(_TAG_ALIVE) + _encode_names(new.voice.alive_players))
+    if new.voice.dead_players != old.voice.dead_players:
+        records.append(_U8.pack(_TAG_DEAD) + _encode_names(new.voice.dead_players))
+    if (new.staged_round_state, new.staged_at) != (
+        old.staged_round_state,
+        old.staged_at,
+    ):
+        records.append(
+            _U8.pack(_TAG_STAGED)
+            + _STAGED.pack(
+                _NOT_STAGED
+                if new.staged_round_state is None
+                else ROUND_STATES.index(new.staged_round_state),
+                math.nan if new.staged_at is None else new.staged_at,
+            )
+        )
+    for player_id, player in new.players.items():
+        if old.players.get(player_id, None) == player:
+            continue
+        flags = (
+            (_PLAYER_DEAD if player.is_dead else 0)
+            | (_PLAYER_IMPOSTOR if player.is_impostor else 0)
+            | (_PLAYER_DISCONNECTED if player.disconnected else 0)
+        )
+        name = player.name.encode("utf8")[:255]
+        records.append(
+            _U8.pack(_TAG_PLAYER)
+            + _PLAYER.pack(player_id, player.color_id, flags)
+            + _U8.pack(len(name))
+            + name
+        )
+    for player_id in old.players.keys() - new.players.keys():
+        records.append(_U8.pack(_TAG_PLAYER_REMOVED) + _U8.pack(player_id))
+    body = _GAME_HEADER.pack(_FRAME_GAME, new.version, game_id, snapshot) + b"".join(
+        records
+    )
+    return _FRAME_LENGTH.pack(len(body)) + body
+
+
+def _hello_frame(epoch, seq):
+    body = _HELLO_HEADER.pack(_FRAME_HELLO, seq) + epoch.encode("ascii")
+    return _FRAME_LENGTH.pack(len(body)) + body
+
+
+def apply_game_frame(games, body):
+    # Applies a game frame's body to games, returning the game_id it changed.
+    _, version, game_id, snapshot = _GAME_HEADER.unpack_from(body)
+    game = FeedGame() if snapshot else games.get(game_id, FeedGame())
+    voice_changes = {}
+    changes = {"version": version}
+    players = None
+    offset = _GAME_HEADER.size
+    while offset < len(body):
+        (tag,) = _U8.unpack_from(body, offset)
+        offset += 1
+        if tag == _TAG_ROUND_STATE:
+            (index,) = _U8.unpack_from(body, offset)
+            offset += 1
+            voice_changes["round_state"] = ROUND_STATES[index]
+        elif tag in (_TAG_ALIVE, _TAG_DEAD):
+            names, offset = _decode_names(body, offset)
+            key = "alive_players" if tag == _TAG_ALIVE else "dead_players"
+            voice_changes[key] = names
+        elif tag == _TAG_STAGED:
+            index, at = _STAGED.unpack_from(body, offset)
+            offset += _STAGED.size
+            changes["staged_round_state"] = (
+                None if index == _NOT_STAGED else ROUND_STATES[index]
+            )
+            changes["staged_at"] = None if math.isnan(at) else at
+        elif tag == _TAG_PLAYER:
+            player_id, color_id, flags = _PLAYER.unpack_from(body, offset)
+            offset += _PLAYER.size
+            (length,) = _U8.unpack_from(body, offset)
+            offset += 1
+            if players is None:
+                players = dict(game.players)
+            players[player_id] = FeedPlayer(
+                name=body[offset : offset + length].decode("utf8"),
+                color_id=color_id,
+                is_dead=bool(flags & _PLAYER_DEAD),
+                is_impostor=bool(flags & _PLAYER_IMPOSTOR),
+                disconnected=bool(flags & _PLAYER_DISCONNECTED),
+            )
+            offset += length
+        elif tag == _TAG_PLAYER_REMOVED:
+            (player_id,) = _U8.unpack_from(body, offset)
+            offset += 1
+            if players is None:
+                players = dict(game.players)
+            players.pop(player_id, None)
+        else:
+            raise ValueError("unknown feed record tag {}".format(tag))
+    if voice_changes:
+        changes["voice"] = dataclasses.replace(game.voice, **voice_changes)
+    if players is not None:
+        changes["players"] = players
+    games[game_id] = dataclasses.replace(game, **changes)
+    return game_id
+
+
+def _feed_players(game_data):
+    if not game_data:
+        return {}
+    return {
+        p.player_id: FeedPlayer(
+            name=p.name,
+            color_id=p.color_id,
+            is_dead=bool(p.is_dead),
+            is_impostor=bool(p.is_impostor),
+            disconnected=bool(p.disconnected),
+        )
+        for p in game_data.players
+    }
+
+
+class FeedSink(amongus.runtime.LoopSink):
+    # Publishes each game's voice state, staged transition and players to
+    # subscribers on a Unix socket. Subscribers get a hello and a snapshot of
+    # every game when they connect, then a delta whenever a game changes.
+
+    name = "feed"
+
+    def __init__(self, loop, path):
+        super().__init__(loop)
+        self.path = path
+        # Lets subscribers tell whether versions are from this process.
+        self.epoch = secrets.token_hex(8)
+        self.seq = 0
+        self.voice = amongus.voice.VoiceTracker()
+        # game_id -> (VoiceState, Staged, players), as last derived.
+        self._derived: Dict[int, Tuple] = {}
+        # game_id -> (GameData snapshot, its players), to skip rebuilding the
+        # players for packets which didn't change them, such as movement.
+        self._players: Dict[int, Tuple] = {}
+        # game_id -> FeedGame, as last published.
+        self.games: Dict[int, FeedGame] = {}
+        self.subscribers = set()
+
+    def derive(self, pkt, game_id, game_state):
+        if game_id is None:
+            return None
+        self.voice.process_packet(pkt, game_id, game_state)
+        game_data = game_state.find_netobj_of_type(amongus.state_tracker.NetObjGameData)
+        last_game_data, players = self._players.get(game_id, (None, None))
+        if players is None or game_data is not last_game_data:
+            players = _feed_players(game_data)
+            self._players[game_id] = (game_data, players)
+        derived = (
+            self.voice.states.get(game_id, amongus.voice.VoiceState()),
+            self.voice.staged.get(game_id, amongus.voice.NOTHING_STAGED),
+            players,
+        )
+        if derived == self._derived.get(game_id, None):
+            return None
+        self._derived[game_id] = derived
+        voice_state, (staged, at), players = derived
+        return (
+            game_id,
+            FeedGame(
+                voice=voice_state,
+                staged_round_state=staged.round_state if staged else None,
+                staged_at=None if at is None else time.time() + (at - time.monotonic()),
+                players=players,
+            ),
+        )
+
+    def apply(self, item):
+        game_id, game = item
+        self.seq += 1
+        game = dataclasses.replace(game, version=self.seq)
+        frame = encode_game(game_id, self.games.get(game_id, None), game)
+        self.games[game_id] = game
+        for writer in list(self.subscribers):
+            if writer.transport.get_write_buffer_size() > SUBSCRIBER_BUFFER_LIMIT:
+                logger.warning("Feed subscriber fell too far behind, disconnecting")
+                self.subscribers.discard(writer)
+                writer.close()
+                continue
+            writer.write(frame)
+
+    async def handle_subscriber(self, reader, writer):
+        writer.write(_hello_frame(self.epoch, self.seq))
+        for game_id, game in self.games.items():
+            writer.write(encode_game(game_id, None, game))
+        self.subscribers.add(writer)
+        logger.info("Feed subscriber connected (%d total)", len(self.subscribers))
+        try:
+            await reader.read()
+        finally:
+            self.subscribers.discard(writer)
+            writer.close()
+
+    async def run(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        await asyncio.start_unix_server(self.handle_subscriber, self.path)
+        logger.info("Publishing feed on %s", self.path)
+
+
+class FeedClient:
+    # Follows a tracker's feed, keeping the latest FeedGame of every game and
+    # calling on_game(game_id, game) on the event loop whenever one changes.
+    # Reconnects when the tracker goes away, and is sent every game again.
+
+    def __init__(self, path, on_game=None):
+        self.path = path
+        self.on_game = on_game
+        self.epoch = None
+        self.games: Dict[int, FeedGame] = {}
+        self.connected = asyncio.Event()
+        self._task = None
+
+    def _handle_frame(self, body):
+        if body[0] == _FRAME_HELLO:
+            _, seq = _HELLO_HEADER.unpack_from(body)
+            epoch = body[_HELLO_HEADER.size :].decode("ascii")
+            if epoch != self.epoch:
+                logger.info("Following feed %s from tracker %s", self.path, epoch)
+                self.epoch = epoch
+            # Every game the tracker still knows is sent again after a hello,
+            # so forget the rest.
+            self.games = {}
+            self.connected.set()
+            return
+        if body[0] != _FRAME_GAME:
+            raise ValueError("unknown feed frame type {}".format(body[0]))
+        game_id = apply_game_frame(self.games, body)
+        if self.on_game:
+            self.on_game(game_id, self.games[game_id])
+
+    async def _follow(self, reader):
+        while True:
+            (length,) = _FRAME_LENGTH.unpack(
+                await reader.readexactly(_FRAME_LENGTH.size)
+            )
+            self._handle_frame(await reader.readexactly(length))
+
+    def start(self):
+        # The event loop only keeps weak references to tasks.
+        self._task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        backoff = RECONNECT_BACKOFF_INITIAL
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+                continue
+            backoff = RECONNECT_BACKOFF_INITIAL
+            try:
+                await self._follow(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logger.warning("Lost feed from %s", self.path)
+            except (ValueError, IndexError, struct.error):
+                # A frame this client can't decode. Reconnecting gets every
+                # game again from scratch.
+                logger.exception("Bad frame in feed from %s, reconnecting", self.path)
+            finally:
+                self.connected.clear()
+                writer.close()
@@ -0,0 +1,91 @@
+# SPDX-FileCopyrightText: 2020 Luke Granger-Brown
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import logging
+import os
+import time
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SERVICES = ("discord", "ts3")
+
+
+class IdentityMap:
+    # Maps in-game names to voice accounts. The file is a JSON list of
+    # {"names": [...], "discord": [...], "ts3": [...]} entries; names match
+    # case-insensitively.
+
+    def __init__(self, entries):
+        self._ids_by_name: Dict[str, Dict[str, FrozenSet[int]]] = {
+            service: {} for service in SERVICES
+        }
+        self._names_by_id: Dict[str, Dict[int, List[str]]] = {
+            service: {} for service in SERVICES
+        }
+        for entry in entries:
+            names = list(entry["names"])
+            for service in SERVICES:
+                account_ids = frozenset(int(i) for i in entry.get(service, []))
+                if not account_ids:
+                    continue
+                ids_by_name = self._ids_by_name[service]
+                for name in names:
+                    key = name.casefold()
+                    ids_by_name[key] = ids_by_name.get(key, frozenset()) | account_ids
+                for account_id in account_ids:
+                    self._names_by_id[service].setdefault(account_id, []).extend(names)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def account_ids(self, service, names: Iterable[str]) -> FrozenSet[int]:
+        ids_by_name = self._ids_by_name[service]
+        account_ids = set()
+        for name in names:
+            account_ids.update(ids_by_name.get(name.casefold(), ()))
+        return frozenset(account_ids)
+
+    def names(self, service, account_id) -> List[str]:
+        return self._names_by_id[service].get(account_id, [])
+
+
+class IdentityService:
+    # Keeps an IdentityMap in sync with the file it came from, checking for
+    # changes at most every check_interval seconds. A file that fails to load
+    # leaves the previous map in place.
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._map = IdentityMap.load(path)
+        self._stat = self._file_stat()
+        self._checked = time.monotonic()
+
+    def _file_stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def current(self) -> IdentityMap:
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return self._map
+        self._checked = now
+        stat = self._file_stat()
+        if stat is None or stat == self._stat:
+            return self._map
+        self._stat = stat
+        try:
+            self._map = IdentityMap.load(self.path)
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.exception("Failed to reload identities from %s", self.path)
+        else:
+            logger.info("Reloaded identities from %s", self.path)
+        return self._map
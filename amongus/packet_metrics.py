@@ -0,0 +1,158 @@
+# SPDX-FileCopyrightText: 2020 Luke Granger-Brown
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import bisect
+from typing import List, Optional
+
+import amongus.enums
+
+# Upper bounds of the latency buckets, in nanoseconds: 1us, doubling up to
+# about a second.
+BUCKET_BOUNDS_NS = tuple(1000 << n for n in range(21))
+
+# Hazel types, message tags, RPC call_ids and netobj types are all bytes, so
+# counters and histograms are kept in lists indexed by them.
+_SLOTS = 256
+
+
+class Histogram:
+    # Counts samples into fixed buckets, without allocating for each one.
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS_NS) + 1)
+        self.count = 0
+        self.sum_ns = 0
+
+    def observe(self, ns):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS_NS, ns)] += 1
+        self.count += 1
+        self.sum_ns += ns
+
+    def observe_seconds(self, seconds):
+        # Negative durations, between clocks which disagree, count as zero.
+        self.observe(int(seconds * 1e9) if seconds > 0 else 0)
+
+    def prometheus_lines(self, name, labels=""):
+        # labels are the histogram's own, without braces.
+        bucket_labels = labels + "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(BUCKET_BOUNDS_NS, self.counts):
+            cumulative += count
+            lines.append(
+                '{}_bucket{{{}le="{}"}} {}'.format(
+                    name, bucket_labels, bound / 1e9, cumulative
+                )
+            )
+        labels = "{{{}}}".format(labels) if labels else ""
+        lines.extend(
+            [
+                '{}_bucket{{{}le="+Inf"}} {}'.format(name, bucket_labels, self.count),
+                "{}_sum{} {:.9f}".format(name, labels, self.sum_ns / 1e9),
+                "{}_count{} {}".format(name, labels, self.count),
+            ]
+        )
+        return lines
+
+
+def _label(enum_cls, value):
+    try:
+        return enum_cls(value)._name_
+    except ValueError:
+        return str(value)
+
+
+class PacketMetrics:
+    # What GameStates sees, by Hazel type, message tag and RPC, and how long
+    # it spends on each message. Decoding covers everything but the handlers:
+    # the layers of the message, and the initial and update data. Handlers
+    # are the RPC handlers, update_from_packet and spawning.
+    #
+    # Only the capture thread updates these; any thread may export them.
+
+    def __init__(self):
+        self.packets = [0] * _SLOTS
+        self.bytes = [0] * _SLOTS
+        self.messages = [0] * _SLOTS
+        self.rpcs = [0] * _SLOTS
+        self.packet_latency = Histogram()
+        self.decode_latency: List[Optional[Histogram]] = [None] * _SLOTS
+        self.rpc_latency: List[Optional[Histogram]] = [None] * _SLOTS
+        self.data_latency: List[Optional[Histogram]] = [None] * _SLOTS
+        self.spawn_latency: List[Optional[Histogram]] = [None] * _SLOTS
+
+    def count_packet(self, hazel_type, size):
+        self.packets[hazel_type] += 1
+        self.bytes[hazel_type] += size
+
+    @staticmethod
+    def observe(histograms, key, ns):
+        histogram = histograms[key]
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(ns)
+
+    def prometheus_lines(self):
+        lines = []
+        for name, label, enum_cls, counts in (
+            (
+                "amongus_packets_total",
+                "hazel_type",
+                amongus.enums.HazelPacketType,
+                self.packets,
+            ),
+            (
+                "amongus_packet_bytes_total",
+                "hazel_type",
+                amongus.enums.HazelPacketType,
+                self.bytes,
+            ),
+            (
+                "amongus_messages_total",
+                "tag",
+                amongus.enums.AmongUsMessageType,
+                self.messages,
+            ),
+            ("amongus_rpcs_total", "rpc", amongus.enums.AmongUsRPCType, self.rpcs),
+        ):
+            lines.append("# TYPE {} counter".format(name))
+            for value, count in enumerate(counts):
+                if count:
+                    lines.append(
+                        '{}{{{}="{}"}} {}'.format(
+                            name, label, _label(enum_cls, value), count
+                        )
+                    )
+        lines.append("# TYPE amongus_process_packet_seconds histogram")
+        lines.extend(
+            self.packet_latency.prometheus_lines("amongus_process_packet_seconds")
+        )
+        lines.append("# TYPE amongus_decode_seconds histogram")
+        for value, histogram in enumerate(self.decode_latency):
+            if histogram:
+                lines.extend(
+                    histogram.prometheus_lines(
+                        "amongus_decode_seconds",
+                        'tag="{}"'.format(
+                            _label(amongus.enums.AmongUsMessageType, value)
+                        ),
+                    )
+                )
+        lines.append("# TYPE amongus_handler_seconds histogram")
+        for handler, enum_cls, histograms in (
+            ("rpc", amongus.enums.AmongUsRPCType, self.rpc_latency),
+            ("data", amongus.enums.AmongUsInnerNetClients, self.data_latency),
+            ("spawn", amongus.enums.AmongUsInnerNetClients, self.spawn_latency),
+        ):
+            for value, histogram in enumerate(histograms):
+                if histogram:
+                    lines.extend(
+                        histogram.prometheus_lines(
+                            "amongus_handler_seconds",
+                            'handler="{}",type="{}"'.format(
+                                handler, _label(enum_cls, value)
+                            ),
+                        )
+                    )
+        return lines
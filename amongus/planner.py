@@ -0,0 +1,87 @@
+# SPDX-FileCopyrightText: 2020 Luke Granger-Brown
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import dataclasses
+import logging
+import time
+from typing import Dict, Optional
+
+import amongus.rpcs
+import amongus.state_tracker
+
+logger = logging.getLogger(__name__)
+
+RoundState = amongus.state_tracker.RoundState
+
+# Timers for games whose options we haven't seen, matching GameOptions.
+DEFAULT_DISCUSSION_TIME = 15
+DEFAULT_VOTING_TIME = 120
+# Seconds from VOTING_COMPLETE to the round resuming, covering the results
+# screen and the ejection cutscene, until a meeting has been timed.
+DEFAULT_RESUME_DELAY = {True: 9.0, False: 7.0}
+
+
+@dataclasses.dataclass(frozen=True)
+class Transition:
+    round_state: RoundState
+    # time.monotonic() it is expected at, or None if the voting timer is
+    # unlimited.
+    at: Optional[float]
+
+
+class TransitionPlanner:
+    # Predicts, for one game, when the current meeting will end and the round
+    # resume, from the discussion and voting timers in the game options. The
+    # delay between voting completing and the round resuming depends on
+    # confirm_ejects, and is learned from each meeting seen.
+
+    def __init__(self):
+        self.next: Optional[Transition] = None
+        self._voting_complete_at: Optional[float] = None
+        self._resume_delays: Dict[bool, float] = dict(DEFAULT_RESUME_DELAY)
+
+    def process_packet(self, game_state, pkt, now=None) -> Optional[Transition]:
+        # Returns the transition expected next after pkt, if any.
+        if now is None:
+            now = time.monotonic()
+        options = game_state.game_options
+        confirm_ejects = bool(options.confirm_ejects) if options else True
+        round_state = game_state.round_state
+        if round_state != RoundState.MEETING:
+            if (
+                self._voting_complete_at is not None
+                and round_state == RoundState.ACTIVE
+            ):
+                delay = now - self._voting_complete_at
+                logger.debug("Round resumed %.1fs after voting completed", delay)
+                self._resume_delays[confirm_ejects] = delay
+            self._voting_complete_at = None
+            self.next = None
+        elif amongus.rpcs.VotingCompleteRPC in pkt:
+            self._voting_complete_at = now
+            self.next = Transition(
+                RoundState.ACTIVE, now + self._resume_delays[confirm_ejects]
+            )
+        elif self.next is None:
+            # The meeting has just started.
+            if options:
+                discussion_time, voting_time = (
+                    options.discussion_time,
+                    options.voting_time,
+                )
+            else:
+                discussion_time, voting_time = (
+                    DEFAULT_DISCUSSION_TIME,
+                    DEFAULT_VOTING_TIME,
+                )
+            at = None
+            if voting_time:
+                at = (
+                    now
+                    + discussion_time
+                    + voting_time
+                    + self._resume_delays[confirm_ejects]
+                )
+            self.next = Transition(RoundState.ACTIVE, at)
+        return self.next
@@ -0,0 +1,321 @@
+# SPDX-FileCopyrightText: 2020 Luke Granger-Brown
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from typing import List
+
+import scapy.all
+import scapy.utils
+
+import amongus.events
+import amongus.packet_metrics
+import amongus.snapshot
+import amongus.state_tracker
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_FILTER = "udp and (src port 22023 or dst port 22023)"
+
+# How many derived items each sink may have waiting before the oldest are
+# dropped.
+DEFAULT_QUEUE_SIZE = 1024
+
+# What each sink's latency is broken down into: derive() on the capture
+# thread, waiting in its queue, deliver(), and from capture to delivered.
+SINK_STAGES = ("derive", "queued", "deliver", "end_to_end")
+
+# Games with no packets for this many seconds, in capture time, are forgotten
+# by the tracker and its sinks.
+GAME_IDLE_TTL = 30 * 60
+
+
+class Sink:
+    # A consumer of tracked games. derive() runs on the capture thread after
+    # every packet, with the game_id of the game it changed (or None) and a
+    # GameSnapshot of it, and returns what, if anything, to queue for
+    # deliver(), which runs on the sink's own thread. Snapshots never change,
+    # so may be queued as they are and read there.
+
+    name = "sink"
+    queue_size = DEFAULT_QUEUE_SIZE
+
+    def derive(self, pkt, game_id, game_state):
+        if game_id is None:
+            return None
+        return (game_id, game_state)
+
+    def deliver(self, item):
+        raise NotImplementedError
+
+    def forget(self, game_id):
+        # Called on the capture thread once the tracker has forgotten a game,
+        # and returns what, if anything, to queue for deliver(), so that it
+        # can be forgotten after whatever is already queued for it.
+        return None
+
+
+class LoopSink(Sink):
+    # A sink whose items are applied on an asyncio event loop. Delivery waits
+    # for each item to be applied, so a busy loop backs up this sink's queue
+    # rather than the loop's. run() is started on the loop alongside it.
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def deliver(self, item):
+        asyncio.run_coroutine_threadsafe(self._apply(item), self.loop).result()
+
+    async def _apply(self, item):
+        self.apply(item)
+
+    def apply(self, item):
+        raise NotImplementedError
+
+    async def run(self):
+        pass
+
+
+class SinkRunner:
+    # Feeds one sink from its own bounded queue and thread. When the sink
+    # falls behind, the oldest items are dropped: the consumers of game
+    # state only need the latest. Items are queued with the capture time of
+    # the packet they came from, to time them through to delivery.
+
+    def __init__(self, sink, queue_size=None):
+        self.sink = sink
+        self.queue = queue.Queue(queue_size or sink.queue_size)
+        self.delivered = 0
+        self.dropped = 0
+        self.failed = 0
+        # time.time() the last item was delivered.
+        self.delivered_at = None
+        self.latency = {
+            stage: amongus.packet_metrics.Histogram() for stage in SINK_STAGES
+        }
+        self._dropping = False
+        self._thread = threading.Thread(
+            target=self._run, name="sink-{}".format(sink.name), daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def offer(self, item, captured_at=None):
+        # Called from the capture thread only.
+        item = (item, captured_at, time.perf_counter_ns())
+        try:
+            self.queue.put_nowait(item)
+            self._dropping = False
+            return
+        except queue.Full:
+            pass
+        try:
+            self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        self.dropped += 1
+        if not self._dropping:
+            self._dropping = True
+            logger.warning(
+                "Sink %s fell behind, dropping its oldest items", self.sink.name
+            )
+        self.queue.put_nowait(item)
+
+    def _run(self):
+        latency = self.latency
+        while True:
+            item, captured_at, queued_ns = self.queue.get()
+            start_ns = time.perf_counter_ns()
+            latency["queued"].observe(start_ns - queued_ns)
+            try:
+                self.sink.deliver(item)
+                self.delivered += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Sink %s failed to deliver", self.sink.name)
+                continue
+            latency["deliver"].observe(time.perf_counter_ns() - start_ns)
+            self.delivered_at = time.time()
+            if captured_at is not None:
+                latency["end_to_end"].observe_seconds(self.delivered_at - captured_at)
+
+
+class Tracker:
+    # Captures and decodes packets once, tracks every game, and fans out
+    # what changed to each sink, and what happened to the event bus's
+    # subscribers. Games which go idle are forgotten here, and each sink is
+    # told to forget them too.
+
+    def __init__(self, sinks, queue_size=None, game_idle_ttl=GAME_IDLE_TTL):
+        self.events = amongus.events.EventBus()
+        self.states = amongus.state_tracker.GameStates(event_bus=self.events)
+        self.snapshots = amongus.snapshot.Snapshots()
+        self.runners: List[SinkRunner] = [
+            SinkRunner(sink, queue_size) for sink in sinks
+        ]
+        self.packets = 0
+        self.changes = 0
+        self.game_idle_ttl = game_idle_ttl
+        # Capture time at which to next look for idle games.
+        self._next_expiry = 0.0
+        # From capture to this process seeing the packet, and then decoding
+        # it, updating the game and taking its snapshot.
+        self.capture_latency = amongus.packet_metrics.Histogram()
+        self.state_latency = amongus.packet_metrics.Histogram()
+
+    def process_packet(self, pkt):
+        self.packets += 1
+        captured_at = float(pkt.time)
+        self.capture_latency.observe_seconds(time.time() - captured_at)
+        start_ns = time.perf_counter_ns()
+        game_id = self.states.process_packet(pkt)
+        game_state = None
+        if game_id is not None:
+            self.changes += 1
+            game_state = self.snapshots.update(game_id, self.states.games[game_id])
+        derive_ns = time.perf_counter_ns()
+        self.state_latency.observe(derive_ns - start_ns)
+        for runner in self.runners:
+            try:
+                item = runner.sink.derive(pkt, game_id, game_state)
+            except Exception:
+                logger.exception("Sink %s failed to derive", runner.sink.name)
+                continue
+            derived_ns = time.perf_counter_ns()
+            runner.latency["derive"].observe(derived_ns - derive_ns)
+            derive_ns = derived_ns
+            if item is not None:
+                runner.offer(item, captured_at)
+        if captured_at >= self._next_expiry:
+            self.expire(captured_at)
+
+    def expire(self, now):
+        # now is a capture time, so that replays expire games as they went.
+        self._next_expiry = now + self.game_idle_ttl / 10
+        for game_id in self.states.expire(now - self.game_idle_ttl):
+            logger.info("Forgetting game %d, which has gone idle", game_id)
+            self.snapshots.forget(game_id)
+            for runner in self.runners:
+                try:
+                    item = runner.sink.forget(game_id)
+                except Exception:
+                    logger.exception("Sink %s failed to forget", runner.sink.name)
+                    continue
+                if item is not None:
+                    runner.offer(item)
+
+    def capture(self, **kwargs):
+        scapy.all.conf.use_pcap = True
+        scapy.all.conf.sniff_promisc = False
+        logger.info("Capturing for %s", ", ".join(r.sink.name for r in self.runners))
+        scapy.all.sniff(prn=self.process_packet, filter=CAPTURE_FILTER, **kwargs)
+
+    def start(self, **kwargs):
+        for runner in self.runners:
+            runner.start()
+        thread = threading.Thread(
+            target=self.capture, kwargs=kwargs, name="capture", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def prometheus_lines(self):
+        lines = [
+            "# TYPE amongus_tracker_packets_total counter",
+            "amongus_tracker_packets_total {}".format(self.packets),
+            "# TYPE amongus_tracker_changes_total counter",
+            "amongus_tracker_changes_total {}".format(self.changes),
+            "# TYPE amongus_tracker_games gauge",
+            "amongus_tracker_games {}".format(len(self.states.games)),
+        ]
+        for metric, kind, value in (
+            ("queued", "gauge", lambda r: r.queue.qsize()),
+            ("delivered_total", "counter", lambda r: r.delivered),
+            ("dropped_total", "counter", lambda r: r.dropped),
+            ("failed_total", "counter", lambda r: r.failed),
+            ("last_delivery_timestamp_seconds", "gauge", lambda r: r.delivered_at or 0),
+        ):
+            lines.append("# TYPE amongus_sink_{} {}".format(metric, kind))
+            for runner in self.runners:
+                lines.append(
+                    'amongus_sink_{}{{sink="{}"}} {}'.format(
+                        metric, runner.sink.name, value(runner)
+                    )
+                )
+        lines.append("# TYPE amongus_latency_seconds histogram")
+        for stage, histogram in (
+            ("capture", self.capture_latency),
+            ("state", self.state_latency),
+        ):
+            lines.extend(
+                histogram.prometheus_lines(
+                    "amongus_latency_seconds", 'stage="{}"'.format(stage)
+                )
+            )
+        lines.append("# TYPE amongus_sink_latency_seconds histogram")
+        for runner in self.runners:
+            for stage in SINK_STAGES:
+                lines.extend(
+                    runner.latency[stage].prometheus_lines(
+                        "amongus_sink_latency_seconds",
+                        'sink="{}",stage="{}"'.format(runner.sink.name, stage),
+                    )
+                )
+        return (
+            lines
+            + self.events.prometheus_lines()
+            + self.states.anomalies.prometheus_lines()
+            + self.states.metrics.prometheus_lines()
+        )
+
+
+class ArchiveSink(Sink):
+    # Appends every captured packet to a pcap file, for replaying later.
+
+    name = "archive"
+    queue_size = 65536
+
+    def __init__(self, path):
+        self.path = path
+        self._writer = scapy.utils.PcapWriter(path, append=True, sync=True)
+
+    def derive(self, pkt, game_id, game_state):
+        return pkt
+
+    def deliver(self, item):
+        self._writer.write(item)
+
+
+class MetricsSink(Sink):
+    # Counts state changes per game and round state, for /metrics.
+
+    name = "metrics"
+
+    def __init__(self):
+        self.changes = {}
+        self._lock = threading.Lock()
+
+    def derive(self, pkt, game_id, game_state):
+        if game_id is None:
+            return None
+        return (game_id, game_state.round_state.value)
+
+    def deliver(self, item):
+        with self._lock:
+            self.changes[item] = self.changes.get(item, 0) + 1
+
+    def prometheus_lines(self):
+        lines = ["# TYPE amongus_game_changes_total counter"]
+        with self._lock:
+            for (game_id, round_state), count in sorted(self.changes.items()):
+                lines.append(
+                    'amongus_game_changes_total{{game_id="{}",round_state="{}"}} {}'.format(
+                        game_id, round_state, count
+                    )
+                )
+        return lines
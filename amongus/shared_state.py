@@ -0,0 +1,339 @@
+# SPDX-FileCopyrightText: 2020 Luke Granger-Brown
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import atexit
+import collections
+import dataclasses
+import logging
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+import struct
+import time
+from typing import Dict, List, Optional, Tuple
+
+import amongus.runtime
+import amongus.state_tracker
+
+logger = logging.getLogger(__name__)
+
+RoundState = amongus.state_tracker.RoundState
+ROUND_STATES = tuple(RoundState)
+
+DEFAULT_PREFIX = "amongus"
+MAX_PLAYERS = 16
+MAX_GAMES = 64
+# Seconds after its last change that a game's region is freed, once another
+# game needs one.
+STALE_AFTER = 15 * 60
+# How many times readers retry a region that is being written before giving
+# up on it, in case the writer died part way through.
+READ_ATTEMPTS = 10000
+
+# Each region starts with a u64 sequence number, which is odd while the
+# writer is part way through changing it. Readers copy the rest and retry if
+# the sequence number was odd or has moved on.
+_SEQ = struct.Struct("<Q")
+_MAGIC = b"AUG1"
+# Written over the header of a region which has been freed, so that readers
+# still attached to it let go.
+_FREED = b"\0" * 4
+# magic, game_id, round_state, player_count, capture time.time().
+_GAME_HEADER = struct.Struct("<4sIBB2xd")
+# player_id, color_id, flags, pos x, pos y, vel x, vel y; positions are the
+# raw CustomNetworkTransform values.
+_PLAYER_SLOT = struct.Struct("<BBBxHHhh")
+_GAME_SIZE = _SEQ.size + _GAME_HEADER.size + MAX_PLAYERS * _PLAYER_SLOT.size
+# game count, then that many u32 game_ids.
+_INDEX_HEADER = struct.Struct("<I")
+_INDEX_ENTRY = struct.Struct("<I")
+_INDEX_SIZE = _SEQ.size + _INDEX_HEADER.size + MAX_GAMES * _INDEX_ENTRY.size
+
+_PLAYER_DEAD = 1
+_PLAYER_IMPOSTOR = 2
+_PLAYER_DISCONNECTED = 4
+_PLAYER_IN_VENT = 8
+_PLAYER_HAS_POSITION = 16
+
+
+def _game_region_name(prefix, game_id):
+    return "{}_{:08x}".format(prefix, game_id)
+
+
+@dataclasses.dataclass(frozen=True)
+class SharedPlayer:
+    player_id: int
+    color_id: int
+    is_dead: bool
+    is_impostor: bool
+    disconnected: bool
+    in_vent: bool
+    # None until the player's CustomNetworkTransform has been seen.
+    pos: Optional[Tuple[int, int]]
+    vel: Optional[Tuple[int, int]]
+
+
+@dataclasses.dataclass(frozen=True)
+class SharedGame:
+    game_id: int
+    # Even, and bumped by 2 for each change.
+    seq: int
+    round_state: RoundState
+    # Capture time of the packet behind the last change.
+    captured_at: float
+    players: Tuple[SharedPlayer, ...]
+
+
+def _pack_game(game_id, game_state, captured_at):
+    players = {}
+    game_data = game_state.find_netobj_of_type(amongus.state_tracker.NetObjGameData)
+    if game_data:
+        for p in game_data.players:
+            flags = (
+                (_PLAYER_DEAD if p.is_dead else 0)
+                | (_PLAYER_IMPOSTOR if p.is_impostor else 0)
+                | (_PLAYER_DISCONNECTED if p.disconnected else 0)
+            )
+            players[p.player_id] = [p.player_id, p.color_id, flags, 0, 0, 0, 0]
+    for net_id, obj in game_state.net_obj_map.items():
+        if obj.netobj_dead or not isinstance(
+            obj, amongus.state_tracker.NetObjPlayerControl
+        ):
+            continue
+        slot = players.get(obj.player_id, None)
+        if slot is None:
+            continue
+        # PlayerControl, PlayerPhysics and CustomNetworkTransform are spawned together.
+        physics = game_state.net_obj_map.get(net_id + 1, None)
+        if isinstance(physics, amongus.state_tracker.NetObjPlayerPhysics):
+            if physics.in_vent:
+                slot[2] |= _PLAYER_IN_VENT
+        transform = game_state.net_obj_map.get(net_id + 2, None)
+        if isinstance(transform, amongus.state_tracker.NetObjCustomNetworkTransform):
+            slot[2] |= _PLAYER_HAS_POSITION
+            slot[3:7] = [*transform.pos, *transform.vel]
+    slots = sorted(players.values())[:MAX_PLAYERS]
+    return _GAME_HEADER.pack(
+        _MAGIC,
+        game_id,
+        ROUND_STATES.index(game_state.round_state),
+        len(slots),
+        captured_at,
+    ) + b"".join(_PLAYER_SLOT.pack(*slot) for slot in slots)
+
+
+def _unpack_game(seq, body):
+    magic, game_id, round_state, player_count, captured_at = _GAME_HEADER.unpack_from(
+        body
+    )
+    if magic != _MAGIC:
+        raise ValueError("not an amongus game region")
+    players = []
+    for n in range(player_count):
+        player_id, color_id, flags, x, y, x_vel, y_vel = _PLAYER_SLOT.unpack_from(
+            body, _GAME_HEADER.size + n * _PLAYER_SLOT.size
+        )
+        has_position = bool(flags & _PLAYER_HAS_POSITION)
+        players.append(
+            SharedPlayer(
+                player_id=player_id,
+                color_id=color_id,
+                is_dead=bool(flags & _PLAYER_DEAD),
+                is_impostor=bool(flags & _PLAYER_IMPOSTOR),
+                disconnected=bool(flags & _PLAYER_DISCONNECTED),
+                in_vent=bool(flags & _PLAYER_IN_VENT),
+                pos=(x, y) if has_position else None,
+                vel=(x_vel, y_vel) if has_position else None,
+            )
+        )
+    return SharedGame(
+        game_id=game_id,
+        seq=seq,
+        round_state=ROUND_STATES[round_state],
+        captured_at=captured_at,
+        players=tuple(players),
+    )
+
+
+def _write(buf, body):
+    (seq,) = _SEQ.unpack_from(buf)
+    _SEQ.pack_into(buf, 0, seq + 1)
+    buf[_SEQ.size : _SEQ.size + len(body)] = body
+    _SEQ.pack_into(buf, 0, seq + 2)
+
+
+def _read(buf, size):
+    # Returns (None, None) if the region is still being written after
+    # READ_ATTEMPTS tries.
+    for _ in range(READ_ATTEMPTS):
+        (seq,) = _SEQ.unpack_from(buf)
+        if seq & 1:
+            continue
+        body = bytes(buf[_SEQ.size : _SEQ.size + size])
+        if _SEQ.unpack_from(buf)[0] == seq:
+            return seq, body
+    return None, None
+
+
+def _create(name, size):
+    try:
+        return shared_memory.SharedMemory(name, create=True, size=size)
+    except FileExistsError:
+        # Left behind by a tracker that didn't exit cleanly.
+        stale = shared_memory.SharedMemory(name)
+        stale.close()
+        stale.unlink()
+        return shared_memory.SharedMemory(name, create=True, size=size)
+
+
+class SharedStateSink(amongus.runtime.Sink):
+    # Keeps a shared memory region per game with its round state and a fixed
+    # slot per player, plus an index of the games, for readers in other
+    # processes to poll without any IPC. Only this sink's thread writes.
+    #
+    # GameStates never forgets a game, so regions are freed here instead:
+    # those of games which haven't changed for STALE_AFTER seconds when a new
+    # game turns up, and the least recently changed when there are MAX_GAMES.
+
+    name = "shm"
+
+    def __init__(self, prefix=DEFAULT_PREFIX, stale_after=STALE_AFTER):
+        self.prefix = prefix
+        self.stale_after = stale_after
+        self._packed: Dict[int, bytes] = {}
+        # (region, time.monotonic() of its last write) by game_id, least
+        # recently written first.
+        self._regions = collections.OrderedDict()
+        self._index = _create(prefix, _INDEX_SIZE)
+        self._write_index()
+        atexit.register(self.close)
+
+    def derive(self, pkt, game_id, game_state):
+        if game_id is None:
+            return None
+        body = _pack_game(game_id, game_state, float(pkt.time))
+        if body == self._packed.get(game_id, None):
+            return None
+        self._packed[game_id] = body
+        return (game_id, body)
+
+    def _write_index(self):
+        game_ids = list(self._regions)
+        _write(
+            self._index.buf,
+            _INDEX_HEADER.pack(len(game_ids))
+            + b"".join(_INDEX_ENTRY.pack(g) for g in game_ids),
+        )
+
+    def _free(self, game_id):
+        region, _ = self._regions.pop(game_id)
+        _write(region.buf, _FREED)
+        region.close()
+        region.unlink()
+        # So that the game's next change is delivered, should it come back.
+        # Only ever popped here, which is safe from this thread.
+        self._packed.pop(game_id, None)
+        logger.info("Freed shared region of game %d", game_id)
+
+    def _allocate(self, game_id, now):
+        for stale_id, (_, written_at) in list(self._regions.items()):
+            if now - written_at < self.stale_after:
+                break
+            self._free(stale_id)
+        if len(self._regions) >= MAX_GAMES:
+            self._free(next(iter(self._regions)))
+        region = _create(_game_region_name(self.prefix, game_id), _GAME_SIZE)
+        self._regions[game_id] = (region, now)
+        self._write_index()
+        return region
+
+    def deliver(self, item):
+        game_id, body = item
+        now = time.monotonic()
+        entry = self._regions.get(game_id, None)
+        if entry is None:
+            region = self._allocate(game_id, now)
+        else:
+            region = entry[0]
+            self._regions[game_id] = (region, now)
+            self._regions.move_to_end(game_id)
+        _write(region.buf, body)
+
+    def close(self):
+        for region in [self._index, *(r for r, _ in self._regions.values())]:
+            region.close()
+            region.unlink()
+        self._regions = collections.OrderedDict()
+        atexit.unregister(self.close)
+
+
+class SharedStateReader:
+    # Reads the regions a SharedStateSink keeps, from any process.
+
+    def __init__(self, prefix=DEFAULT_PREFIX):
+        self.prefix = prefix
+        self._index = self._attach(prefix)
+        self._regions: Dict[int, shared_memory.SharedMemory] = {}
+
+    def _attach(self, name):
+        region = shared_memory.SharedMemory(name)
+        # Only the writer should unlink the region, but attaching registers it
+        # to be unlinked when this process exits.
+        resource_tracker.unregister(region._name, "shared_memory")
+        return region
+
+    def game_ids(self) -> List[int]:
+        _, body = _read(self._index.buf, _INDEX_SIZE - _SEQ.size)
+        if body is None:
+            logger.warning("Shared index %s is stuck mid-write", self.prefix)
+            return []
+        (count,) = _INDEX_HEADER.unpack_from(body)
+        return [
+            _INDEX_ENTRY.unpack_from(body, _INDEX_HEADER.size + n * _INDEX_ENTRY.size)[
+                0
+            ]
+            for n in range(count)
+        ]
+
+    def _region(self, game_id):
+        region = self._regions.get(game_id, None)
+        if region is None:
+            try:
+                region = self._attach(_game_region_name(self.prefix, game_id))
+            except FileNotFoundError:
+                return None
+            self._regions[game_id] = region
+        return region
+
+    def seq(self, game_id) -> Optional[int]:
+        # For pollers to skip games which haven't changed since they last read.
+        region = self._region(game_id)
+        if region is None:
+            return None
+        return _SEQ.unpack_from(region.buf)[0] & ~1
+
+    def _detach(self, game_id):
+        self._regions.pop(game_id).close()
+
+    def read(self, game_id) -> Optional[SharedGame]:
+        # None for games which aren't shared (any more), haven't been written
+        # yet, or whose writer is stuck mid-write.
+        region = self._region(game_id)
+        if region is None:
+            return None
+        seq, body = _read(region.buf, _GAME_SIZE - _SEQ.size)
+        if body is None:
+            logger.warning("Shared region of game %d is stuck mid-write", game_id)
+            return None
+        if seq == 0:
+            return None
+        if body[: len(_FREED)] == _FREED:
+            # The game may be shared again later, in a new region.
+            self._detach(game_id)
+            return None
+        return _unpack_game(seq, body)
+
+    def close(self):
+        for region in [self._index, *self._regions.values()]:
+            region.close()
+        self._regions = {}
@@ -0,0 +1,198 @@
+# SPDX-FileCopyrightText: 2020 Luke Granger-Brown
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import dataclasses
+import types
+from typing import Dict, FrozenSet, Mapping, Optional, Tuple
+
+import amongus.state_tracker
+
+RoundState = amongus.state_tracker.RoundState
+
+_frozen_classes = {}
+
+
+def _readonly(self, *args):
+    raise dataclasses.FrozenInstanceError(
+        "{} is part of a snapshot".format(type(self).__name__)
+    )
+
+
+def _frozen_class(cls):
+    # A subclass of a NetObj class which can't be changed, so that snapshots
+    # pass the same isinstance() checks as the live objects.
+    frozen = _frozen_classes.get(cls, None)
+    if frozen is None:
+        frozen = _frozen_classes[cls] = type(
+            cls.__name__,
+            (cls,),
+            {"__setattr__": _readonly, "__delattr__": _readonly, "__hash__": None},
+        )
+    return frozen
+
+
+def _freeze_value(value):
+    if isinstance(value, list):
+        return tuple(_freeze_value(v) for v in value)
+    if isinstance(value, amongus.state_tracker.BaseNetObj):
+        return freeze(value)
+    return value
+
+
+def freeze(obj, **changes):
+    # An immutable copy of obj, with lists as tuples. NetObjs lose their
+    # game_state, so only their fields can be read.
+    frozen = object.__new__(_frozen_class(type(obj)))
+    for f in dataclasses.fields(obj):
+        if f.name in changes:
+            value = changes[f.name]
+        elif f.name == "game_state":
+            value = None
+        else:
+            value = _freeze_value(getattr(obj, f.name))
+        object.__setattr__(frozen, f.name, value)
+    return frozen
+
+
+@dataclasses.dataclass(frozen=True)
+class RosterSnapshot:
+    version: int
+    alive: FrozenSet[str]
+    dead: FrozenSet[str]
+    impostors: FrozenSet[str]
+
+
+@dataclasses.dataclass(frozen=True)
+class GameSnapshot:
+    # An immutable GameState, as of one packet. Objects which didn't change
+    # between snapshots are shared by them, so they are cheap to make and to
+    # hold on to from any thread.
+    game_id: int
+    # Bumped by 1 for each snapshot of the game.
+    version: int
+    # Capture time of the packet behind the snapshot, as a time.time().
+    captured_at: Optional[float]
+    round_state: RoundState
+    scene: str
+    game_options: Optional[amongus.state_tracker.NetObjGameOptions]
+    net_obj_map: Mapping[int, amongus.state_tracker.BaseNetObj]
+    chat_log: Tuple[str, ...]
+    rosters: RosterSnapshot
+
+    def find_netobj_of_type(self, cls):
+        netobj = None
+        for v in self.net_obj_map.values():
+            if v.netobj_dead:
+                continue
+            if isinstance(v, cls):
+                if netobj:
+                    raise Exception("multiple netobj of type {}".format(cls))
+                netobj = v
+        return netobj
+
+
+class _GameSnapshotter:
+    def __init__(self, game_id):
+        self.game_id = game_id
+        self.latest: Optional[GameSnapshot] = None
+        self._net_obj_map = None
+        self._net_objs: Dict[int, amongus.state_tracker.BaseNetObj] = {}
+        # Each player's live object and its snapshot, by player_id, for
+        # reuse until it is changed or replaced.
+        self._players = {}
+        self._game_options = None
+
+    def _freeze_player(self, player, changed_player_ids):
+        source, frozen = self._players.get(player.player_id, (None, None))
+        if source is not player or player.player_id in changed_player_ids:
+            frozen = freeze(player)
+            self._players[player.player_id] = (player, frozen)
+        return frozen
+
+    def _freeze_net_obj(self, obj, changed_player_ids):
+        if isinstance(obj, amongus.state_tracker.NetObjGameData):
+            return freeze(
+                obj,
+                players=tuple(
+                    self._freeze_player(p, changed_player_ids) for p in obj.players
+                ),
+            )
+        return freeze(obj)
+
+    def snapshot(self, state) -> GameSnapshot:
+        changed_net_ids, changed_player_ids = state.take_changes()
+        latest = self.latest
+        if state.net_obj_map is not self._net_obj_map:
+            # The state was reset, so nothing can be reused.
+            self._net_obj_map = state.net_obj_map
+            self._net_objs = {}
+            self._players = {}
+            changed_net_ids = set(state.net_obj_map)
+        net_objs = self._net_objs
+        for net_id in changed_net_ids:
+            if net_objs is self._net_objs:
+                # The last snapshot holds on to the old map.
+                net_objs = dict(net_objs)
+            obj = state.net_obj_map.get(net_id, None)
+            if obj is None:
+                net_objs.pop(net_id, None)
+                continue
+            net_objs[net_id] = self._freeze_net_obj(obj, changed_player_ids)
+        if latest is None or net_objs is not self._net_objs:
+            self._net_objs = net_objs
+            net_obj_map = types.MappingProxyType(net_objs)
+        else:
+            net_obj_map = latest.net_obj_map
+
+        game_options = latest.game_options if latest else None
+        if state.game_options is not self._game_options:
+            self._game_options = state.game_options
+            game_options = state.game_options and freeze(state.game_options)
+        rosters = state.rosters
+        if latest and latest.rosters.version == rosters.version:
+            roster_snapshot = latest.rosters
+        else:
+            roster_snapshot = RosterSnapshot(
+                version=rosters.version,
+                alive=rosters.alive,
+                dead=rosters.dead,
+                impostors=rosters.impostors,
+            )
+        # The chat log is only ever appended to.
+        chat_log = latest.chat_log if latest else ()
+        if len(chat_log) != len(state.chat_log):
+            chat_log = tuple(state.chat_log)
+
+        self.latest = GameSnapshot(
+            game_id=self.game_id,
+            version=latest.version + 1 if latest else 1,
+            captured_at=state.captured_at,
+            round_state=state.round_state,
+            scene=state.scene,
+            game_options=game_options,
+            net_obj_map=net_obj_map,
+            chat_log=chat_log,
+            rosters=roster_snapshot,
+        )
+        return self.latest
+
+
+class Snapshots:
+    # Takes a GameSnapshot of each game as it changes, on the capture thread.
+    # The latest of each may be read from any thread.
+
+    def __init__(self):
+        self._games: Dict[int, _GameSnapshotter] = {}
+        self.latest: Dict[int, GameSnapshot] = {}
+
+    def update(self, game_id, state) -> GameSnapshot:
+        snapshotter = self._games.get(game_id, None)
+        if snapshotter is None:
+            snapshotter = self._games[game_id] = _GameSnapshotter(game_id)
+        snapshot = self.latest[game_id] = snapshotter.snapshot(state)
+        return snapshot
+
+    def forget(self, game_id):
+        self._games.pop(game_id, None)
+        self.latest.pop(game_id, None)
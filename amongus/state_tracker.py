@@ -6,12 +6,16 @@ import copy
 import dataclasses
 import enum
 import logging
-from typing import Dict, List, Optional, Tuple
+import time
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
 
 import scapy.packet
 
+import amongus.anomalies
 import amongus.enums
+import amongus.events
 import amongus.hazel_packets
+import amongus.packet_metrics
 
 logger = logging.getLogger(__name__)
 
@@ -124,12 +128,87 @@ class RoundState(enum.Enum):
     POSTGAME = "postgame"
 
 
+@dataclasses.dataclass
+class PlayerRosters:
+    # Player names by fate, kept up to date as players change. The sets are
+    # only replaced when a name, is_dead or is_impostor changes, and version
+    # is bumped each time, so callers can compare versions instead of sets.
+    version: int = 0
+    alive: FrozenSet[str] = frozenset()
+    dead: FrozenSet[str] = frozenset()
+    impostors: FrozenSet[str] = frozenset()
+    _players: Dict[int, Tuple[str, bool, bool]] = dataclasses.field(
+        default_factory=dict, repr=False
+    )
+
+    def _rebuild(self):
+        self.version += 1
+        self.alive = frozenset(
+            name for name, is_dead, _ in self._players.values() if not is_dead
+        )
+        self.dead = frozenset(
+            name for name, is_dead, _ in self._players.values() if is_dead
+        )
+        self.impostors = frozenset(
+            name for name, _, is_impostor in self._players.values() if is_impostor
+        )
+
+    def update_player(self, player):
+        entry = (player.name, player.is_dead, player.is_impostor)
+        if self._players.get(player.player_id, None) == entry:
+            return
+        self._players[player.player_id] = entry
+        self._rebuild()
+
+    def replace_players(self, players):
+        self._players = {
+            p.player_id: (p.name, p.is_dead, p.is_impostor) for p in players
+        }
+        self._rebuild()
+
+
+# Metadata for fields which are bookkeeping rather than game data, so asdict()
+# leaves them out.
+_NOT_SERIALIZED = {"serialize": False}
+
+
 @dataclasses.dataclass
 class GameState:
     game_options: NetObjGameOptions = None
     net_obj_map: Dict[int, BaseNetObj] = dataclasses.field(default_factory=dict)
     scene: str = "OnlineGame"
     chat_log: List[str] = dataclasses.field(default_factory=list)
+    rosters: PlayerRosters = dataclasses.field(
+        default_factory=PlayerRosters, metadata=_NOT_SERIALIZED
+    )
+    # The net_ids and player_ids of whatever changed since take_changes(), so
+    # that snapshots can reuse the rest.
+    changed_net_ids: Set[int] = dataclasses.field(
+        default_factory=set, repr=False, metadata=_NOT_SERIALIZED
+    )
+    changed_player_ids: Set[int] = dataclasses.field(
+        default_factory=set, repr=False, metadata=_NOT_SERIALIZED
+    )
+    # What events from the handlers are stamped with.
+    game_id: Optional[int] = dataclasses.field(default=None, metadata=_NOT_SERIALIZED)
+    captured_at: Optional[float] = dataclasses.field(
+        default=None, repr=False, metadata=_NOT_SERIALIZED
+    )
+    event_bus: Optional[amongus.events.EventBus] = dataclasses.field(
+        default=None, repr=False, compare=False, metadata=_NOT_SERIALIZED
+    )
+    anomalies: amongus.anomalies.Anomalies = dataclasses.field(
+        default_factory=amongus.anomalies.Anomalies,
+        repr=False,
+        compare=False,
+        metadata=_NOT_SERIALIZED,
+    )
+    metrics: amongus.packet_metrics.PacketMetrics = dataclasses.field(
+        default_factory=amongus.packet_metrics.PacketMetrics,
+        repr=False,
+        compare=False,
+        metadata=_NOT_SERIALIZED,
+    )
 
     @property
     def extra_serializable_attributes(self):
@@ -146,14 +225,49 @@ class GameState:
                 netobj = v
         return netobj
 
-    def get_game_data_player(self, player_id):
+    def mark_changed(self, net_id, player_id=None):
+        self.changed_net_ids.add(net_id)
+        if player_id is not None:
+            self.changed_player_ids.add(player_id)
+
+    def take_changes(self) -> Tuple[Set[int], Set[int]]:
+        changes = (self.changed_net_ids, self.changed_player_ids)
+        self.changed_net_ids = set()
+        self.changed_player_ids = set()
+        return changes
+
+    @property
+    def emitting(self) -> bool:
+        # Handlers check this before looking up what their events need.
+        return self.event_bus is not None and bool(self.event_bus.subscriptions)
+
+    def emit(self, event_cls, **kwargs):
+        self.event_bus.publish(
+            event_cls(game_id=self.game_id, captured_at=self.captured_at, **kwargs)
+        )
+
+    def get_game_data_player(self, player_id, changing=False):
+        # Callers which change the player they get pass changing=True, so
+        # that it is snapshotted again.
         game_data = self.find_netobj_of_type(NetObjGameData)
+        if game_data is None:
+            raise KeyError("no GameData for player_id={}".format(player_id))
         for p in game_data.players:
             if p.player_id == player_id:
+                if changing:
+                    self.mark_changed(game_data.net_id, player_id)
                 return p
         p = NetObjGameDataPlayer(player_id=player_id)
         game_data.players.append(p)
-        logger.warning("Generating GameDataPlayer instance for player %d", player_id)
+        self.mark_changed(game_data.net_id, player_id)
+        self.rosters.update_player(p)
+        self.anomalies.note(
+            amongus.anomalies.GENERATED_PLAYER,
+            None,
+            None,
+            "Generating GameDataPlayer instance for player %d",
+            player_id,
+        )
         return p
 
     @property
@@ -171,12 +285,18 @@ class GameState:
         logger.info("Resetting state")
         self.net_obj_map = {}
         self.game_options = None
+        self.rosters.replace_players([])
 
     def process_packet(self, pkt) -> bool:
-        if amongus.hazel_packets.Hazel not in pkt:
+        hzl = pkt.getlayer(amongus.hazel_packets.Hazel)
+        if hzl is None:
             return False
-        hzl = pkt[amongus.hazel_packets.Hazel]
-        if hzl.type in (
+        return self.process_hazel(hzl, hzl.type)
+
+    def process_hazel(self, hzl, hazel_type) -> bool:
+        # For callers which have already looked up the Hazel layer and its
+        # type; scapy is slow to do either.
+        if hazel_type in (
             amongus.enums.HazelPacketType.PING.value,
             amongus.enums.HazelPacketType.ACK.value,
         ):
@@ -187,129 +307,298 @@ class GameState:
             msgs = hzl[amongus.messages.AmongUsDirectedMessage].messages
         else:
             return False
+        metrics = self.metrics
         for msg in msgs:
-            if msg.tag == amongus.enums.AmongUsMessageType.MSG_SPAWN.value:
-                spawn = msg[amongus.spawn.AmongUsSpawnMessage]
-                prefab = amongus.enums.AmongUsInnerNetSpawnPrefabs(spawn.spawnable_id)
-                if prefab == amongus.enums.AmongUsInnerNetSpawnPrefabs.LOBBY_BEHAVIOR:
-                    # Reset the state!
-                    self.reset()
-                if len(prefab.spawn_children) != len(spawn.children):
-                    logger.warning(
-                        "Spawned spawnable_id=%d with %d children (expected %d)",
-                        spawn.spawnable_id,
-                        len(spawn.children),
-                        len(prefab.spawn_children),
+            tag = msg.tag
+            metrics.messages[tag] += 1
+            start = time.perf_counter_ns()
+            handler_ns = self._process_message(msg, tag)
+            metrics.observe(
+                metrics.decode_latency,
+                tag,
+                time.perf_counter_ns() - start - handler_ns,
+            )
+        return True
+
+    def _process_message(self, msg, tag) -> int:
+        # Returns the nanoseconds spent in handlers.
+        metrics = self.metrics
+        handler_ns = 0
+        if tag == amongus.enums.AmongUsMessageType.MSG_SPAWN.value:
+            spawn = msg[amongus.spawn.AmongUsSpawnMessage]
+            prefab = amongus.enums.AmongUsInnerNetSpawnPrefabs(spawn.spawnable_id)
+            if prefab == amongus.enums.AmongUsInnerNetSpawnPrefabs.LOBBY_BEHAVIOR:
+                # Reset the state!
+                self.reset()
+            if len(prefab.spawn_children) != len(spawn.children):
+                self.anomalies.note(
+                    amongus.anomalies.SPAWN_CHILD_COUNT,
+                    prefab,
+                    None,
+                    "Spawned spawnable_id=%d with %d children (expected %d)",
+                    spawn.spawnable_id,
+                    len(spawn.children),
+                    len(prefab.spawn_children),
+                )
+            else:
+                for ch in zip(prefab.spawn_children, spawn.children):
+                    child_enum, child_pkt = ch
+                    child_cls = net_obj_dataclass_map.get(child_enum, None)
+                    if not child_cls:
+                        self.anomalies.note(
+                            amongus.anomalies.UNKNOWN_SPAWNABLE,
+                            child_enum,
+                            None,
+                            "Unknown spawnable %s with net_id=%d",
+                            child_enum,
+                            child_pkt.net_id,
+                        )
+                        continue
+                    initial_layer = amongus.data.initial_data_layers.get(
+                        child_enum, None
                     )
-                else:
-                    for ch in zip(prefab.spawn_children, spawn.children):
-                        child_enum, child_pkt = ch
-                        child_cls = net_obj_dataclass_map.get(child_enum, None)
-                        if not child_cls:
-                            logger.warning(
-                                "Unknown spawnable %s with net_id=%d",
-                                child_enum,
-                                child_pkt.net_id,
-                            )
-                            continue
-                        initial_layer = amongus.data.initial_data_layers.get(
-                            child_enum, None
+                    if initial_layer:
+                        initial_data = initial_layer(child_pkt.msg)
+                    elif len(child_pkt.msg) == 0:
+                        # We don't have an initial layer for PLAYER_PHYSICS. There's no data.
+                        initial_data = None
+                    else:
+                        self.anomalies.note(
+                            amongus.anomalies.UNKNOWN_INITIAL_LAYER,
+                            child_enum,
+                            None,
+                            "Unknown initial_data_layer %s with net_id=%d (payload length=%d)",
+                            child_enum,
+                            child_pkt.net_id,
+                            len(child_pkt.msg),
                         )
-                        if initial_layer:
-                            initial_data = initial_layer(child_pkt.msg)
-                        elif len(child_pkt.msg) == 0:
-                            # We don't have an initial layer for PLAYER_PHYSICS. There's no data.
-                            initial_data = None
-                        else:
-                            logger.warning(
-                                "Unknown initial_data_layer %s with net_id=%d (payload length=%d)",
-                                child_enum,
-                                child_pkt.net_id,
-                                len(child_pkt.msg),
-                            )
-                            continue
-                        if (
-                            child_pkt.net_id in self.net_obj_map
-                            and not self.net_obj_map[child_pkt.net_id].netobj_dead
-                        ):
-                            logger.warning(
-                                "Spawning %s on top of existing %s (net_id=%d)",
-                                child_enum,
-                                self.net_obj_map[child_pkt.net_id].netobj_type,
-                                child_pkt.net_id,
-                            )
-                        self.net_obj_map[
-                            child_pkt.net_id
-                        ] = child_cls.construct_from_spawn_data(
-                            self, child_enum, child_pkt.net_id, initial_data
+                        continue
+                    if (
+                        child_pkt.net_id in self.net_obj_map
+                        and not self.net_obj_map[child_pkt.net_id].netobj_dead
+                    ):
+                        self.anomalies.note(
+                            amongus.anomalies.SPAWN_OVER_EXISTING,
+                            child_enum,
+                            None,
+                            "Spawning %s on top of existing %s (net_id=%d)",
+                            child_enum,
+                            self.net_obj_map[child_pkt.net_id].netobj_type,
+                            child_pkt.net_id,
                         )
-            elif msg.tag == amongus.enums.AmongUsMessageType.MSG_RPC.value:
-                rpc = msg[amongus.rpcs.AmongUsRPCMessage]
-                obj = self.net_obj_map.get(rpc.net_id, None)
-                if not obj:
-                    logger.warning(
-                        "RPC sent to net_id=%d that I didn't see spawn", rpc.net_id
-                    )
-                    continue
-                if obj.netobj_dead:
-                    logger.warning(
-                        "RPC sent to net_id=%d (%s) that is already dead",
-                        rpc.net_id,
-                        obj.netobj_type,
-                    )
-                rpc_enum = amongus.enums.AmongUsRPCType(rpc.call_id)
-                handler = getattr(obj, "handle_{}".format(rpc_enum._name_), None)
-                if not handler:
-                    logger.warning(
-                        "RPC %s sent to net_id=%d (%s) with no registered handler",
-                        rpc_enum,
-                        rpc.net_id,
-                        obj.netobj_type,
+                    start = time.perf_counter_ns()
+                    self.net_obj_map[
+                        child_pkt.net_id
+                    ] = child_cls.construct_from_spawn_data(
+                        self, child_enum, child_pkt.net_id, initial_data
                     )
-                    continue
+                    ns = time.perf_counter_ns() - start
+                    metrics.observe(metrics.spawn_latency, child_enum.value, ns)
+                    handler_ns += ns
+                    self.mark_changed(child_pkt.net_id)
+        elif tag == amongus.enums.AmongUsMessageType.MSG_RPC.value:
+            rpc = msg[amongus.rpcs.AmongUsRPCMessage]
+            call_id = rpc.call_id
+            metrics.rpcs[call_id] += 1
+            try:
+                rpc_enum = amongus.enums.AmongUsRPCType(call_id)
+            except ValueError:
+                self.anomalies.note(
+                    amongus.anomalies.UNKNOWN_RPC,
+                    None,
+                    None,
+                    "Unknown RPC call_id=%d sent to net_id=%d",
+                    call_id,
+                    rpc.net_id,
+                )
+                return 0
+            obj = self.net_obj_map.get(rpc.net_id, None)
+            if not obj:
+                self.anomalies.note(
+                    amongus.anomalies.RPC_UNKNOWN_NET_ID,
+                    None,
+                    rpc_enum,
+                    "RPC %s sent to net_id=%d that I didn't see spawn",
+                    rpc_enum,
+                    rpc.net_id,
+                )
+                return 0
+            if obj.netobj_dead:
+                self.anomalies.note(
+                    amongus.anomalies.RPC_DEAD_NET_ID,
+                    obj.netobj_type,
+                    rpc_enum,
+                    "RPC %s sent to net_id=%d (%s) that is already dead",
+                    rpc_enum,
+                    rpc.net_id,
+                    obj.netobj_type,
+                )
+            handler = getattr(obj, "handle_{}".format(rpc_enum._name_), None)
+            if not handler:
+                self.anomalies.note(
+                    amongus.anomalies.RPC_NO_HANDLER,
+                    obj.netobj_type,
+                    rpc_enum,
+                    "RPC %s sent to net_id=%d (%s) with no registered handler",
+                    rpc_enum,
+                    rpc.net_id,
+                    obj.netobj_type,
+                )
+                return 0
+            self.mark_changed(rpc.net_id)
+            start = time.perf_counter_ns()
+            try:
                 handler(rpc)
-            elif msg.tag == amongus.enums.AmongUsMessageType.MSG_DATA_UPDATE.value:
-                update = msg[amongus.data.AmongUsDataMessage]
-                obj = self.net_obj_map.get(update.net_id, None)
-                if not obj:
-                    logger.warning(
-                        "Data update for net_id=%d that I didn't see spawn",
-                        update.net_id,
-                    )
-                    continue
-                if obj.netobj_dead:
-                    logger.warning(
-                        "Data update for net_id=%d (%s) that is already dead",
-                        update.net_id,
-                        obj.netobj_type,
-                    )
-                update_layer = amongus.data.data_layers.get(obj.netobj_type, None)
-                if not update_layer:
-                    logger.warning(
-                        "Data update for net_id=%d (%s) that has no associated update layer",
-                        update.net_id,
-                        obj.netobj_type,
-                    )
-                    continue
-                obj.update_from_packet(update_layer(update[scapy.packet.Raw].load))
-            elif msg.tag == amongus.enums.AmongUsMessageType.MSG_DESPAWN.value:
-                despawn = msg[amongus.spawn.AmongUsDespawnMessage]
-                if despawn.net_id in self.net_obj_map:
-                    self.net_obj_map[despawn.net_id].netobj_dead = True
-                else:
-                    logger.warning(
-                        "Despawning net_id=%d that I didn't see spawn", despawn.net_id
-                    )
-            elif msg.tag == amongus.enums.AmongUsMessageType.MSG_CHANGE_SCENE.value:
-                scene = msg.scene.decode("utf8")
-                logger.info("Changing scene to %s", scene)
-                self.scene = scene
-        return True
+            except KeyError as error:
+                # An object it refers to which we didn't see spawn, having
+                # attached part way through a game.
+                self.anomalies.note(
+                    amongus.anomalies.HANDLER_MISSING_OBJECT,
+                    obj.netobj_type,
+                    rpc_enum,
+                    "RPC %s to net_id=%d (%s) refers to something missing: %s",
+                    rpc_enum,
+                    rpc.net_id,
+                    obj.netobj_type,
+                    error,
+                )
+            except Exception:
+                # Counted rather than raised so that one bad handler can't
+                # stop the capture, but with the traceback of the first.
+                self.anomalies.note(
+                    amongus.anomalies.HANDLER_FAILED,
+                    obj.netobj_type,
+                    rpc_enum,
+                    "RPC %s to net_id=%d (%s) failed",
+                    rpc_enum,
+                    rpc.net_id,
+                    obj.netobj_type,
+                    exc_info=True,
+                )
+            handler_ns = time.perf_counter_ns() - start
+            metrics.observe(metrics.rpc_latency, call_id, handler_ns)
+        elif tag == amongus.enums.AmongUsMessageType.MSG_DATA_UPDATE.value:
+            update = msg[amongus.data.AmongUsDataMessage]
+            obj = self.net_obj_map.get(update.net_id, None)
+            if not obj:
+                self.anomalies.note(
+                    amongus.anomalies.DATA_UNKNOWN_NET_ID,
+                    None,
+                    None,
+                    "Data update for net_id=%d that I didn't see spawn",
+                    update.net_id,
+                )
+                return 0
+            if obj.netobj_dead:
+                self.anomalies.note(
+                    amongus.anomalies.DATA_DEAD_NET_ID,
+                    obj.netobj_type,
+                    None,
+                    "Data update for net_id=%d (%s) that is already dead",
+                    update.net_id,
+                    obj.netobj_type,
+                )
+            update_layer = amongus.data.data_layers.get(obj.netobj_type, None)
+            if not update_layer:
+                self.anomalies.note(
+                    amongus.anomalies.DATA_NO_LAYER,
+                    obj.netobj_type,
+                    None,
+                    "Data update for net_id=%d (%s) that has no associated update layer",
+                    update.net_id,
+                    obj.netobj_type,
+                )
+                return 0
+            self.mark_changed(update.net_id)
+            data = update_layer(update[scapy.packet.Raw].load)
+            start = time.perf_counter_ns()
+            obj.update_from_packet(data)
+            handler_ns = time.perf_counter_ns() - start
+            metrics.observe(metrics.data_latency, obj.netobj_type.value, handler_ns)
+        elif tag == amongus.enums.AmongUsMessageType.MSG_DESPAWN.value:
+            despawn = msg[amongus.spawn.AmongUsDespawnMessage]
+            if despawn.net_id in self.net_obj_map:
+                self.net_obj_map[despawn.net_id].netobj_dead = True
+                self.mark_changed(despawn.net_id)
+            else:
+                self.anomalies.note(
+                    amongus.anomalies.DESPAWN_UNKNOWN_NET_ID,
+                    None,
+                    None,
+                    "Despawning net_id=%d that I didn't see spawn",
+                    despawn.net_id,
+                )
+        elif tag == amongus.enums.AmongUsMessageType.MSG_CHANGE_SCENE.value:
+            scene = msg.scene.decode("utf8")
+            logger.info("Changing scene to %s", scene)
+            self.scene = scene
+        return handler_ns
 
     def asdict(self):
         return asdict(self)
 
 
+def packet_game_id(pkt) -> Optional[int]:
+    if amongus.messages.AmongUsBroadcastMessage in pkt:
+        return pkt[amongus.messages.AmongUsBroadcastMessage].game_id
+    elif amongus.messages.AmongUsDirectedMessage in pkt:
+        return pkt[amongus.messages.AmongUsDirectedMessage].game_id
+    return None
+
+
+@dataclasses.dataclass
+class GameStates:
+    games: Dict[int, GameState] = dataclasses.field(default_factory=dict)
+    event_bus: Optional[amongus.events.EventBus] = None
+    anomalies: amongus.anomalies.Anomalies = dataclasses.field(
+        default_factory=amongus.anomalies.Anomalies
+    )
+    metrics: amongus.packet_metrics.PacketMetrics = dataclasses.field(
+        default_factory=amongus.packet_metrics.PacketMetrics
+    )
+
+    def process_packet(self, pkt) -> Optional[int]:
+        # Returns the game_id of the GameState that changed, if any.
+        start = time.perf_counter_ns()
+        hzl = pkt.getlayer(amongus.hazel_packets.Hazel)
+        if hzl is None:
+            return None
+        hazel_type = hzl.type
+        self.metrics.count_packet(hazel_type, len(pkt.original) if pkt.original else 0)
+        game_id = self._process_hazel(pkt, hzl, hazel_type)
+        self.metrics.packet_latency.observe(time.perf_counter_ns() - start)
+        return game_id
+
+    def _process_hazel(self, pkt, hzl, hazel_type):
+        game_id = packet_game_id(hzl)
+        if game_id is None:
+            return None
+        state = self.games.get(game_id, None)
+        if state is None:
+            state = self.games[game_id] = GameState(
+                game_id=game_id,
+                event_bus=self.event_bus,
+                anomalies=self.anomalies,
+                metrics=self.metrics,
+            )
+        state.captured_at = float(pkt.time)
+        if not state.process_hazel(hzl, hazel_type):
+            return None
+        return game_id
+
+    def expire(self, before) -> List[int]:
+        # Forgets the games with no packets captured since before, and
+        # returns their game_ids.
+        expired = [
+            game_id
+            for game_id, state in self.games.items()
+            if state.captured_at is not None and state.captured_at < before
+        ]
+        for game_id in expired:
+            del self.games[game_id]
+        return expired
+
+
 @_register_net_obj_dataclass(amongus.enums.AmongUsInnerNetClients.SHIP_STATUS_POLUS)
 @_register_net_obj_dataclass(amongus.enums.AmongUsInnerNetClients.SHIP_STATUS_KELD)
 @_register_net_obj_dataclass(amongus.enums.AmongUsInnerNetClients.SHIP_STATUS_MIRA_HQ)
@@ -350,45 +639,54 @@ class NetObjMeetingHud(NetObj):
             self.votes[idx] = NetObjMeetingHudVote.construct_from_spawn_data(vote_pkt)
 
     def handle_CAST_VOTE(self, pkt):
-        src_player = self.game_state.get_game_data_player(pkt.src_player_id)
-        suspect_player_name = None
+        if not self.game_state.emitting:
+            return
+        suspect_player_id = suspect_player_name = None
         if pkt.suspect_player_id != 0xFF:
-            suspect_player = self.game_state.get_game_data_player(pkt.suspect_player_id)
-            suspect_player_name = suspect_player.name
-        else:
-            suspect_player_name = "[skip]"
-        print("{} votes for {}".format(src_player.name, suspect_player_name))
+            suspect_player_id = pkt.suspect_player_id
+            suspect_player_name = self.game_state.get_game_data_player(
+                suspect_player_id
+            ).name
+        self.game_state.emit(
+            amongus.events.VoteCast,
+            voter_id=pkt.src_player_id,
+            voter=self.game_state.get_game_data_player(pkt.src_player_id).name,
+            suspect_id=suspect_player_id,
+            suspect=suspect_player_name,
+        )
+
+    def _vote_result(self, n, vote):
+        voted_for_id = voted_for_name = None
+        if not vote.is_dead and vote.has_voted and vote.voted_for != -1:
+            voted_for_id = vote.voted_for
+            voted_for_name = self.game_state.get_game_data_player(voted_for_id).name
+        return amongus.events.VoteResult(
+            player_id=n,
+            player=self.game_state.get_game_data_player(n).name,
+            was_reporter=bool(vote.was_reporter),
+            is_dead=bool(vote.is_dead),
+            has_voted=bool(vote.has_voted),
+            voted_for_id=voted_for_id,
+            voted_for=voted_for_name,
+        )
 
     def handle_VOTING_COMPLETE(self, pkt):
-        print("Voting complete!\n\tVotes:")
-        for nvote in enumerate(pkt.votes):
-            n, vote = nvote
-            src_player = self.game_state.get_game_data_player(n)
-            src_player_name = src_player.name
-            if vote.was_reporter:
-                src_player_name += " (reporter)"
-            txt = ""
-            if vote.is_dead:
-                txt = "is dead"
-            elif not vote.has_voted:
-                txt = "did not vote"
-            elif vote.voted_for == -1:
-                txt = "voted to skip"
-            else:
-                dst_player_name = self.game_state.get_game_data_player(
-                    vote.voted_for
-                ).name
-                txt = "voted for {}".format(dst_player_name)
-            print("\t\t{} {}".format(src_player_name, txt))
-        print("\n\tResults:")
-        if pkt.tie:
-            print("\t\t...it was a tie.")
-        elif pkt.exiled_player_id == 0xFF:
-            print("\t\tSkipped.")
-        else:
-            exiled_player = self.game_state.get_game_data_player(pkt.exiled_player_id)
-            print("\t\t{} was ejected.".format(exiled_player.name))
+        exiled_player = None
+        if not pkt.tie and pkt.exiled_player_id != 0xFF:
+            exiled_player = self.game_state.get_game_data_player(
+                pkt.exiled_player_id, changing=True
+            )
             exiled_player.is_dead = True
+            self.game_state.rosters.update_player(exiled_player)
+        if not self.game_state.emitting:
+            return
+        self.game_state.emit(
+            amongus.events.VotingComplete,
+            votes=tuple(self._vote_result(n, vote) for n, vote in enumerate(pkt.votes)),
+            tie=bool(pkt.tie),
+            exiled_id=exiled_player.player_id if exiled_player else None,
+            exiled=exiled_player.name if exiled_player else None,
+        )
 
     def handle_CLOSE_MEETING_HUD(self, pkt):
         self.netobj_dead = True
@@ -501,6 +799,14 @@ class NetObjGameData(NetObj):
             ]
         }
 
+    @classmethod
+    def construct_from_spawn_data(cls, game_state, netobj_type, net_id, pkt):
+        game_data = super().construct_from_spawn_data(
+            game_state, netobj_type, net_id, pkt
+        )
+        game_state.rosters.replace_players(game_data.players)
+        return game_data
+
     def handle_PLAYER_INFO(self, pkt):
         player_infos_by_id = {}
         for player in self.players:
@@ -510,14 +816,17 @@ class NetObjGameData(NetObj):
                 p = NetObjGameDataPlayer(player_id=pipkt.tag)
                 player_infos_by_id[p.player_id] = p
                 self.players.append(p)
+            self.game_state.mark_changed(self.net_id, pipkt.tag)
             player_infos_by_id[pipkt.tag].update_from_player_info(
                 pipkt[amongus.player_info.PlayerInfo]
             )
+            self.game_state.rosters.update_player(player_infos_by_id[pipkt.tag])
 
     def handle_SET_TASKS(self, pkt):
         for p in self.players:
             if p.player_id != pkt.player_id:
                 continue
+            self.game_state.mark_changed(self.net_id, p.player_id)
             if len(p.tasks) != len(pkt.task_types):
                 p.tasks = [
                     NetObjGameDataPlayerTask(
@@ -553,86 +862,133 @@ class NetObjPlayerControl(NetObj):
     def player(self):
         return self._get_game_data_player()
 
-    def _get_game_data_player(self, player_id=None):
+    def _get_game_data_player(self, player_id=None, changing=False):
         if player_id is None:
             player_id = self.player_id
-        return self.game_state.get_game_data_player(player_id=player_id)
+        return self.game_state.get_game_data_player(
+            player_id=player_id, changing=changing
+        )
 
     def handle_SET_PET(self, pkt):
-        self.player.pet_id = pkt.pet
+        self._get_game_data_player(changing=True).pet_id = pkt.pet
 
     def handle_SET_HAT(self, pkt):
-        self.player.hat_id = pkt.hat
+        self._get_game_data_player(changing=True).hat_id = pkt.hat
 
     def handle_SET_SKIN(self, pkt):
-        self.player.skin_id = pkt.skin
+        self._get_game_data_player(changing=True).skin_id = pkt.skin
 
     def handle_SET_NAME(self, pkt):
-        self.player.name = pkt.name
+        player = self._get_game_data_player(changing=True)
+        player.name = pkt.player_name.decode("utf8")
+        self.game_state.rosters.update_player(player)
 
     def handle_SET_COLOR(self, pkt):
-        self.player.color_id = pkt.color
+        self._get_game_data_player(changing=True).color_id = pkt.color
 
     def handle_COMPLETE_TASK(self, pkt):
-        for task in self._get_game_data_player().tasks:
+        for task in self._get_game_data_player(changing=True).tasks:
             if pkt.task_id == task.task_id:
                 task.task_done = True
                 break
         else:
             # TODO(lukegb): Raise exception?
             pass
+        if self.game_state.emitting:
+            self.game_state.emit(
+                amongus.events.TaskCompleted,
+                player_id=self.player_id,
+                player=self.player.name,
+                task_id=pkt.task_id,
+            )
 
     def handle_PLAY_ANIMATION(self, pkt):
         pass
 
     def handle_ADD_CHAT(self, pkt):
-        note = "CHAT: {}".format(self.player.name)
-        if self.player.is_dead:
-            note += " (dead)"
-        print("{}: {}".format(note, pkt.msg.decode("utf8")))
+        if not self.game_state.emitting:
+            return
+        player = self.player
+        self.game_state.emit(
+            amongus.events.Chat,
+            player_id=self.player_id,
+            player=player.name,
+            is_dead=bool(player.is_dead),
+            message=pkt.msg.decode("utf8"),
+        )
 
     def handle_ADD_CHAT_NOTE(self, pkt):
-        if pkt.note_id == 0x00:
-            print("{} voted!".format(self._get_game_data_player(pkt.src_player).name))
+        if pkt.note_id != 0x00 or not self.game_state.emitting:
+            return
+        self.game_state.emit(
+            amongus.events.VoteNoted,
+            voter_id=pkt.src_player,
+            voter=self._get_game_data_player(pkt.src_player).name,
+        )
 
     def handle_MURDER_PLAYER(self, pkt):
         them_netobj = self.game_state.net_obj_map.get(pkt.payload.net_id, None)
         if not them_netobj:
-            print("couldn't find them in MURDER_PLAYER handler")
+            self.game_state.anomalies.note(
+                amongus.anomalies.MURDER_UNKNOWN_NET_ID,
+                None,
+                amongus.enums.AmongUsRPCType.MURDER_PLAYER,
+                "MURDER_PLAYER of net_id=%d that I didn't see spawn",
+                pkt.payload.net_id,
+            )
             return
-        them = them_netobj.player
+        them = them_netobj._get_game_data_player(changing=True)
         them.is_dead = True
-        print("{} murdered {}".format(self.player.name, them.name))
+        self.game_state.rosters.update_player(them)
+        if self.game_state.emitting:
+            self.game_state.emit(
+                amongus.events.Murder,
+                murderer_id=self.player_id,
+                murderer=self.player.name,
+                victim_id=them.player_id,
+                victim=them.name,
+            )
 
     def handle_GAME_COUNTDOWN(self, pkt):
-        if pkt.countdown == 0xFF:
-            print("Game start cancelled.")
-            return
-        print("Game start in {}...".format(pkt.countdown))
+        if self.game_state.emitting:
+            self.game_state.emit(
+                amongus.events.Countdown,
+                seconds=None if pkt.countdown == 0xFF else pkt.countdown,
+            )
 
     def handle_SET_INFECTED(self, pkt):
         pass  # We get this data via player info anyway.
 
-    def handle_REPORT_DEAD_BODY(self, pkt):
-        me_name = self.player.name
-        if pkt.who == 0xFF:
-            print("{} pressed the emergency button (REPORT_DEAD_BODY)!".format(me_name))
+    def _emit_meeting(self, event_cls, pkt):
+        if not self.game_state.emitting:
             return
-        who = self._get_game_data_player(pkt.who)
-        print("{} reported {}'s death (REPORT_DEAD_BODY)!".format(me_name, who.name))
+        body_id = body_name = None
+        if pkt.who != 0xFF:
+            body_id = pkt.who
+            body_name = self._get_game_data_player(body_id).name
+        self.game_state.emit(
+            event_cls,
+            caller_id=self.player_id,
+            caller=self.player.name,
+            body_id=body_id,
+            body=body_name,
+        )
+
+    def handle_REPORT_DEAD_BODY(self, pkt):
+        self._emit_meeting(amongus.events.MeetingRequested, pkt)
 
     def handle_START_MEETING(self, pkt):
-        me_name = self.player.name
-        if pkt.who == 0xFF:
-            print("{} pressed the emergency button!".format(me_name))
-            return
-        who = self._get_game_data_player(pkt.who)
-        print("{} reported {}'s death!".format(me_name, who.name))
+        self._emit_meeting(amongus.events.MeetingStarted, pkt)
 
     def handle_SET_SCANNER(self, pkt):
-        print(
-            "SET_SCANNER: id={} on={} (by {})".format(pkt.id, pkt.on, self.player.name)
-        )
+        if self.game_state.emitting:
+            self.game_state.emit(
+                amongus.events.Scanner,
+                player_id=self.player_id,
+                player=self.player.name,
+                scanner_id=pkt.id,
+                on=bool(pkt.on),
+            )
 
     def handle_GAME_OPTIONS(self, pkt):
         self.game_state.game_options = NetObjGameOptions.construct_from_spawn_data(pkt)
@@ -658,17 +1014,25 @@ class NetObjPlayerPhysics(NetObj):
             )
         return player_control._get_game_data_player()
 
+    def _emit_vent(self, pkt):
+        if not self.game_state.emitting:
+            return
+        player = self._get_game_data_player()
+        self.game_state.emit(
+            amongus.events.Vent,
+            player_id=player.player_id,
+            player=player.name,
+            vent_id=pkt.vent_id,
+            entered=self.in_vent,
+        )
+
     def handle_ENTER_VENT(self, pkt):
         self.in_vent = True
-        print(
-            "{} entered vent {}".format(self._get_game_data_player().name, pkt.vent_id)
-        )
+        self._emit_vent(pkt)
 
     def handle_EXIT_VENT(self, pkt):
         self.in_vent = False
-        print(
-            "{} exited vent {}".format(self._get_game_data_player().name, pkt.vent_id)
-        )
+        self._emit_vent(pkt)
 
 
 @_register_net_obj_dataclass(
@@ -732,6 +1096,8 @@ def asdict(obj):
             if f.name == "game_state" and isinstance(obj, NetObj):
                 # Avoid using the backreference.
                 continue
+            if not f.metadata.get("serialize", True):
+                continue
             result.append((f.name, asdict(getattr(obj, f.name))))
         for fname in getattr(obj, "extra_serializable_attributes", []):
             result.append((fname, asdict(getattr(obj, fname))))
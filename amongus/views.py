@@ -0,0 +1,111 @@
+# SPDX-FileCopyrightText: 2020 Luke Granger-Brown
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import dataclasses
+from typing import Any, Dict, List
+
+import amongus.state_tracker
+
+TOPICS = ("roster", "positions", "meetings", "events")
+
+# Topics which are derived from the state; "events" are derived from changes.
+STATE_TOPICS = ("roster", "positions", "meetings")
+
+
+@dataclasses.dataclass(frozen=True)
+class TopicView:
+    header: Dict[str, Any]
+    players: Dict[int, Any]
+
+    def for_player(self, player_id):
+        return dict(self.header, player=self.players.get(player_id, None))
+
+    def asdict(self):
+        return dict(self.header, players=self.players)
+
+
+def roster_view(state):
+    players = {}
+    game_data = state.find_netobj_of_type(amongus.state_tracker.NetObjGameData)
+    if game_data:
+        for p in game_data.players:
+            players[p.player_id] = amongus.state_tracker.asdict(p)
+    return TopicView(
+        header={"round_state": state.round_state.name, "scene": state.scene},
+        players=players,
+    )
+
+
+def positions_view(state):
+    players = {}
+    for net_id, obj in state.net_obj_map.items():
+        if obj.netobj_dead or not isinstance(
+            obj, amongus.state_tracker.NetObjPlayerControl
+        ):
+            continue
+        # PlayerControl, PlayerPhysics and CustomNetworkTransform are spawned together.
+        physics = state.net_obj_map.get(net_id + 1, None)
+        transform = state.net_obj_map.get(net_id + 2, None)
+        if not isinstance(
+            transform, amongus.state_tracker.NetObjCustomNetworkTransform
+        ):
+            continue
+        players[obj.player_id] = {
+            "pos": transform.pos,
+            "vel": transform.vel,
+            "in_vent": isinstance(physics, amongus.state_tracker.NetObjPlayerPhysics)
+            and physics.in_vent,
+        }
+    return TopicView(header={}, players=players)
+
+
+def meetings_view(state):
+    meeting_hud = state.find_netobj_of_type(amongus.state_tracker.NetObjMeetingHud)
+    if not meeting_hud:
+        return TopicView(header={"active": False}, players={})
+    # Votes are indexed by player_id.
+    return TopicView(
+        header={"active": True},
+        players={
+            n: amongus.state_tracker.asdict(vote)
+            for n, vote in enumerate(meeting_hud.votes)
+        },
+    )
+
+
+def game_views(state) -> Dict[str, TopicView]:
+    return {
+        "roster": roster_view(state),
+        "positions": positions_view(state),
+        "meetings": meetings_view(state),
+    }
+
+
+def roster_events(old, new) -> List[Dict[str, Any]]:
+    # Each event lists the player_ids it concerns, for routing to per-player subscribers.
+    events = []
+    if old.header["round_state"] != new.header["round_state"]:
+        events.append(
+            {
+                "type": "round_state",
+                "round_state": new.header["round_state"],
+                "player_ids": [],
+            }
+        )
+    for player_id, player in new.players.items():
+        old_player = old.players.get(player_id, None)
+        if old_player is None:
+            events.append(
+                {"type": "joined", "name": player["name"], "player_ids": [player_id]}
+            )
+        elif player["is_dead"] and not old_player["is_dead"]:
+            events.append(
+                {"type": "died", "name": player["name"], "player_ids": [player_id]}
+            )
+    for player_id, player in old.players.items():
+        if player_id not in new.players:
+            events.append(
+                {"type": "left", "name": player["name"], "player_ids": [player_id]}
+            )
+    return events
@@ -0,0 +1,113 @@
+# SPDX-FileCopyrightText: 2020 Luke Granger-Brown
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import dataclasses
+import logging
+from typing import Dict, FrozenSet, Optional, Tuple
+
+import amongus.planner
+import amongus.rpcs
+import amongus.runtime
+import amongus.state_tracker
+
+logger = logging.getLogger(__name__)
+
+RoundState = amongus.state_tracker.RoundState
+
+
+@dataclasses.dataclass(frozen=True, eq=True)
+class VoiceState:
+    round_state: RoundState = RoundState.LOBBY
+    alive_players: FrozenSet[str] = dataclasses.field(default_factory=frozenset)
+    dead_players: FrozenSet[str] = dataclasses.field(default_factory=frozenset)
+
+
+# A state expected at a time.monotonic(), or (None, None).
+Staged = Tuple[Optional[VoiceState], Optional[float]]
+NOTHING_STAGED: Staged = (None, None)
+
+
+class VoiceTracker:
+    # Derives what the voice bots sync each game to. Deaths only become
+    # visible when nobody can talk about them any more: at meetings, in the
+    # lobby and once voting completes. Alongside, the state to stage ahead of
+    # the transitions the planner predicts.
+
+    def __init__(self):
+        self.states: Dict[int, VoiceState] = {}
+        self.roster_versions: Dict[int, int] = {}
+        self.planners: Dict[int, amongus.planner.TransitionPlanner] = {}
+        self.staged: Dict[int, Staged] = {}
+
+    def process_packet(self, pkt, game_id, state):
+        # Returns (game_id, VoiceState, Staged) if either changed.
+        if game_id is None:
+            return None
+        voice_state = self.states.get(game_id, VoiceState())
+        round_state = state.round_state
+        changes = {"round_state": round_state}
+        if (
+            round_state == RoundState.LOBBY
+            or round_state == RoundState.MEETING
+            or amongus.rpcs.VotingCompleteRPC in pkt
+            or amongus.rpcs.SetInfectedRPC in pkt
+        ):
+            # Update dead/alive players.
+            rosters = state.rosters
+            if rosters.version != self.roster_versions.get(game_id, None):
+                self.roster_versions[game_id] = rosters.version
+                changes.update(alive_players=rosters.alive, dead_players=rosters.dead)
+        new_voice_state = dataclasses.replace(voice_state, **changes)
+        changed = new_voice_state != voice_state
+        if changed:
+            logger.info("New state for game %d: %s", game_id, str(new_voice_state))
+            self.states[game_id] = new_voice_state
+
+        planner = self.planners.get(game_id, None)
+        if planner is None:
+            planner = self.planners[game_id] = amongus.planner.TransitionPlanner()
+        transition = planner.process_packet(state, pkt)
+        staged = NOTHING_STAGED
+        if transition:
+            staged = (
+                dataclasses.replace(
+                    new_voice_state, round_state=transition.round_state
+                ),
+                transition.at,
+            )
+        if staged != self.staged.get(game_id, NOTHING_STAGED):
+            self.staged[game_id] = staged
+            changed = True
+        if not changed:
+            return None
+        return (game_id, new_voice_state, staged)
+
+
+class VoiceSink(amongus.runtime.LoopSink):
+    # Hands a bot (publish and stage on its event loop) the VoiceTracker's
+    # states. Each item carries the game's latest of both, so any can be
+    # dropped, and only what changed since the last applied is passed on.
+
+    def __init__(self, loop, publish, stage, name="voice"):
+        super().__init__(loop)
+        self.name = name
+        self.publish = publish
+        self.stage = stage
+        self.tracker = VoiceTracker()
+        # As last applied on the event loop.
+        self.applied: Dict[int, Tuple[VoiceState, Staged]] = {}
+
+    def derive(self, pkt, game_id, game_state):
+        return self.tracker.process_packet(pkt, game_id, game_state)
+
+    def apply(self, item):
+        game_id, voice_state, staged = item
+        old_state, old_staged = self.applied.get(
+            game_id, (VoiceState(), NOTHING_STAGED)
+        )
+        self.applied[game_id] = (voice_state, staged)
+        if voice_state != old_state:
+            self.publish(game_id, voice_state)
+        if staged != old_staged:
+            self.stage(game_id, *staged)
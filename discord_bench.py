@@ -0,0 +1,415 @@
+# SPDX-FileCopyrightText: 2020 Luke Granger-Brown
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+import dataclasses
+import json
+import tempfile
+import time
+from typing import Dict, List, Optional, Set
+
+from absl import app
+from absl import flags
+import discord
+import scapy.all
+
+import amongus.identity
+import amongus.state_tracker
+import amongus.voice
+import discord_bot
+import discord_mock
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer("bench_players", 10, "Number of players in the benchmark game.")
+flags.DEFINE_integer("bench_dead", 3, "Number of players who die during the game.")
+flags.DEFINE_string(
+    "bench_pcap",
+    None,
+    "Recorded game to replay through a DiscordBot connected to the mock, as a "
+    "pcap file. Without it, a scripted game is run through the scheduler alone, "
+    "with and without concurrency.",
+)
+flags.DEFINE_float(
+    "bench_speed",
+    1.0,
+    "Speed to replay --bench_pcap at, relative to how it was recorded; 0 replays "
+    "it as fast as the bot keeps up, which bunches up rate limited calls.",
+)
+
+GUILD_ID = 1
+MAIN_CHANNEL_ID = 10
+DEAD_CHANNEL_ID = 11
+ALIVE_ROLE_ID = 20
+DEAD_ROLE_ID = 21
+
+RoundState = amongus.state_tracker.RoundState
+
+
+class Recorder:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.last_done = 0.0
+        self.last_noticeable = 0.0
+
+    def done(self, noticeable):
+        elapsed = time.monotonic() - self.start
+        self.last_done = max(self.last_done, elapsed)
+        if noticeable:
+            self.last_noticeable = max(self.last_noticeable, elapsed)
+
+
+# Stand-ins for the discord.py models the bot touches, backed by a real
+# HTTPClient so requests go through discord.py's own rate limit handling.
+
+
+@dataclasses.dataclass(eq=False)
+class FakeRole:
+    guild: "FakeGuild"
+    id: int
+    name: str
+
+    @property
+    def members(self):
+        return [m for m in self.guild.members if self in m.roles]
+
+    def __str__(self):
+        return self.name
+
+
+@dataclasses.dataclass(eq=False)
+class FakeChannel:
+    guild: "FakeGuild"
+    id: int
+    name: str
+    overwrites: Dict[FakeRole, discord.PermissionOverwrite] = dataclasses.field(
+        default_factory=dict
+    )
+
+    @property
+    def members(self):
+        return [m for m in self.guild.members if m.voice_channel is self]
+
+    async def set_permissions(self, target, **permissions):
+        overwrite = discord.PermissionOverwrite(**permissions)
+        allow, deny = overwrite.pair()
+        await self.guild.http.edit_channel_permissions(
+            self.id, target.id, allow.value, deny.value, "role"
+        )
+        self.overwrites[target] = overwrite
+        self.guild.recorder.done(permissions.get("speak", False))
+
+    def __str__(self):
+        return self.name
+
+
+@dataclasses.dataclass(eq=False)
+class FakeMember:
+    guild: "FakeGuild"
+    id: int
+    name: str
+    roles: Set[FakeRole] = dataclasses.field(default_factory=set)
+    voice_channel: Optional[FakeChannel] = None
+
+    async def add_roles(self, role):
+        await self.guild.http.add_role(self.guild.id, self.id, role.id)
+        self.roles.add(role)
+        self.guild.recorder.done(False)
+
+    async def remove_roles(self, role):
+        await self.guild.http.remove_role(self.guild.id, self.id, role.id)
+        self.roles.discard(role)
+        self.guild.recorder.done(role.id == DEAD_ROLE_ID)
+
+    async def move_to(self, channel):
+        await self.guild.http.move_member(self.id, self.guild.id, channel.id)
+        self.voice_channel = channel
+        self.guild.recorder.done(channel.id == MAIN_CHANNEL_ID)
+
+    def __str__(self):
+        return self.name
+
+
+@dataclasses.dataclass(eq=False)
+class FakeGuild:
+    http: discord.http.HTTPClient
+    id: int = GUILD_ID
+    members: List[FakeMember] = dataclasses.field(default_factory=list)
+    channels: List[FakeChannel] = dataclasses.field(default_factory=list)
+    roles: List[FakeRole] = dataclasses.field(default_factory=list)
+    recorder: Recorder = dataclasses.field(default_factory=Recorder)
+
+    @staticmethod
+    def _find(items, item_id):
+        for item in items:
+            if item.id == item_id:
+                return item
+        return None
+
+    def get_member(self, member_id):
+        return self._find(self.members, member_id)
+
+    def get_channel(self, channel_id):
+        return self._find(self.channels, channel_id)
+
+    def get_role(self, role_id):
+        return self._find(self.roles, role_id)
+
+
+class SequentialScheduler:
+    # What the bot did before it had a scheduler: one call at a time, in the
+    # order they were generated.
+
+    async def run(self, actions):
+        for action in actions:
+            await action.run()
+
+
+def _scenario(names, dead):
+    alive = frozenset(names) - dead
+    everyone = frozenset(names)
+    return [
+        ("game start", discord_bot.GameState(RoundState.ACTIVE, everyone)),
+        ("deaths", discord_bot.GameState(RoundState.ACTIVE, alive, dead)),
+        ("meeting", discord_bot.GameState(RoundState.MEETING, alive, dead)),
+        ("meeting over", discord_bot.GameState(RoundState.ACTIVE, alive, dead)),
+        ("back to lobby", discord_bot.GameState(RoundState.LOBBY, everyone)),
+    ]
+
+
+async def _run_mode(mode, mock, base_url, identities):
+    discord.http.Route.BASE = base_url
+    mock.reset_log()
+    http = discord.http.HTTPClient(loop=asyncio.get_event_loop())
+    await http.static_login("bench", bot=True)
+    if mode == "sequential":
+        scheduler = SequentialScheduler()
+    else:
+        scheduler = discord_bot.ActionScheduler(
+            discord_bot._parse_route_budgets(FLAGS.route_budgets),
+            FLAGS.max_concurrent_actions,
+        )
+    route = discord_bot.RouteSync(
+        discord_bot.Route(
+            GUILD_ID, MAIN_CHANNEL_ID, DEAD_CHANNEL_ID, ALIVE_ROLE_ID, DEAD_ROLE_ID
+        ),
+        identities,
+        scheduler,
+    )
+
+    guild = FakeGuild(http)
+    main_channel = FakeChannel(guild, MAIN_CHANNEL_ID, "main")
+    guild.channels = [main_channel, FakeChannel(guild, DEAD_CHANNEL_ID, "dead")]
+    guild.roles = [
+        FakeRole(guild, ALIVE_ROLE_ID, "alive"),
+        FakeRole(guild, DEAD_ROLE_ID, "dead"),
+    ]
+    names = ["player{}".format(n) for n in range(FLAGS.bench_players)]
+    for n, name in enumerate(names):
+        guild.members.append(
+            FakeMember(guild, 1000 + n, name, voice_channel=main_channel)
+        )
+    route.attach(guild)
+
+    try:
+        for step, state in _scenario(names, frozenset(names[: FLAGS.bench_dead])):
+            calls_before = len(mock.calls)
+            guild.recorder = Recorder()
+            route.state = state
+            await route.sync()
+            calls = mock.calls[calls_before:]
+            print(
+                "{:<12} {:<14} converged {:6.2f}s  noticeable {:6.2f}s  "
+                "calls {:3d}  429s {:3d}".format(
+                    mode,
+                    step,
+                    guild.recorder.last_done,
+                    guild.recorder.last_noticeable,
+                    len(calls),
+                    sum(1 for c in calls if c.status == 429),
+                )
+            )
+    finally:
+        await http.close()
+
+
+async def bench(identities):
+    mock = discord_mock.MockDiscord(
+        FLAGS.mock_latency, discord_mock.parse_route_limits(FLAGS.mock_route_limits)
+    )
+    runner = await discord_mock.start(mock, FLAGS.mock_host, 0)
+    host, port = runner.addresses[0][:2]
+    try:
+        for mode in ("sequential", "scheduled"):
+            # Fresh rate limit windows for each mode.
+            mock.buckets.clear()
+            await _run_mode(
+                mode,
+                mock,
+                "http://{}:{}{}".format(host, port, discord_mock.API_PREFIX),
+                identities,
+            )
+    finally:
+        await runner.cleanup()
+
+
+def _player_names(packets):
+    states = amongus.state_tracker.GameStates()
+    names = set()
+    for pkt in packets:
+        game_id = states.process_packet(pkt)
+        if game_id is None:
+            continue
+        rosters = states.games[game_id].rosters
+        names |= rosters.alive | rosters.dead
+    return sorted(names)
+
+
+async def _idle(route, syncing):
+    while route.wake.is_set() or syncing:
+        await asyncio.sleep(0.005)
+
+
+async def replay(packets, names, identities):
+    mock = discord_mock.MockDiscord(
+        FLAGS.mock_latency,
+        discord_mock.parse_route_limits(FLAGS.mock_route_limits),
+        FLAGS.mock_gateway_latency,
+    )
+    mock.add_guild(GUILD_ID, "bench")
+    mock.add_role(GUILD_ID, ALIVE_ROLE_ID, "alive")
+    mock.add_role(GUILD_ID, DEAD_ROLE_ID, "dead")
+    mock.add_voice_channel(GUILD_ID, MAIN_CHANNEL_ID, "main")
+    mock.add_voice_channel(GUILD_ID, DEAD_CHANNEL_ID, "dead")
+    for n, name in enumerate(names):
+        mock.add_member(GUILD_ID, 1000 + n, name, MAIN_CHANNEL_ID)
+    runner = await discord_mock.start(mock, FLAGS.mock_host, 0)
+    host, port = runner.addresses[0][:2]
+    discord.http.Route.BASE = "http://{}:{}{}".format(
+        host, port, discord_mock.API_PREFIX
+    )
+
+    intents = discord.Intents.default()
+    intents.members = True
+    bot = discord_bot.DiscordBot(
+        [
+            discord_bot.Route(
+                GUILD_ID, MAIN_CHANNEL_ID, DEAD_CHANNEL_ID, ALIVE_ROLE_ID, DEAD_ROLE_ID
+            )
+        ],
+        identities,
+        loop=asyncio.get_event_loop(),
+        intents=intents,
+    )
+    route = bot.routes[None]
+    # Syncs in progress, so a transition is only over once they're done.
+    syncing = set()
+    route_sync = route.sync
+
+    async def sync():
+        task = asyncio.current_task()
+        syncing.add(task)
+        try:
+            await route_sync()
+        finally:
+            syncing.discard(task)
+
+    route.sync = sync
+
+    await bot.login("bench")
+    connection = asyncio.ensure_future(bot.connect(reconnect=False))
+    results = []
+    try:
+        await bot.wait_until_ready()
+        await _idle(route, syncing)
+
+        published = []
+
+        def publish(game_id, state):
+            published.append(state)
+            bot.update(game_id, state)
+
+        states = amongus.state_tracker.GameStates()
+        sink = amongus.voice.VoiceSink(asyncio.get_event_loop(), publish, bot.stage)
+        replay_start = time.monotonic()
+        for pkt in packets:
+            if FLAGS.bench_speed:
+                due = (float(pkt.time) - float(packets[0].time)) / FLAGS.bench_speed
+                delay = due - (time.monotonic() - replay_start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            before = len(published)
+            calls_before = len(mock.calls)
+            start = time.monotonic()
+            game_id = states.process_packet(pkt)
+            item = sink.derive(pkt, game_id, states.games.get(game_id, None))
+            if item is not None:
+                sink.apply(item)
+            if len(published) == before:
+                continue
+            await asyncio.sleep(0)
+            await _idle(route, syncing)
+            calls = mock.calls[calls_before:]
+            converged = (
+                max((c.at for c in calls if c.status != 429), default=start) - start
+            )
+            results.append((published[-1], converged, calls))
+    finally:
+        await bot.close()
+        connection.cancel()
+        await runner.cleanup()
+
+    for n, (state, converged, calls) in enumerate(results):
+        print(
+            "{:3d} {:<9} alive {:2d} dead {:2d}  converged {:7.1f}ms  "
+            "calls {:3d}  429s {:3d}".format(
+                n,
+                state.round_state.value,
+                len(state.alive_players),
+                len(state.dead_players),
+                converged * 1000,
+                len(calls),
+                sum(1 for c in calls if c.status == 429),
+            )
+        )
+    if results:
+        times = sorted(converged for _, converged, _ in results)
+        all_calls = [c for _, _, calls in results for c in calls]
+        print(
+            "{} transitions  median {:.1f}ms  max {:.1f}ms  calls {}  "
+            "429 rate {:.1%}".format(
+                len(results),
+                times[len(times) // 2] * 1000,
+                times[-1] * 1000,
+                len(all_calls),
+                sum(1 for c in all_calls if c.status == 429) / max(len(all_calls), 1),
+            )
+        )
+
+
+def main(argv):
+    if len(argv) != 1:
+        raise app.UsageError("Too many arguments.")
+
+    if FLAGS.bench_pcap:
+        packets = scapy.all.rdpcap(FLAGS.bench_pcap)
+        names = _player_names(packets)
+    else:
+        packets = None
+        names = ["player{}".format(n) for n in range(FLAGS.bench_players)]
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+        json.dump(
+            [{"names": [name], "discord": [1000 + n]} for n, name in enumerate(names)],
+            f,
+        )
+        f.flush()
+        identities = amongus.identity.IdentityService(f.name)
+    loop = asyncio.get_event_loop()
+    if packets is None:
+        loop.run_until_complete(bench(identities))
+    else:
+        loop.run_until_complete(replay(packets, names, identities))
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -3,20 +3,24 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import asyncio
-import concurrent
 import dataclasses
-import threading
+import enum
+import functools
+import json
 import time
-from typing import FrozenSet, List
+from typing import (Any, Awaitable, Callable, Dict, FrozenSet, List, Optional,
+                    Set, Tuple)
 
 from absl import app
 from absl import flags
 from absl import logging
 import discord
-import scapy.all
 
-import amongus.rpcs
+import amongus.feed
+import amongus.identity
+import amongus.runtime
 import amongus.state_tracker
+import amongus.voice
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string(
@@ -35,59 +39,43 @@ flags.DEFINE_integer(
 )
 flags.DEFINE_integer("alive_role", 759143620569333840, "Role ID to add alive people to")
 flags.DEFINE_integer("dead_role", 759143500464783420, "Role ID to add dead people to")
-
-
-def _coerce_list(thing):
-    if isinstance(thing, (list, tuple)):
-        return list(thing)
-    else:
-        return [thing]
-
-
-class UsernameDatabase:
-    def __init__(self, data):
-        self.usernames_to_discord_ids = {}
-        self.discord_ids_to_usernames = {}
-        for usernames, client_ids in data:
-            usernames = _coerce_list(usernames)
-            client_ids = _coerce_list(client_ids)
-            for username in usernames:
-                self.usernames_to_discord_ids[username] = client_ids
-            for client_id in client_ids:
-                self.discord_ids_to_usernames[client_id] = usernames
-
-    def usernames_from_discord_ids(self, discord_ids):
-        return self.discord_ids_to_usernames.get(discord_ids, [])
-
-    def discord_idss_from_username(self, username):
-        return self.usernames_to_discord_ids.get(username, [])
-
-
-USERNAME_DB = UsernameDatabase(
-    [
-        ("Memories", 266212268147081216),
-        (("Zenras", "Giblets", "Stelbig"), 233707984033677313),
-        ("Mumfrey", 235556733639065600),
-        ("Raisin", 143158010498252810),
-        ("th0rney", 236916600433934337),
-        ("HDWolfGamer", 161584244479623168),
-        ("lukegb", 102909905052114944),
-        ("felltir", 212206922978295808),
-        ("NSE", 359435848707604500),
-        ("Rosalyan", 226761069576716288),
-        ("BrackishBrit", 276851033005752320),
-        ("sirrambod", 695013418456973386),
-    ]
+flags.DEFINE_string(
+    "routes_file",
+    None,
+    "JSON list of routes, each mapping a game_id to a guild and its channels and "
+    "roles; fields left out default to the flags above. Without it, one route "
+    "built from the flags follows every game.",
+)
+flags.DEFINE_string(
+    "follow_feed",
+    None,
+    "Unix socket of a tracker's feed sink to follow, instead of capturing "
+    "packets itself.",
+)
+flags.DEFINE_string(
+    "identity_file",
+    "identities.json",
+    "JSON file mapping in-game names to Discord accounts; reloaded on change.",
+)
+flags.DEFINE_integer(
+    "max_concurrent_actions",
+    8,
+    "Maximum Discord API calls each route has in flight at once.",
 )
+flags.DEFINE_list(
+    "route_budgets",
+    [],
+    "Client-side rate limit budgets per route, as route=requests/seconds (e.g. "
+    "member_roles=10/10), for leaving headroom when the bot token is shared. "
+    "discord.py already waits out the limits Discord reports.",
+)
+
+# How long before a staged state is due to recompute its actions, to pick up
+# anything that has changed since it was staged.
+PREPARE_LEAD_SECONDS = 2.0
 
 
-@dataclasses.dataclass(frozen=True, eq=True)
-class GameState:
-    round_state: amongus.state_tracker.RoundState = (
-        amongus.state_tracker.RoundState.LOBBY
-    )
-    alive_players: FrozenSet[str] = dataclasses.field(default_factory=frozenset)
-    dead_players: FrozenSet[str] = dataclasses.field(default_factory=frozenset)
+GameState = amongus.voice.VoiceState
 
 
 @dataclasses.dataclass(frozen=True)
@@ -99,197 +87,531 @@ class DiscordUser:
     roles: List[int]
 
 
-class DiscordBot(discord.Client):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._game_state = GameState()
-        self._ready = False
-        self._guild = None
-        self._dead_channel = None
-        self._main_channel = None
-        self._dead_role = None
-        self._alive_role = None
+class ActionPriority(enum.IntEnum):
+    # Lower runs first: being unmuted or pulled out of the dead channel is what
+    # players notice.
+    NOTICEABLE = 0
+    NORMAL = 1
+
+
+@dataclasses.dataclass(order=True)
+class DiscordAction:
+    priority: ActionPriority
+    # (route, major parameter) - actions on the same route share a rate limit.
+    route: Tuple[str, int] = dataclasses.field(compare=False)
+    description: str = dataclasses.field(compare=False)
+    run: Callable[[], Awaitable[Any]] = dataclasses.field(compare=False)
+
+
+def _parse_route_budgets(specs):
+    budgets = {}
+    for spec in specs:
+        route, _, budget = spec.partition("=")
+        limit, _, period = budget.partition("/")
+        budgets[route] = (int(limit), float(period))
+    return budgets
+
+
+class RouteBudget:
+    # Token bucket, where reserving a token that isn't there yet returns how
+    # long to wait for it.
+
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.rate = limit / period
+        self.tokens = float(limit)
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        now = time.monotonic()
+        self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class ActionScheduler:
+    def __init__(self, budgets, max_concurrency):
+        self._limits = budgets
+        self._budgets = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def _budget(self, route):
+        budget = self._budgets.get(route, None)
+        if budget is None and route[0] in self._limits:
+            budget = self._budgets[route] = RouteBudget(*self._limits[route[0]])
+        return budget
+
+    async def _run_action(self, action, delay):
+        if delay:
+            await asyncio.sleep(delay)
+        async with self._semaphore:
+            logging.info("%s", action.description)
+            try:
+                await action.run()
+            except discord.HTTPException:
+                logging.exception("Failed: %s", action.description)
+
+    async def run(self, actions):
+        # Budget is reserved in priority order, so within a route the actions
+        # players notice go first; independent routes proceed concurrently.
+        tasks = []
+        for action in sorted(actions):
+            budget = self._budget(action.route)
+            delay = budget.reserve() if budget else 0.0
+            tasks.append(asyncio.ensure_future(self._run_action(action, delay)))
+        if tasks:
+            await asyncio.gather(*tasks)
+
+
+@dataclasses.dataclass
+class ObservedGuild:
+    # What the bot believes its roles and channels currently look like, kept
+    # up to date from gateway events and from its own successful calls, so
+    # that sync() only has to diff it against the desired state.
+    role_members: Dict[int, Set[int]]
+    # (channel_id, role_id) -> (connect, speak) overwrite.
+    overwrites: Dict[Tuple[int, int], Tuple[Optional[bool], Optional[bool]]]
+    # member_id -> channel_id, for members in one of the watched channels.
+    voice_channels: Dict[int, int]
+    channel_ids: FrozenSet[int]
+    # Bumped whenever anything above actually changes, so actions computed
+    # earlier can be checked for still being current.
+    version: int = 0
 
     @classmethod
-    def _lowercase_names(cls, names):
-        return (n.lower() for n in names)
+    def load(cls, channels, roles):
+        observed = cls(
+            role_members={role.id: {m.id for m in role.members} for role in roles},
+            overwrites={},
+            voice_channels={},
+            channel_ids=frozenset(channel.id for channel in channels),
+        )
+        for channel in channels:
+            observed.channel_updated(channel)
+            for member in channel.members:
+                observed.voice_channels[member.id] = channel.id
+        return observed
+
+    def role_changed(self, role_id, member_id, present):
+        members = self.role_members[role_id]
+        if (member_id in members) == present:
+            return
+        if present:
+            members.add(member_id)
+        else:
+            members.discard(member_id)
+        self.version += 1
+
+    def moved(self, member_id, channel_id):
+        if channel_id not in self.channel_ids:
+            channel_id = None
+        if self.voice_channels.get(member_id, None) == channel_id:
+            return
+        if channel_id is None:
+            del self.voice_channels[member_id]
+        else:
+            self.voice_channels[member_id] = channel_id
+        self.version += 1
+
+    def overwrite_set(self, channel_id, role_id, overwrite):
+        if self.overwrites.get((channel_id, role_id), None) == overwrite:
+            return
+        self.overwrites[(channel_id, role_id)] = overwrite
+        self.version += 1
+
+    def member_updated(self, member):
+        role_ids = {role.id for role in member.roles}
+        for role_id in self.role_members:
+            self.role_changed(role_id, member.id, role_id in role_ids)
+
+    def voice_state_updated(self, member, voice_state):
+        channel = voice_state.channel
+        self.moved(member.id, channel.id if channel else None)
+
+    def channel_updated(self, channel):
+        if channel.id not in self.channel_ids:
+            return
+        overwrites = {role_id: (None, None) for role_id in self.role_members}
+        for target, overwrite in channel.overwrites.items():
+            if target.id in self.role_members:
+                overwrites[target.id] = (overwrite.connect, overwrite.speak)
+        for role_id, overwrite in overwrites.items():
+            self.overwrite_set(channel.id, role_id, overwrite)
+
+
+@dataclasses.dataclass(frozen=True)
+class Route:
+    # Where one game's players are managed. A game_id of None takes every
+    # game that has no route of its own.
+    guild_id: int
+    main_channel_id: int
+    dead_channel_id: int
+    alive_role: int
+    dead_role: int
+    game_id: Optional[int] = None
+
+    @classmethod
+    def from_flags(cls, **overrides):
+        fields = dict(
+            guild_id=FLAGS.guild_id,
+            main_channel_id=FLAGS.main_channel_id,
+            dead_channel_id=FLAGS.dead_channel_id,
+            alive_role=FLAGS.alive_role,
+            dead_role=FLAGS.dead_role,
+        )
+        fields.update(overrides)
+        return cls(**fields)
 
     @classmethod
-    def _is_player_in_list(cls, user, player_names):
-        return any(
-            (un in cls._lowercase_names(player_names))
-            for un in cls._lowercase_names(
-                USERNAME_DB.usernames_from_discord_ids(user.id)
+    def load(cls, path):
+        with open(path) as f:
+            return [cls.from_flags(**entry) for entry in json.load(f)]
+
+
+@dataclasses.dataclass
+class PreparedActions:
+    state: GameState
+    # ObservedGuild.version the actions were computed against.
+    version: int
+    actions: List[DiscordAction]
+
+
+class RouteSync:
+    # Reconciles one route's roles and channels with its game. Each route has
+    # its own scheduler and task, so a slow or rate limited guild doesn't hold
+    # up the others.
+
+    def __init__(self, route, identities, scheduler):
+        self.route = route
+        self.identities = identities
+        self.scheduler = scheduler
+        self.state = GameState()
+        self.wake = asyncio.Event()
+        self.staged = None
+        self.prepared = None
+        self._prepare_timer = None
+        self.guild = None
+        self.main_channel = None
+        self.dead_channel = None
+        self.alive_role = None
+        self.dead_role = None
+        self.observed = None
+
+    def attach(self, guild):
+        main_channel = guild.get_channel(self.route.main_channel_id)
+        dead_channel = guild.get_channel(self.route.dead_channel_id)
+        alive_role = guild.get_role(self.route.alive_role)
+        dead_role = guild.get_role(self.route.dead_role)
+        if None in (main_channel, dead_channel, alive_role, dead_role):
+            logging.error("%s is missing a channel or role in %s", self.route, guild)
+            return
+        self.guild = guild
+        self.main_channel = main_channel
+        self.dead_channel = dead_channel
+        self.alive_role = alive_role
+        self.dead_role = dead_role
+        self.observed = ObservedGuild.load(
+            [main_channel, dead_channel], [alive_role, dead_role]
+        )
+        self.prepare()
+        self.wake.set()
+
+    def _member_ids(self, player_names):
+        return {
+            discord_id
+            for discord_id in self.identities.current().account_ids(
+                "discord", player_names
             )
+            if self.guild.get_member(discord_id)
+        }
+
+    def _role_actions(self, role, player_names, removal_priority):
+        current = self.observed.role_members[role.id]
+        want = self._member_ids(player_names)
+
+        route = ("member_roles", self.guild.id)
+        actions = []
+        for member_id in want - current:
+            member = self.guild.get_member(member_id)
+            actions.append(
+                DiscordAction(
+                    ActionPriority.NORMAL,
+                    route,
+                    "Adding {} to role {}".format(member, role),
+                    functools.partial(self._add_role, member, role),
+                )
+            )
+        for member_id in current - want:
+            member = self.guild.get_member(member_id)
+            if not member:
+                continue
+            actions.append(
+                DiscordAction(
+                    removal_priority,
+                    route,
+                    "Removing {} from role {}".format(member, role),
+                    functools.partial(self._remove_role, member, role),
+                )
+            )
+        return actions
+
+    async def _add_role(self, member, role):
+        await member.add_roles(role)
+        self.observed.role_changed(role.id, member.id, True)
+
+    async def _remove_role(self, member, role):
+        await member.remove_roles(role)
+        self.observed.role_changed(role.id, member.id, False)
+
+    def role_actions(self, state):
+        # Losing the dead role unmutes people in the main channel.
+        return self._role_actions(
+            self.alive_role, state.alive_players, ActionPriority.NORMAL
+        ) + self._role_actions(
+            self.dead_role, state.dead_players, ActionPriority.NOTICEABLE
         )
 
-    async def sync_role_with_list(self, role, player_names):
-        current_users = set(role.members)
-        want_users = set()
-        for member in self._guild.members:
-            if self._is_player_in_list(member, player_names):
-                want_users.add(member)
-
-        to_add = want_users - current_users
-        to_remove = current_users - want_users
-        for member in to_add:
-            logging.info("Adding %s to server group %s", str(member), str(role))
-            await member.add_roles(role)
-        for member in to_remove:
-            logging.info("Removing %s from server group %s", str(member), str(role))
-            await member.remove_roles(role)
-
-    async def sync_roles(self):
-        want_alive_players = self._game_state.alive_players
-        want_dead_players = self._game_state.dead_players
-        if self._game_state.round_state in (
-            amongus.state_tracker.RoundState.LOBBY,
-            amongus.state_tracker.RoundState.POSTGAME,
-        ):
-            want_alive_players = []
-            want_dead_players = []
-        await self.sync_role_with_list(self._alive_role, self._game_state.alive_players)
-        await self.sync_role_with_list(self._dead_role, self._game_state.dead_players)
+    def _permission_actions(self, role, speak):
+        key = (self.main_channel.id, role.id)
+        if self.observed.overwrites.get(key, None) == (True, speak):
+            return []
+        return [
+            DiscordAction(
+                ActionPriority.NOTICEABLE if speak else ActionPriority.NORMAL,
+                ("channel_permissions", self.main_channel.id),
+                "Setting speak={} for {} in {}".format(speak, role, self.main_channel),
+                functools.partial(self._set_speak, role, speak),
+            )
+        ]
 
-    async def sync_main_channel_status(self):
-        if self._game_state.round_state in (
+    async def _set_speak(self, role, speak):
+        await self.main_channel.set_permissions(role, connect=True, speak=speak)
+        self.observed.overwrite_set(self.main_channel.id, role.id, (True, speak))
+
+    def main_channel_actions(self, state):
+        if state.round_state in (
             amongus.state_tracker.RoundState.LOBBY,
             amongus.state_tracker.RoundState.POSTGAME,
         ):
-            await self._main_channel.set_permissions(
-                self._dead_role, connect=True, speak=True
-            )
-            await self._main_channel.set_permissions(
-                self._alive_role, connect=True, speak=True
-            )
-        elif self._game_state.round_state == amongus.state_tracker.RoundState.MEETING:
-            await self._main_channel.set_permissions(
-                self._dead_role, connect=True, speak=False
-            )
-            await self._main_channel.set_permissions(
-                self._alive_role, connect=True, speak=True
-            )
+            dead_speak, alive_speak = True, True
+        elif state.round_state == amongus.state_tracker.RoundState.MEETING:
+            dead_speak, alive_speak = False, True
         else:
-            await self._main_channel.set_permissions(
-                self._dead_role, connect=True, speak=False
-            )
-            await self._main_channel.set_permissions(
-                self._alive_role, connect=True, speak=False
-            )
+            dead_speak, alive_speak = False, False
+        return self._permission_actions(
+            self.dead_role, dead_speak
+        ) + self._permission_actions(self.alive_role, alive_speak)
+
+    def _move_action(self, member_id, channel, priority):
+        member = self.guild.get_member(member_id)
+        return DiscordAction(
+            priority,
+            ("member_edit", self.guild.id),
+            "Moving {} to {}".format(member, channel),
+            functools.partial(self._move, member, channel),
+        )
+
+    async def _move(self, member, channel):
+        await member.move_to(channel)
+        self.observed.moved(member.id, channel.id)
 
-    async def move_people(self):
-        if self._game_state.round_state in (
+    def _members_in(self, channel):
+        # Only members still in the cache can be moved.
+        return {
+            member_id
+            for member_id, channel_id in self.observed.voice_channels.items()
+            if channel_id == channel.id and self.guild.get_member(member_id)
+        }
+
+    def move_actions(self, state):
+        if state.round_state in (
             amongus.state_tracker.RoundState.LOBBY,
             amongus.state_tracker.RoundState.POSTGAME,
             amongus.state_tracker.RoundState.MEETING,
         ):
             # Empty the ghost lobby.
-            for member in self._dead_channel.members:
-                await member.move_to(self._main_channel)
-        elif self._game_state.round_state == amongus.state_tracker.RoundState.ACTIVE:
+            return [
+                self._move_action(
+                    member_id, self.main_channel, ActionPriority.NOTICEABLE
+                )
+                for member_id in self._members_in(self.dead_channel)
+            ]
+        elif state.round_state == amongus.state_tracker.RoundState.ACTIVE:
             # Moving ghosts to ghost lobby.
-            for member in self._main_channel.members:
-                if self._is_player_in_list(member, self._game_state.dead_players):
-                    await member.move_to(self._dead_channel)
+            return [
+                self._move_action(member_id, self.dead_channel, ActionPriority.NORMAL)
+                for member_id in self._members_in(self.main_channel)
+                & self._member_ids(state.dead_players)
+            ]
+        return []
+
+    def actions(self, state):
+        return (
+            self.role_actions(state)
+            + self.main_channel_actions(state)
+            + self.move_actions(state)
+        )
 
-    async def sync(self):
-        logging.info("Syncing state")
-        await self.sync_roles()
-        await self.sync_main_channel_status()
-        await self.move_people()
-
-    async def update_game_state(self, new_state):
-        self._game_state = new_state
-        if not self._ready:
-            return
-        await self.sync()
+    def stage(self, state, at):
+        # The listener expects the game to reach state at (roughly) time at;
+        # work out what that will take now, and again just before it's due,
+        # so sync() has nothing left to compute when it arrives.
+        self.staged = state
+        if self._prepare_timer:
+            self._prepare_timer.cancel()
+            self._prepare_timer = None
+        if state is not None and at is not None:
+            self._prepare_timer = asyncio.get_event_loop().call_later(
+                max(0.0, at - time.monotonic() - PREPARE_LEAD_SECONDS), self.prepare
+            )
+        self.prepare()
 
-    async def on_ready(self):
-        self._ready = True
-        self._guild = self.get_guild(FLAGS.guild_id)
-        self._dead_channel = self._guild.get_channel(FLAGS.dead_channel_id)
-        self._main_channel = self._guild.get_channel(FLAGS.main_channel_id)
-        self._dead_role = self._guild.get_role(FLAGS.dead_role)
-        self._alive_role = self._guild.get_role(FLAGS.alive_role)
-        await self.sync()
-
-
-class ListenerThread(threading.Thread):
-    def __init__(self, new_state_cb, loop, **kwargs):
-        super().__init__(**kwargs)
-        self.loop = loop
-        self.new_state_cb = new_state_cb
-        self.state = amongus.state_tracker.GameState()
-        self.my_state = GameState()
-
-    def process_packet(self, pkt):
-        if not self.state.process_packet(pkt):
+    def prepare(self):
+        self.prepared = None
+        if self.staged is None or self.observed is None or self.staged == self.state:
             return
-        round_state = self.state.round_state
-        changes = {"round_state": round_state}
+        self.prepared = PreparedActions(
+            self.staged, self.observed.version, self.actions(self.staged)
+        )
+
+    async def sync(self):
+        prepared = self.prepared
         if (
-            round_state == amongus.state_tracker.RoundState.LOBBY
-            or round_state == amongus.state_tracker.RoundState.MEETING
-            or amongus.rpcs.VotingCompleteRPC in pkt
-            or amongus.rpcs.SetInfectedRPC in pkt
+            prepared
+            and prepared.state == self.state
+            and prepared.version == self.observed.version
         ):
-            # Update dead/alive players.
-            game_data = self.state.find_netobj_of_type(
-                amongus.state_tracker.NetObjGameData
+            logging.info("Using actions staged for %s", str(self.state))
+            actions = prepared.actions
+        else:
+            actions = self.actions(self.state)
+        self.prepared = None
+        if actions:
+            logging.info("Syncing state in %s: %d actions", self.guild, len(actions))
+            await self.scheduler.run(actions)
+        self.prepare()
+
+    def update(self, state):
+        self.state = state
+        self.wake.set()
+
+    async def run(self):
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            if self.observed is None:
+                # on_ready wakes us again once the guild is attached.
+                continue
+            try:
+                await self.sync()
+            except Exception:
+                logging.exception("Failed to sync state %s", str(self.state))
+
+
+class DiscordBot(discord.Client):
+    # All routes share the one gateway connection; events are handed to the
+    # routes in the guild they came from.
+
+    def __init__(self, routes, identities, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        budgets = _parse_route_budgets(FLAGS.route_budgets)
+        self.routes: Dict[Optional[int], RouteSync] = {
+            route.game_id: RouteSync(
+                route,
+                identities,
+                ActionScheduler(budgets, FLAGS.max_concurrent_actions),
             )
-            if not game_data:
+            for route in routes
+        }
+        self._route_tasks = []
+
+    def _route(self, game_id):
+        return self.routes.get(game_id, None) or self.routes.get(None, None)
+
+    def update(self, game_id, state):
+        route = self._route(game_id)
+        if route:
+            route.update(state)
+
+    def stage(self, game_id, state, at):
+        route = self._route(game_id)
+        if route:
+            route.stage(state, at)
+
+    def _attached_routes(self, guild):
+        return [
+            route
+            for route in self.routes.values()
+            if route.observed and route.guild.id == guild.id
+        ]
+
+    async def on_member_update(self, before, after):
+        for route in self._attached_routes(after.guild):
+            route.observed.member_updated(after)
+
+    async def on_voice_state_update(self, member, before, after):
+        for route in self._attached_routes(member.guild):
+            route.observed.voice_state_updated(member, after)
+
+    async def on_guild_channel_update(self, before, after):
+        for route in self._attached_routes(after.guild):
+            route.observed.channel_updated(after)
+
+    async def on_ready(self):
+        for route in self.routes.values():
+            guild = self.get_guild(route.route.guild_id)
+            if guild is None:
                 logging.error(
-                    "NetObjGameData missing when in MEETING state :( - no idea what's going on"
+                    "Not in guild %d for %s", route.route.guild_id, route.route
                 )
-                return
-            living_players = set()
-            dead_players = set()
-            for p in game_data.players:
-                if p.is_dead:
-                    dead_players.add(p.name)
-                else:
-                    living_players.add(p.name)
-            changes.update(
-                alive_players=frozenset(living_players),
-                dead_players=frozenset(dead_players),
-            )
-        new_my_state = dataclasses.replace(self.my_state, **changes)
-        if new_my_state != self.my_state:
-            logging.info("New state: %s", str(new_my_state))
-            future = asyncio.run_coroutine_threadsafe(
-                self.new_state_cb(new_my_state), self.loop
-            )
-            try:
-                future.result(5)
-            except concurrent.futures.TimeoutError:
-                logging.exception(
-                    "Timed out waiting for coroutine to respond to update"
-                )
-                raise
-            self.my_state = new_my_state
+                continue
+            route.attach(guild)
+        if not self._route_tasks:
+            self._route_tasks = [
+                self.loop.create_task(route.run()) for route in self.routes.values()
+            ]
 
-    def run(self):
-        state = amongus.state_tracker.GameState()
+    async def close(self):
+        for task in self._route_tasks:
+            task.cancel()
+        self._route_tasks = []
+        await super().close()
 
-        logging.info("listener ready")
-        scapy.all.sniff(
-            prn=self.process_packet, filter="udp and (src port 22023 or dst port 22023)"
-        )
+
+def make_bot(loop):
+    if not FLAGS.client_token:
+        raise app.UsageError("--client_token is required.")
+
+    if FLAGS.routes_file:
+        routes = Route.load(FLAGS.routes_file)
+    else:
+        routes = [Route.from_flags()]
+
+    # Keeping the observed state current needs member and voice state events.
+    intents = discord.Intents.default()
+    intents.members = True
+    identities = amongus.identity.IdentityService(FLAGS.identity_file)
+    return DiscordBot(routes, identities, loop=loop, intents=intents)
 
 
 def main(argv):
     if len(argv) != 1:
         raise app.UsageError("Too many arguments.")
-    if not FLAGS.client_token:
-        raise app.UsageError("--client_token is required.")
 
-    scapy.all.conf.use_pcap = True
-    scapy.all.conf.sniff_promisc = False
     loop = asyncio.get_event_loop()
-
-    bot = DiscordBot(loop=loop)
-    listener_thread = ListenerThread(bot.update_game_state, loop, daemon=True)
-    listener_thread.start()
+    bot = make_bot(loop)
+    sink = amongus.voice.VoiceSink(loop, bot.update, bot.stage, name="discord")
+    if FLAGS.follow_feed:
+        client = amongus.feed.FeedClient(
+            FLAGS.follow_feed,
+            lambda game_id, game: sink.apply((game_id, game.voice, game.staged())),
+        )
+        client.start()
+    else:
+        amongus.runtime.Tracker([sink]).start()
     bot.run(FLAGS.client_token)
 
 
@@ -0,0 +1,489 @@
+# SPDX-FileCopyrightText: 2020 Luke Granger-Brown
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+import collections
+import dataclasses
+import json
+import math
+import time
+from typing import Dict, List, Optional, Tuple
+
+from absl import app
+from absl import flags
+from absl import logging
+from aiohttp import web
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string("mock_host", "localhost", "Host to serve the mock Discord API on.")
+flags.DEFINE_integer("mock_port", 8765, "Port to serve the mock Discord API on.")
+flags.DEFINE_float(
+    "mock_latency", 0.05, "Seconds the mock Discord API takes to answer a request."
+)
+flags.DEFINE_float(
+    "mock_gateway_latency",
+    0.05,
+    "Seconds after a change before the mock gateway dispatches its event.",
+)
+flags.DEFINE_list(
+    "mock_route_limits",
+    ["member_roles=10/10", "member_edit=10/10", "channel_permissions=5/5"],
+    "Rate limits the mock Discord API enforces, as route=requests/seconds.",
+)
+
+API_PREFIX = "/api/v7"
+GATEWAY_PATH = "/gateway"
+HEARTBEAT_INTERVAL_MS = 41250
+# The bot's own user.
+BOT_USER_ID = 1
+
+OP_DISPATCH = 0
+OP_HEARTBEAT = 1
+OP_IDENTIFY = 2
+OP_REQUEST_GUILD_MEMBERS = 8
+OP_HELLO = 10
+OP_HEARTBEAT_ACK = 11
+
+
+def parse_route_limits(specs):
+    limits = {}
+    for spec in specs:
+        route, _, limit = spec.partition("=")
+        requests, _, period = limit.partition("/")
+        limits[route] = (int(requests), float(period))
+    return limits
+
+
+def _json_response(data, status=200, headers=None):
+    # discord.py only decodes JSON when the content type is exactly
+    # application/json, without aiohttp's charset parameter.
+    return web.Response(
+        body=json.dumps(data).encode(),
+        status=status,
+        headers=dict(headers or {}, **{"Content-Type": "application/json"}),
+    )
+
+
+@dataclasses.dataclass
+class Bucket:
+    limit: int
+    period: float
+    remaining: int = 0
+    reset_at: float = 0.0
+
+    def take(self, now):
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + self.period
+        if self.remaining == 0:
+            return False
+        self.remaining -= 1
+        return True
+
+
+@dataclasses.dataclass
+class MockGuild:
+    id: int
+    name: str
+    roles: Dict[int, str] = dataclasses.field(default_factory=dict)
+    # Voice channels.
+    channels: Dict[int, str] = dataclasses.field(default_factory=dict)
+    members: Dict[int, str] = dataclasses.field(default_factory=dict)
+
+
+class GatewaySession:
+    def __init__(self, ws):
+        self.ws = ws
+        self.seq = 0
+
+    async def send(self, op, data, event=None):
+        payload = {"op": op, "d": data}
+        if op == OP_DISPATCH:
+            self.seq += 1
+            payload.update(s=self.seq, t=event)
+        await self.ws.send_json(payload)
+
+
+@dataclasses.dataclass
+class Call:
+    at: float
+    method: str
+    route: str
+    major_id: int
+    status: int
+
+
+class MockDiscord:
+    # Just enough of the Discord REST API and gateway for the bot's voice and
+    # role management, with per-route rate limits shaped like the real ones.
+    # Changes, whether made through the API or by the helpers standing in for
+    # users, are dispatched as gateway events after gateway_latency.
+
+    def __init__(self, latency, limits, gateway_latency=0.0):
+        self.latency = latency
+        self.limits = limits
+        self.gateway_latency = gateway_latency
+        self.buckets: Dict[Tuple[str, int], Bucket] = {}
+        self.calls: List[Call] = []
+        self.guilds: Dict[int, MockGuild] = {}
+        self.member_roles = collections.defaultdict(set)
+        self.member_channels: Dict[int, Optional[int]] = {}
+        self.overwrites = collections.defaultdict(dict)
+        self.sessions: List[GatewaySession] = []
+
+    def add_guild(self, guild_id, name):
+        self.guilds[guild_id] = MockGuild(guild_id, name)
+        # @everyone.
+        self.guilds[guild_id].roles[guild_id] = "@everyone"
+
+    def add_role(self, guild_id, role_id, name):
+        self.guilds[guild_id].roles[role_id] = name
+
+    def add_voice_channel(self, guild_id, channel_id, name):
+        self.guilds[guild_id].channels[channel_id] = name
+
+    def add_member(self, guild_id, user_id, name, channel_id=None):
+        self.guilds[guild_id].members[user_id] = name
+        self.member_channels[user_id] = channel_id
+
+    def join_voice(self, guild_id, user_id, channel_id):
+        # A user moving themselves.
+        self.member_channels[user_id] = channel_id
+        self._dispatch("VOICE_STATE_UPDATE", self._voice_state(guild_id, user_id))
+
+    def _guild_of_channel(self, channel_id):
+        for guild in self.guilds.values():
+            if channel_id in guild.channels:
+                return guild
+        return None
+
+    def _user(self, guild, user_id):
+        return {
+            "id": str(user_id),
+            "username": guild.members.get(user_id, str(user_id)),
+            "discriminator": "0000",
+            "avatar": None,
+        }
+
+    def _member(self, guild, user_id):
+        return {
+            "user": self._user(guild, user_id),
+            "roles": [
+                str(role_id)
+                for role_id in sorted(self.member_roles[user_id])
+                if role_id in guild.roles
+            ],
+            "joined_at": "2020-10-01T00:00:00+00:00",
+            "nick": None,
+            "deaf": False,
+            "mute": False,
+        }
+
+    def _channel(self, guild, channel_id):
+        return {
+            "id": str(channel_id),
+            "type": 2,
+            "guild_id": str(guild.id),
+            "name": guild.channels[channel_id],
+            "position": list(guild.channels).index(channel_id),
+            "parent_id": None,
+            "bitrate": 64000,
+            "user_limit": 0,
+            "permission_overwrites": [
+                {
+                    "id": str(target),
+                    "type": "role",
+                    "allow": allow,
+                    "deny": deny,
+                    "allow_new": str(allow),
+                    "deny_new": str(deny),
+                }
+                for target, (allow, deny) in self.overwrites[channel_id].items()
+            ],
+        }
+
+    def _voice_state(self, guild_id, user_id):
+        guild = self.guilds[guild_id]
+        channel_id = self.member_channels.get(user_id, None)
+        return {
+            "guild_id": str(guild_id),
+            "channel_id": str(channel_id) if channel_id else None,
+            "user_id": str(user_id),
+            "member": self._member(guild, user_id),
+            "session_id": "mock",
+            "deaf": False,
+            "mute": False,
+            "self_deaf": False,
+            "self_mute": False,
+            "self_video": False,
+            "suppress": False,
+        }
+
+    def _guild_create(self, guild):
+        return {
+            "id": str(guild.id),
+            "name": guild.name,
+            "unavailable": False,
+            "large": False,
+            "member_count": len(guild.members),
+            "owner_id": str(BOT_USER_ID),
+            "roles": [
+                {
+                    "id": str(role_id),
+                    "name": name,
+                    "position": position,
+                    "permissions": "0",
+                    "permissions_new": "0",
+                }
+                for position, (role_id, name) in enumerate(guild.roles.items())
+            ],
+            "channels": [
+                self._channel(guild, channel_id) for channel_id in guild.channels
+            ],
+            "members": [self._member(guild, user_id) for user_id in guild.members],
+            "voice_states": [
+                self._voice_state(guild.id, user_id)
+                for user_id in guild.members
+                if self.member_channels.get(user_id, None)
+            ],
+        }
+
+    def _dispatch(self, event, data):
+        async def send():
+            await asyncio.sleep(self.gateway_latency)
+            for session in list(self.sessions):
+                try:
+                    await session.send(OP_DISPATCH, data, event)
+                except ConnectionError:
+                    pass
+
+        asyncio.ensure_future(send())
+
+    def reset_log(self):
+        self.calls = []
+
+    def _bucket(self, route, major_id):
+        key = (route, major_id)
+        bucket = self.buckets.get(key, None)
+        if bucket is None and route in self.limits:
+            bucket = self.buckets[key] = Bucket(*self.limits[route])
+        return bucket
+
+    async def _limited(self, request, route, major_id, apply):
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        bucket = self._bucket(route, major_id)
+        if bucket and not bucket.take(now):
+            retry_after = bucket.reset_at - now
+            self.calls.append(Call(now, request.method, route, major_id, 429))
+            return _json_response(
+                {
+                    "message": "You are being rate limited.",
+                    "retry_after": math.ceil(retry_after * 1000),
+                    "global": False,
+                },
+                status=429,
+                headers={"Via": "1.1 mock", "Retry-After": str(math.ceil(retry_after))},
+            )
+        result = apply()
+        self.calls.append(Call(now, request.method, route, major_id, 204))
+        headers = {}
+        if bucket:
+            headers = {
+                "X-RateLimit-Bucket": "{}:{}".format(route, major_id),
+                "X-RateLimit-Limit": str(bucket.limit),
+                "X-RateLimit-Remaining": str(bucket.remaining),
+                "X-RateLimit-Reset-After": "{:.3f}".format(bucket.reset_at - now),
+            }
+        if result is None:
+            return web.Response(status=204, headers=headers)
+        return _json_response(result, headers=headers)
+
+    def _bot_user(self):
+        return {
+            "id": str(BOT_USER_ID),
+            "username": "mock",
+            "discriminator": "0000",
+            "avatar": None,
+            "bot": True,
+        }
+
+    async def get_me(self, request):
+        return _json_response(self._bot_user())
+
+    async def get_gateway(self, request):
+        return _json_response({"url": "ws://{}{}".format(request.host, GATEWAY_PATH)})
+
+    async def gateway(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        session = GatewaySession(ws)
+        await session.send(OP_HELLO, {"heartbeat_interval": HEARTBEAT_INTERVAL_MS})
+        try:
+            async for msg in ws:
+                payload = msg.json()
+                op = payload["op"]
+                if op == OP_HEARTBEAT:
+                    await session.send(OP_HEARTBEAT_ACK, None)
+                elif op == OP_IDENTIFY:
+                    await session.send(
+                        OP_DISPATCH,
+                        {
+                            "v": 6,
+                            "session_id": "mock",
+                            "user": self._bot_user(),
+                            "guilds": [
+                                {"id": str(guild_id), "unavailable": True}
+                                for guild_id in self.guilds
+                            ],
+                        },
+                        "READY",
+                    )
+                    for guild in self.guilds.values():
+                        await session.send(
+                            OP_DISPATCH, self._guild_create(guild), "GUILD_CREATE"
+                        )
+                    self.sessions.append(session)
+                elif op == OP_REQUEST_GUILD_MEMBERS:
+                    # Everyone was in GUILD_CREATE, so there is nothing more.
+                    guild = self.guilds[int(payload["d"]["guild_id"])]
+                    await session.send(
+                        OP_DISPATCH,
+                        {
+                            "guild_id": str(guild.id),
+                            "members": [
+                                self._member(guild, user_id)
+                                for user_id in guild.members
+                            ],
+                            "chunk_index": 0,
+                            "chunk_count": 1,
+                            "nonce": payload["d"].get("nonce", None),
+                        },
+                        "GUILD_MEMBERS_CHUNK",
+                    )
+        finally:
+            if session in self.sessions:
+                self.sessions.remove(session)
+        return ws
+
+    async def put_member_role(self, request):
+        guild_id = int(request.match_info["guild_id"])
+        user_id = int(request.match_info["user_id"])
+        role_id = int(request.match_info["role_id"])
+
+        def apply():
+            self.member_roles[user_id].add(role_id)
+            self._dispatch_member_update(guild_id, user_id)
+
+        return await self._limited(request, "member_roles", guild_id, apply)
+
+    async def delete_member_role(self, request):
+        guild_id = int(request.match_info["guild_id"])
+        user_id = int(request.match_info["user_id"])
+        role_id = int(request.match_info["role_id"])
+
+        def apply():
+            self.member_roles[user_id].discard(role_id)
+            self._dispatch_member_update(guild_id, user_id)
+
+        return await self._limited(request, "member_roles", guild_id, apply)
+
+    def _dispatch_member_update(self, guild_id, user_id):
+        guild = self.guilds.get(guild_id, None)
+        if guild is None:
+            return
+        member = self._member(guild, user_id)
+        member["guild_id"] = str(guild_id)
+        self._dispatch("GUILD_MEMBER_UPDATE", member)
+
+    async def patch_member(self, request):
+        guild_id = int(request.match_info["guild_id"])
+        user_id = int(request.match_info["user_id"])
+        fields = await request.json()
+
+        def apply():
+            if "channel_id" in fields:
+                self.member_channels[user_id] = fields["channel_id"] and int(
+                    fields["channel_id"]
+                )
+                if guild_id in self.guilds:
+                    self._dispatch(
+                        "VOICE_STATE_UPDATE", self._voice_state(guild_id, user_id)
+                    )
+            return {"user": {"id": str(user_id)}, "roles": []}
+
+        return await self._limited(request, "member_edit", guild_id, apply)
+
+    async def put_channel_permissions(self, request):
+        channel_id = int(request.match_info["channel_id"])
+        target = int(request.match_info["target"])
+        overwrite = await request.json()
+
+        def apply():
+            self.overwrites[channel_id][target] = (
+                int(overwrite["allow"]),
+                int(overwrite["deny"]),
+            )
+            guild = self._guild_of_channel(channel_id)
+            if guild:
+                self._dispatch("CHANNEL_UPDATE", self._channel(guild, channel_id))
+
+        return await self._limited(request, "channel_permissions", channel_id, apply)
+
+    def make_app(self):
+        application = web.Application()
+        application.add_routes(
+            [
+                web.get(API_PREFIX + "/users/@me", self.get_me),
+                web.get(API_PREFIX + "/gateway", self.get_gateway),
+                web.get(GATEWAY_PATH, self.gateway),
+                web.put(
+                    API_PREFIX + "/guilds/{guild_id}/members/{user_id}/roles/{role_id}",
+                    self.put_member_role,
+                ),
+                web.delete(
+                    API_PREFIX + "/guilds/{guild_id}/members/{user_id}/roles/{role_id}",
+                    self.delete_member_role,
+                ),
+                web.patch(
+                    API_PREFIX + "/guilds/{guild_id}/members/{user_id}",
+                    self.patch_member,
+                ),
+                web.put(
+                    API_PREFIX + "/channels/{channel_id}/permissions/{target}",
+                    self.put_channel_permissions,
+                ),
+            ]
+        )
+        return application
+
+
+async def start(mock, host, port):
+    runner = web.AppRunner(mock.make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner
+
+
+def main(argv):
+    if len(argv) != 1:
+        raise app.UsageError("Too many arguments.")
+
+    mock = MockDiscord(
+        FLAGS.mock_latency,
+        parse_route_limits(FLAGS.mock_route_limits),
+        FLAGS.mock_gateway_latency,
+    )
+    logging.info(
+        "Serving mock Discord API on http://%s:%d%s",
+        FLAGS.mock_host,
+        FLAGS.mock_port,
+        API_PREFIX,
+    )
+    web.run_app(mock.make_app(), host=FLAGS.mock_host, port=FLAGS.mock_port)
+
+
+if __name__ == "__main__":
+    app.run(main)
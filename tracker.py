@@ -0,0 +1,187 @@
+# SPDX-FileCopyrightText: 2020 Luke Granger-Brown
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+import http
+import importlib
+import sys
+
+from absl import app
+from absl import flags
+from absl import logging
+
+import amongus.events
+import amongus.feed
+import amongus.runtime
+import amongus.shared_state
+import amongus.voice
+
+FLAGS = flags.FLAGS
+flags.DEFINE_list(
+    "sinks",
+    ["websocket"],
+    "Consumers to run on one capture: any of websocket, discord, ts3, archive, "
+    "metrics, feed and shm. Each takes its own module's flags.",
+)
+flags.DEFINE_integer(
+    "sink_queue_size",
+    0,
+    "Items each sink may have waiting before its oldest are dropped; 0 uses "
+    "each sink's default.",
+)
+flags.DEFINE_string(
+    "archive_path", "capture.pcap", "pcap file the archive sink appends to."
+)
+flags.DEFINE_bool(
+    "print_events",
+    False,
+    "Print what happens in each game (murders, votes, chat and so on) to stdout.",
+)
+flags.DEFINE_string("metrics_host", "localhost", "Host to serve /metrics on.")
+flags.DEFINE_integer("metrics_port", 8766, "Port to serve /metrics on.")
+flags.DEFINE_string(
+    "shm_prefix",
+    amongus.shared_state.DEFAULT_PREFIX,
+    "Name of the shared memory index the shm sink keeps; each game's region is "
+    "named <prefix>_<game_id in hex>.",
+)
+flags.DEFINE_string(
+    "feed_socket",
+    "/tmp/amongus_tracker.sock",
+    "Unix socket the feed sink publishes on, for bots run with --follow_feed "
+    "and other subscribers using amongus.feed.FeedClient.",
+)
+
+# Sinks which live in their own modules, imported only when asked for. The
+# Discord and TS3 bots define flags of the same names, so can't share a
+# process; one of them can follow the feed instead.
+SINK_MODULES = {
+    "websocket": "websocket_server",
+    "discord": "discord_bot",
+    "ts3": "ts3_bot",
+}
+SINKS = frozenset(SINK_MODULES) | {"archive", "metrics", "feed", "shm"}
+
+flags.register_validator(
+    "sinks",
+    lambda sinks: set(sinks) <= SINKS,
+    "--sinks must be among {}".format(", ".join(sorted(SINKS))),
+)
+flags.register_validator(
+    "sinks",
+    lambda sinks: not {"discord", "ts3"} <= set(sinks),
+    "The discord and ts3 sinks can't share a process; run one of the bots "
+    "with --follow_feed and the feed sink instead.",
+)
+
+
+def _parse_flags(argv):
+    # The sinks' modules are imported first, so that their flags are parsed
+    # along with ours.
+    try:
+        FLAGS(argv, known_only=True)
+    except flags.Error as error:
+        sys.stderr.write("FATAL Flags parsing error: {}\n".format(error))
+        sys.exit(1)
+    for sink in sorted(set(FLAGS.sinks) & set(SINK_MODULES)):
+        importlib.import_module(SINK_MODULES[sink])
+    FLAGS.unparse_flags()
+    return app.parse_flags_with_usage(argv)
+
+
+async def serve_metrics(reader, writer, metrics):
+    try:
+        request = await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        writer.close()
+        return
+    path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+    if path == b"/metrics":
+        status = http.HTTPStatus.OK
+        body = ("\n".join(metrics()) + "\n").encode("utf8")
+    else:
+        status = http.HTTPStatus.NOT_FOUND
+        body = b"not found\n"
+    writer.write(
+        "HTTP/1.1 {} {}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+        "Content-Length: {}\r\nConnection: close\r\n\r\n".format(
+            status.value, status.phrase, len(body)
+        ).encode("ascii")
+        + body
+    )
+    await writer.drain()
+    writer.close()
+
+
+def main(argv):
+    if len(argv) != 1:
+        raise app.UsageError("Too many arguments.")
+
+    loop = asyncio.get_event_loop()
+    sinks = []
+    tasks = []
+    websocket_sink = None
+    if "websocket" in FLAGS.sinks:
+        import websocket_server
+
+        websocket_sink = websocket_server.WebSocketSink(loop)
+        sinks.append(websocket_sink)
+        tasks.append(websocket_sink.run())
+    if "discord" in FLAGS.sinks:
+        import discord_bot
+
+        bot = discord_bot.make_bot(loop)
+        sinks.append(
+            amongus.voice.VoiceSink(loop, bot.update, bot.stage, name="discord")
+        )
+        tasks.append(bot.start(FLAGS.client_token))
+    if "ts3" in FLAGS.sinks:
+        import ts3_bot
+
+        bot = ts3_bot.make_bot()
+        sinks.append(amongus.voice.VoiceSink(loop, bot.update, bot.stage, name="ts3"))
+        tasks.append(bot.run())
+    if "feed" in FLAGS.sinks:
+        feed_sink = amongus.feed.FeedSink(loop, FLAGS.feed_socket)
+        sinks.append(feed_sink)
+        tasks.append(feed_sink.run())
+    if "shm" in FLAGS.sinks:
+        sinks.append(amongus.shared_state.SharedStateSink(FLAGS.shm_prefix))
+    if "archive" in FLAGS.sinks:
+        sinks.append(amongus.runtime.ArchiveSink(FLAGS.archive_path))
+    metrics_sink = None
+    if "metrics" in FLAGS.sinks:
+        metrics_sink = amongus.runtime.MetricsSink()
+        sinks.append(metrics_sink)
+
+    tracker = amongus.runtime.Tracker(sinks, FLAGS.sink_queue_size or None)
+    if websocket_sink and websocket_sink.wsh:
+        websocket_sink.wsh.metrics.append(tracker.prometheus_lines)
+    if metrics_sink:
+
+        def metrics():
+            return tracker.prometheus_lines() + metrics_sink.prometheus_lines()
+
+        loop.run_until_complete(
+            asyncio.start_server(
+                lambda reader, writer: serve_metrics(reader, writer, metrics),
+                FLAGS.metrics_host,
+                FLAGS.metrics_port,
+            )
+        )
+        logging.info(
+            "Serving metrics on http://%s:%d/metrics",
+            FLAGS.metrics_host,
+            FLAGS.metrics_port,
+        )
+
+    if FLAGS.print_events:
+        amongus.events.TextRenderer(tracker.events).start()
+    tracker.start()
+    loop.run_until_complete(asyncio.gather(*tasks))
+    loop.run_forever()
+
+
+if __name__ == "__main__":
+    app.run(main, flags_parser=_parse_flags)
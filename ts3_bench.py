@@ -0,0 +1,154 @@
+# SPDX-FileCopyrightText: 2020 Luke Granger-Brown
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+import json
+import tempfile
+import time
+
+from absl import app
+from absl import flags
+import scapy.all
+
+import amongus.identity
+import amongus.state_tracker
+import amongus.voice
+import ts3_bot
+import ts3_mock
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string("bench_pcap", None, "Recorded game to replay, as a pcap file.")
+flags.DEFINE_float(
+    "bench_settle",
+    0.2,
+    "Seconds without any commands reaching the mock server after which a "
+    "transition counts as finished.",
+)
+
+# Server group everyone starts in.
+GUEST_SERVER_GROUP = 8
+
+
+def _player_names(packets):
+    states = amongus.state_tracker.GameStates()
+    names = set()
+    for pkt in packets:
+        game_id = states.process_packet(pkt)
+        if game_id is None:
+            continue
+        rosters = states.games[game_id].rosters
+        names |= rosters.alive | rosters.dead
+    return sorted(names)
+
+
+async def _settle(mock):
+    calls = len(mock.calls)
+    while True:
+        await asyncio.sleep(FLAGS.bench_settle)
+        if len(mock.calls) == calls:
+            return
+        calls = len(mock.calls)
+
+
+async def bench(packets, names, identities):
+    mock = ts3_mock.MockServer(
+        FLAGS.mock_latency, ts3_mock.parse_command_latency(FLAGS.mock_command_latency)
+    )
+    mock.add_channel(FLAGS.main_channel_id)
+    mock.add_channel(FLAGS.dead_channel_id)
+    for n, name in enumerate(names):
+        mock.add_client(name, 1000 + n, FLAGS.main_channel_id, [GUEST_SERVER_GROUP])
+    server = await mock.start("127.0.0.1", 0)
+    host, port = server.sockets[0].getsockname()[:2]
+
+    bot = ts3_bot.TS3Bot(
+        [
+            ts3_bot.Route.from_flags(
+                connection_string="telnet://{}:{}".format(host, port), server_id=1
+            )
+        ],
+        identities,
+    )
+    bot_task = asyncio.ensure_future(bot.run())
+    while not all(server.ready for server in bot.servers.values()):
+        await asyncio.sleep(0.01)
+    await _settle(mock)
+
+    published = []
+
+    def publish(game_id, state):
+        published.append(state)
+        bot.update(game_id, state)
+
+    states = amongus.state_tracker.GameStates()
+    sink = amongus.voice.VoiceSink(asyncio.get_event_loop(), publish, bot.stage)
+    results = []
+    try:
+        for pkt in packets:
+            before = len(published)
+            calls_before = len(mock.calls)
+            start = time.monotonic()
+            game_id = states.process_packet(pkt)
+            item = sink.derive(pkt, game_id, states.games.get(game_id, None))
+            if item is not None:
+                sink.apply(item)
+            if len(published) == before:
+                continue
+            await _settle(mock)
+            calls = [
+                call
+                for call in mock.calls[calls_before:]
+                if call.cmd in ts3_mock.MUTATING_COMMANDS
+            ]
+            converged = max((call.at for call in calls), default=start) - start
+            results.append((published[-1], converged, calls))
+    finally:
+        bot_task.cancel()
+        server.close()
+
+    for n, (state, converged, calls) in enumerate(results):
+        print(
+            "{:3d} {:<9} alive {:2d} dead {:2d}  converged {:7.1f}ms  "
+            "commands {:2d}  items {:3d}  errors {:2d}".format(
+                n,
+                state.round_state.value,
+                len(state.alive_players),
+                len(state.dead_players),
+                converged * 1000,
+                len(calls),
+                sum(call.items for call in calls),
+                sum(1 for call in calls if call.error_id),
+            )
+        )
+    if results:
+        times = sorted(converged for _, converged, _ in results)
+        print(
+            "{} transitions  median {:.1f}ms  max {:.1f}ms  commands {}".format(
+                len(results),
+                times[len(times) // 2] * 1000,
+                times[-1] * 1000,
+                sum(len(calls) for _, _, calls in results),
+            )
+        )
+
+
+def main(argv):
+    if len(argv) != 1:
+        raise app.UsageError("Too many arguments.")
+    if not FLAGS.bench_pcap:
+        raise app.UsageError("--bench_pcap is required.")
+
+    packets = scapy.all.rdpcap(FLAGS.bench_pcap)
+    names = _player_names(packets)
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+        json.dump(
+            [{"names": [name], "ts3": [1000 + n]} for n, name in enumerate(names)], f
+        )
+        f.flush()
+        identities = amongus.identity.IdentityService(f.name)
+    asyncio.get_event_loop().run_until_complete(bench(packets, names, identities))
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,368 @@
+# SPDX-FileCopyrightText: 2020 Luke Granger-Brown
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+import dataclasses
+import json
+import time
+from typing import Dict, List, Set
+
+from absl import app
+from absl import flags
+from absl import logging
+import ts3.escape
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+    "mock_host", "localhost", "Host to serve the mock TS3 ServerQuery interface on."
+)
+flags.DEFINE_integer(
+    "mock_port", 10011, "Port to serve the mock TS3 ServerQuery interface on."
+)
+flags.DEFINE_float(
+    "mock_latency", 0.02, "Seconds the mock TS3 server takes to answer a command."
+)
+flags.DEFINE_list(
+    "mock_command_latency",
+    [],
+    "Latencies for particular commands, overriding --mock_latency, as "
+    "command=seconds (e.g. clientmove=0.1).",
+)
+flags.DEFINE_list("mock_channels", ["62", "65"], "IDs of the mock server's channels.")
+flags.DEFINE_string(
+    "mock_clients_file",
+    None,
+    "JSON list of clients connected to the mock server at start, each "
+    '{"nickname": ..., "database_id": ..., "channel_id": ..., '
+    '"server_groups": [...]}.',
+)
+
+LINE_END = b"\n\r"
+
+# Commands which change the server, as opposed to reading from it.
+MUTATING_COMMANDS = frozenset(
+    ["channeledit", "clientmove", "servergroupaddclient", "servergroupdelclient"]
+)
+
+
+def parse_command_latency(specs):
+    latencies = {}
+    for spec in specs:
+        cmd, _, seconds = spec.partition("=")
+        latencies[cmd] = float(seconds)
+    return latencies
+
+
+def parse_command(line):
+    cmd, _, rest = line.partition(" ")
+    items = []
+    options = []
+    for chunk in rest.split("|"):
+        params = {}
+        for word in chunk.split():
+            if word.startswith("-"):
+                options.append(word[1:])
+                continue
+            key, _, value = word.partition("=")
+            params[key] = ts3.escape.unescape(value)
+        items.append(params)
+    # Piped items carry over the parameters of the first that they leave out.
+    return cmd, [dict(items[0], **item) for item in items], options
+
+
+def format_items(items):
+    return "|".join(
+        " ".join(
+            "{}={}".format(key, ts3.escape.escape(str(value)))
+            for key, value in item.items()
+        )
+        for item in items
+    ).encode()
+
+
+class QueryError(Exception):
+    def __init__(self, error_id, msg):
+        super().__init__(msg)
+        self.error_id = error_id
+        self.msg = msg
+
+
+@dataclasses.dataclass
+class Client:
+    client_id: int
+    database_id: int
+    nickname: str
+    channel_id: int
+    server_groups: Set[int]
+
+
+@dataclasses.dataclass
+class Channel:
+    name: str
+    topic: str = ""
+    needed_talk_power: int = 0
+
+
+@dataclasses.dataclass
+class Call:
+    at: float
+    cmd: str
+    items: int
+    error_id: int
+
+
+class MockServer:
+    # Just enough of a TS3 virtual server's ServerQuery interface for the bot,
+    # with notifications for every change, whoever made it. Each connection's
+    # commands are answered in order, after a per-command latency.
+
+    def __init__(self, latency, command_latency=None):
+        self.latency = latency
+        self.command_latency = command_latency or {}
+        self.clients: Dict[int, Client] = {}
+        self.channels: Dict[int, Channel] = {}
+        self.calls: List[Call] = []
+        self._subscribers = set()
+        self._next_client_id = 1
+
+    def reset_log(self):
+        self.calls = []
+
+    def add_channel(self, cid, name="", topic="", needed_talk_power=0):
+        self.channels[cid] = Channel(name or str(cid), topic, needed_talk_power)
+
+    def add_client(self, nickname, database_id, channel_id, server_groups=(8,)):
+        client = Client(
+            self._next_client_id,
+            database_id,
+            nickname,
+            channel_id,
+            set(server_groups),
+        )
+        self._next_client_id += 1
+        self.clients[client.client_id] = client
+        self._notify(
+            "notifycliententerview",
+            [
+                {
+                    "cfid": 0,
+                    "ctid": channel_id,
+                    "reasonid": 0,
+                    "clid": client.client_id,
+                    "client_database_id": database_id,
+                    "client_nickname": nickname,
+                    "client_type": 0,
+                    "client_servergroups": ",".join(
+                        str(sgid) for sgid in sorted(client.server_groups)
+                    ),
+                }
+            ],
+        )
+        return client.client_id
+
+    def remove_client(self, clid):
+        client = self.clients.pop(clid)
+        self._notify(
+            "notifyclientleftview",
+            [{"cfid": client.channel_id, "ctid": 0, "reasonid": 8, "clid": clid}],
+        )
+
+    def move_client(self, clid, cid, reasonid=0):
+        self.clients[clid].channel_id = cid
+        self._notify(
+            "notifyclientmoved", [{"ctid": cid, "reasonid": reasonid, "clid": clid}]
+        )
+
+    def _notify(self, event, items):
+        line = event.encode() + b" " + format_items(items) + LINE_END
+        for writer in list(self._subscribers):
+            writer.write(line)
+
+    def _client(self, clid):
+        client = self.clients.get(int(clid), None)
+        if client is None:
+            raise QueryError(512, "invalid clientID")
+        return client
+
+    def _channel(self, cid):
+        channel = self.channels.get(int(cid), None)
+        if channel is None:
+            raise QueryError(768, "invalid channelID")
+        return channel
+
+    def _clients_by_database_id(self, cldbid):
+        clients = [c for c in self.clients.values() if c.database_id == int(cldbid)]
+        if not clients:
+            raise QueryError(512, "invalid clientID")
+        return clients
+
+    def cmd_clientlist(self, items, options):
+        results = []
+        for client in self.clients.values():
+            result = {
+                "clid": client.client_id,
+                "cid": client.channel_id,
+                "client_database_id": client.database_id,
+                "client_nickname": client.nickname,
+                "client_type": 0,
+            }
+            if "groups" in options:
+                result["client_servergroups"] = ",".join(
+                    str(sgid) for sgid in sorted(client.server_groups)
+                )
+            results.append(result)
+        return results
+
+    def cmd_channelinfo(self, items, options):
+        channel = self._channel(items[0]["cid"])
+        return [
+            {
+                "channel_name": channel.name,
+                "channel_topic": channel.topic,
+                "channel_needed_talk_power": channel.needed_talk_power,
+            }
+        ]
+
+    def cmd_channeledit(self, items, options):
+        params = items[0]
+        cid = int(params["cid"])
+        channel = self._channel(cid)
+        changes = {"cid": cid, "reasonid": 10}
+        if "channel_topic" in params:
+            channel.topic = params["channel_topic"]
+            changes["channel_topic"] = channel.topic
+        if "channel_needed_talk_power" in params:
+            channel.needed_talk_power = int(params["channel_needed_talk_power"])
+            changes["channel_needed_talk_power"] = channel.needed_talk_power
+        self._notify("notifychanneledited", [changes])
+
+    def cmd_clientmove(self, items, options):
+        for params in items:
+            client = self._client(params["clid"])
+            cid = int(params["cid"])
+            self._channel(cid)
+            if client.channel_id == cid:
+                raise QueryError(770, "already member of channel")
+            self.move_client(client.client_id, cid, reasonid=1)
+
+    def _server_group_clients(self, items, options, present):
+        for params in items:
+            sgid = int(params["sgid"])
+            for client in self._clients_by_database_id(params["cldbid"]):
+                if (sgid in client.server_groups) == present:
+                    if present:
+                        raise QueryError(2561, "duplicate entry")
+                    raise QueryError(2563, "empty result set")
+                if present:
+                    client.server_groups.add(sgid)
+                else:
+                    client.server_groups.discard(sgid)
+                self._notify(
+                    "notifyservergroupclient{}".format(
+                        "added" if present else "deleted"
+                    ),
+                    [
+                        {
+                            "sgid": sgid,
+                            "cldbid": client.database_id,
+                            "clid": client.client_id,
+                        }
+                    ],
+                )
+
+    def cmd_servergroupaddclient(self, items, options):
+        self._server_group_clients(items, options, True)
+
+    def cmd_servergroupdelclient(self, items, options):
+        self._server_group_clients(items, options, False)
+
+    def cmd_version(self, items, options):
+        return [{"version": "3.13.0", "build": 0, "platform": "Mock"}]
+
+    def cmd_login(self, items, options):
+        pass
+
+    def cmd_use(self, items, options):
+        pass
+
+    def _run(self, line, writer):
+        cmd, items, options = parse_command(line)
+        if cmd == "servernotifyregister":
+            self._subscribers.add(writer)
+            return None
+        handler = getattr(self, "cmd_{}".format(cmd), None)
+        if handler is None:
+            raise QueryError(256, "command not found")
+        return handler(items, options)
+
+    async def handle_connection(self, reader, writer):
+        writer.write(b"TS3" + LINE_END)
+        writer.write(
+            b"Welcome to the mock TeamSpeak 3 ServerQuery interface." + LINE_END
+        )
+        try:
+            while True:
+                line = (await reader.readuntil(LINE_END)).decode().strip()
+                if not line:
+                    continue
+                if line == "quit":
+                    break
+                cmd = line.partition(" ")[0]
+                await asyncio.sleep(self.command_latency.get(cmd, self.latency))
+                error_id, msg = 0, "ok"
+                try:
+                    results = self._run(line, writer)
+                except QueryError as err:
+                    error_id, msg, results = err.error_id, err.msg, None
+                except (KeyError, ValueError):
+                    error_id, msg, results = 1538, "invalid parameter", None
+                self.calls.append(
+                    Call(time.monotonic(), cmd, line.count("|") + 1, error_id)
+                )
+                if results:
+                    writer.write(format_items(results) + LINE_END)
+                writer.write(
+                    b"error " + format_items([{"id": error_id, "msg": msg}]) + LINE_END
+                )
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._subscribers.discard(writer)
+            writer.close()
+
+    async def start(self, host, port):
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+
+def main(argv):
+    if len(argv) != 1:
+        raise app.UsageError("Too many arguments.")
+
+    mock = MockServer(
+        FLAGS.mock_latency, parse_command_latency(FLAGS.mock_command_latency)
+    )
+    for cid in FLAGS.mock_channels:
+        mock.add_channel(int(cid))
+    if FLAGS.mock_clients_file:
+        with open(FLAGS.mock_clients_file) as f:
+            for client in json.load(f):
+                mock.add_client(
+                    client["nickname"],
+                    client["database_id"],
+                    client["channel_id"],
+                    client.get("server_groups", [8]),
+                )
+
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(mock.start(FLAGS.mock_host, FLAGS.mock_port))
+    logging.info(
+        "Serving mock TS3 ServerQuery on telnet://%s:%d",
+        FLAGS.mock_host,
+        FLAGS.mock_port,
+    )
+    loop.run_until_complete(server.serve_forever())
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,156 @@
+# SPDX-FileCopyrightText: 2020 Luke Granger-Brown
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+import collections
+import urllib.parse
+
+from absl import logging
+import ts3.query
+import ts3.query_builder
+import ts3.response
+
+_LINE_END = b"\n\r"
+
+
+class ConnectionClosed(ts3.query.TS3Error):
+    pass
+
+
+class ServerQueryClient:
+    # An asyncio TS3 ServerQuery client for one virtual server, over the raw
+    # (telnet) interface. Commands and responses are matched up in order, so
+    # any number of commands can be in flight at once; notifications are
+    # handed to on_event as they arrive. Query building and response parsing
+    # are py-ts3's.
+
+    def __init__(self, uri, server_id, on_event=None, keepalive_interval=60):
+        parts = urllib.parse.urlsplit(uri)
+        if parts.scheme != "telnet":
+            raise ValueError("only telnet:// ServerQuery URIs are supported")
+        self.host = parts.hostname
+        self.port = parts.port or 10011
+        self.username = urllib.parse.unquote(parts.username or "")
+        self.password = urllib.parse.unquote(parts.password or "")
+        self.server_id = server_id
+        self.on_event = on_event
+        self.keepalive_interval = keepalive_interval
+        self._reader = None
+        self._writer = None
+        self._pending = collections.deque()
+        self._tasks = []
+        self.closed = asyncio.Event()
+
+    async def connect(self):
+        self.closed.clear()
+        try:
+            self._reader, self._writer = await asyncio.open_connection(
+                self.host, self.port
+            )
+            # "TS3" and the welcome message.
+            for _ in range(2):
+                await self._reader.readuntil(_LINE_END)
+            self._tasks = [
+                asyncio.ensure_future(self._read_loop()),
+                asyncio.ensure_future(self._keepalive_loop()),
+            ]
+            if self.username:
+                await self.execute(
+                    "login",
+                    client_login_name=self.username,
+                    client_login_password=self.password,
+                )
+            await self.execute("use", sid=self.server_id)
+        except BaseException:
+            # Don't leave the socket and tasks behind for each failed attempt.
+            self.close()
+            raise
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(ConnectionClosed())
+        self.closed.set()
+
+    async def _read_loop(self):
+        lines = []
+        try:
+            while True:
+                line = await self._reader.readuntil(_LINE_END)
+                if line.startswith(b"notify"):
+                    if self.on_event:
+                        self.on_event(ts3.response.TS3Event(line))
+                    continue
+                lines.append(line)
+                if not line.startswith(b"error"):
+                    continue
+                response = ts3.response.TS3QueryResponse(b"".join(lines))
+                lines = []
+                if not self._pending:
+                    # Such as the server telling us why it is about to
+                    # disconnect us.
+                    logging.warning(
+                        "Unexpected ServerQuery response from %s: %s",
+                        self.host,
+                        response.error,
+                    )
+                    continue
+                future = self._pending.popleft()
+                if future.done():
+                    continue
+                if response.error["id"] != "0":
+                    future.set_exception(ts3.query.TS3QueryError(response))
+                else:
+                    future.set_result(response)
+        except (asyncio.IncompleteReadError, ConnectionError) as err:
+            logging.warning("ServerQuery connection to %s closed: %s", self.host, err)
+        finally:
+            asyncio.get_event_loop().call_soon(self.close)
+
+    async def _keepalive_loop(self):
+        while True:
+            await asyncio.sleep(self.keepalive_interval)
+            try:
+                await self.execute("version")
+            except ts3.query.TS3Error:
+                logging.exception("ServerQuery keepalive failed")
+
+    def _send(self, query):
+        if self._writer is None:
+            raise ConnectionClosed()
+        future = asyncio.get_event_loop().create_future()
+        self._writer.write(query.compile().encode() + _LINE_END)
+        self._pending.append(future)
+        return future
+
+    async def _drain(self):
+        try:
+            if self._writer:
+                await self._writer.drain()
+        except ConnectionError:
+            # The read loop notices too, and fails everything pending.
+            pass
+
+    async def execute(self, cmd, *options, **params):
+        return await self.execute_query(
+            ts3.query_builder.TS3QueryBuilder(cmd).pipe(*options, **params)
+        )
+
+    async def execute_query(self, query):
+        future = self._send(query)
+        await self._drain()
+        return await future
+
+    async def pipeline(self, queries):
+        # Results are in query order; failed commands give their exception.
+        futures = [self._send(query) for query in queries]
+        await self._drain()
+        return await asyncio.gather(*futures, return_exceptions=True)
@@ -3,80 +3,1050 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import asyncio
-import copy
+import collections
 import dataclasses
-import enum
+import gzip
+import http
+import itertools
 import json
-import logging
-import threading
+import multiprocessing
+import os
+import secrets
+import struct
+import time
+from typing import Any, Dict, FrozenSet, List, Optional
+import urllib.parse
+import zlib
 
-from scapy.all import conf
-from scapy.all import sniff
+from absl import app
+from absl import flags
+from absl import logging
 import websockets
+import websockets.extensions.permessage_deflate
 
 import amongus
+import amongus.runtime
+import amongus.views
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string("host", "localhost", "Host to serve websockets on.")
+flags.DEFINE_integer("port", 8765, "Port to serve websockets on.")
+flags.DEFINE_integer(
+    "workers",
+    0,
+    "Number of websocket fan-out worker processes. With 0, a single process "
+    "both tracks state and serves websockets. Workers have no tracker, so their "
+    "/metrics only has the compression stats of whichever worker answers; run "
+    "tracker.py with --sinks=websocket,metrics to serve the tracker's metrics on "
+    "its --metrics_port.",
+)
+flags.DEFINE_bool("deflate", True, "Offer permessage-deflate to clients.")
+flags.DEFINE_integer(
+    "deflate_window_bits", 15, "Largest deflate window (8-15) used for sending."
+)
+flags.DEFINE_integer("deflate_mem_level", 8, "zlib memLevel (1-9) used for sending.")
+flags.DEFINE_integer("deflate_level", 6, "zlib compression level (0-9).")
+flags.DEFINE_integer(
+    "deflate_min_size",
+    256,
+    "Messages smaller than this many bytes are sent uncompressed.",
+)
+flags.DEFINE_bool(
+    "deflate_no_context_takeover",
+    True,
+    "Compress each message independently, so a broadcast is compressed once and "
+    "shared by every client receiving it, rather than once per client.",
+)
+flags.DEFINE_string(
+    "tracker_socket",
+    "/tmp/amongus_websocket_server.sock",
+    "Unix socket the tracker publishes encoded frames to workers on.",
+)
 
 loop = asyncio.get_event_loop()
 
 
-def listener(wsh):
-    conf.use_pcap = True
-    conf.sniff_promisc = False
-    state = amongus.GameState()
+# How many recent deltas to keep per game and topic for clients to resume from.
+REPLAY_RING_SIZES = {
+    "roster": 256,
+    "positions": 4096,
+    "meetings": 256,
+    "events": 1024,
+}
+
+# Clients further behind than this are disconnected, and can resume later.
+CLIENT_QUEUE_SIZE = 1024
+
+# How long a /state?since=<version> request waits for the game to change.
+LONG_POLL_TIMEOUT = 30.0
+
+# Workers with this many bytes of frames unsent are disconnected, and resync.
+WORKER_BUFFER_LIMIT = 16 * 1024 * 1024
+
+# How many compressed broadcasts to keep for sharing between clients.
+DEFLATE_CACHE_SIZE = 256
+
+# Websocket opcodes (RFC 6455).
+_OP_CONT = 0
+_OP_CLOSE = 8
+
+DELTA_KINDS = ("snapshot", "delta", "event")
+
+_FRAME_LENGTH = struct.Struct("<I")
+_FRAME_HELLO = 1
+_FRAME_DELTA = 2
+# The tracker has forgotten a game.
+_FRAME_FORGET = 3
+_HELLO_HEADER = struct.Struct("<BQ")
+_FORGET_HEADER = struct.Struct("<BI")
+_DELTA_HEADER = struct.Struct("<BQIBBH")
+_VARIANT_HEADER = struct.Struct("<hI")
+# Keys of an encoded delta which aren't part of the topic header.
+_ENVELOPE_KEYS = frozenset(
+    ["seq", "game_id", "topic", "type", "players", "removed", "event"]
+)
+
+
+def _parse_int(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, int):
+        return value
+    return int(value, 0)
+
+
+def _path_params(path):
+    # e.g. /, /0x1234, /0x1234?topics=meetings,events&player_id=3&epoch=...&since=42
+    url = urllib.parse.urlsplit(path)
+    d = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+    segment = url.path.strip("/")
+    if segment:
+        d.setdefault("game_id", segment)
+    return d
+
+
+@dataclasses.dataclass(frozen=True)
+class Subscription:
+    # None means "all games"/"all players".
+    game_id: Optional[int] = None
+    topics: FrozenSet[str] = frozenset(amongus.views.TOPICS)
+    player_id: Optional[int] = None
+
+    @classmethod
+    def from_dict(cls, d):
+        topics = d.get("topics", None)
+        if topics is None:
+            topics = amongus.views.TOPICS
+        elif isinstance(topics, str):
+            topics = topics.split(",")
+        topics = frozenset(t for t in topics if t)
+        unknown = topics - frozenset(amongus.views.TOPICS)
+        if unknown:
+            raise ValueError("unknown topics {}".format(sorted(unknown)))
+        return cls(
+            game_id=_parse_int(d.get("game_id", None)),
+            topics=topics,
+            player_id=_parse_int(d.get("player_id", None)),
+        )
+
+    def keys(self):
+        for topic in self.topics:
+            yield (self.game_id, topic, self.player_id)
 
-    def process_packet(pkt):
-        if state.process_packet(pkt):
-            asyncio.run_coroutine_threadsafe(
-                wsh.broadcast_state(json.dumps(state.asdict())), loop
+
+@dataclasses.dataclass
+class Delta:
+    seq: int
+    game_id: int
+    topic: str
+    kind: str
+    header: Dict[str, Any] = dataclasses.field(default_factory=dict)
+    players: Dict[int, Any] = dataclasses.field(default_factory=dict)
+    removed: FrozenSet[int] = frozenset()
+    event: Optional[Dict[str, Any]] = None
+    # Which per-player subscribers this is relevant to.
+    player_ids: FrozenSet[int] = frozenset()
+    _encoded: Dict[Optional[int], str] = dataclasses.field(
+        default_factory=dict, repr=False
+    )
+
+    @classmethod
+    def between(cls, seq, game_id, topic, old_view, view):
+        if old_view is None:
+            return cls.snapshot(seq, game_id, topic, view, kind="delta")
+        players = {
+            player_id: player
+            for player_id, player in view.players.items()
+            if old_view.players.get(player_id, None) != player
+        }
+        removed = frozenset(old_view.players.keys() - view.players.keys())
+        if old_view.header != view.header:
+            player_ids = frozenset(view.players.keys()) | removed
+        else:
+            player_ids = frozenset(players.keys()) | removed
+        return cls(
+            seq=seq,
+            game_id=game_id,
+            topic=topic,
+            kind="delta",
+            header=view.header,
+            players=players,
+            removed=removed,
+            player_ids=player_ids,
+        )
+
+    @classmethod
+    def snapshot(cls, seq, game_id, topic, view, kind="snapshot"):
+        return cls(
+            seq=seq,
+            game_id=game_id,
+            topic=topic,
+            kind=kind,
+            header=view.header,
+            players=view.players,
+            player_ids=frozenset(view.players.keys()),
+        )
+
+    @classmethod
+    def for_event(cls, seq, game_id, event):
+        return cls(
+            seq=seq,
+            game_id=game_id,
+            topic="events",
+            kind="event",
+            event=event,
+            player_ids=frozenset(event["player_ids"]),
+        )
+
+    @classmethod
+    def from_frame(cls, body):
+        _, seq, game_id, topic_idx, kind_idx, player_count = _DELTA_HEADER.unpack_from(
+            body
+        )
+        offset = _DELTA_HEADER.size
+        player_ids = frozenset(body[offset : offset + player_count])
+        offset += player_count
+        encoded = {}
+        while offset < len(body):
+            player_id, length = _VARIANT_HEADER.unpack_from(body, offset)
+            offset += _VARIANT_HEADER.size
+            encoded[None if player_id < 0 else player_id] = body[
+                offset : offset + length
+            ].decode("utf8")
+            offset += length
+        # Workers only decode the all-players variant, to maintain their views.
+        msg = json.loads(encoded[None])
+        return cls(
+            seq=seq,
+            game_id=game_id,
+            topic=amongus.views.TOPICS[topic_idx],
+            kind=DELTA_KINDS[kind_idx],
+            header={k: v for k, v in msg.items() if k not in _ENVELOPE_KEYS},
+            players={int(k): v for k, v in msg.get("players", {}).items()},
+            removed=frozenset(msg.get("removed", [])),
+            event=msg.get("event", None),
+            player_ids=player_ids,
+            _encoded=encoded,
+        )
+
+    def to_frame(self):
+        variants = [None]
+        if self.event is None:
+            variants.extend(sorted(self.player_ids))
+        parts = [
+            _DELTA_HEADER.pack(
+                _FRAME_DELTA,
+                self.seq,
+                self.game_id,
+                amongus.views.TOPICS.index(self.topic),
+                DELTA_KINDS.index(self.kind),
+                len(self.player_ids),
+            ),
+            bytes(sorted(self.player_ids)),
+        ]
+        for player_id in variants:
+            encoded = self.encode(player_id).encode("utf8")
+            parts.append(
+                _VARIANT_HEADER.pack(
+                    -1 if player_id is None else player_id, len(encoded)
+                )
             )
+            parts.append(encoded)
+        body = b"".join(parts)
+        return _FRAME_LENGTH.pack(len(body)) + body
 
-    logging.info("listener ready")
-    sniff(prn=process_packet, filter="udp and (src port 22023 or dst port 22023)")
+    def relevant_to(self, player_id):
+        return player_id is None or player_id in self.player_ids
 
+    def encode(self, player_id):
+        if self.event is not None:
+            # Events are the same for every subscriber.
+            player_id = None
+        encoded = self._encoded.get(player_id, None)
+        if encoded is not None:
+            return encoded
+        msg = {
+            "seq": self.seq,
+            "game_id": self.game_id,
+            "topic": self.topic,
+            "type": self.kind,
+        }
+        if self.event is not None:
+            msg["event"] = self.event
+        elif player_id is None:
+            msg.update(self.header, players=self.players, removed=sorted(self.removed))
+        else:
+            msg.update(self.header, player_id=player_id)
+            if player_id in self.players:
+                msg["player"] = self.players[player_id]
+            elif player_id in self.removed:
+                msg["removed"] = True
+        encoded = self._encoded[player_id] = json.dumps(msg)
+        return encoded
 
-class WebSocketHandler:
+
+def _hello_frame(epoch, seq):
+    body = _HELLO_HEADER.pack(_FRAME_HELLO, seq) + epoch.encode("ascii")
+    return _FRAME_LENGTH.pack(len(body)) + body
+
+
+def _forget_frame(game_id):
+    body = _FORGET_HEADER.pack(_FRAME_FORGET, game_id)
+    return _FRAME_LENGTH.pack(len(body)) + body
+
+
+class DeltaSource:
     def __init__(self):
-        self.last_state = None
-        self.connected = set()
+        # Lets clients tell whether sequence numbers are from this process.
+        self.epoch = secrets.token_hex(8)
+        self.seq = 0
+        # game_id -> {topic: TopicView}, as last published.
+        self.views = {}
+
+    def _next_seq(self):
+        self.seq += 1
+        return self.seq
+
+    def update(self, game_id, views) -> List[Delta]:
+        old_views = self.views.get(game_id, None)
+        self.views[game_id] = views
+
+        deltas = []
+        for topic, view in views.items():
+            old_view = old_views[topic] if old_views else None
+            if old_view == view:
+                continue
+            deltas.append(
+                Delta.between(self._next_seq(), game_id, topic, old_view, view)
+            )
+        if old_views:
+            for event in amongus.views.roster_events(
+                old_views["roster"], views["roster"]
+            ):
+                deltas.append(Delta.for_event(self._next_seq(), game_id, event))
+        return deltas
 
-    async def broadcast_state(self, state):
+    def forget(self, game_id):
+        self.views.pop(game_id, None)
+
+    def snapshots(self) -> List[Delta]:
+        return [
+            Delta.snapshot(self.seq, game_id, topic, view)
+            for game_id, views in self.views.items()
+            for topic, view in views.items()
+        ]
+
+
+class ReplayRing:
+    def __init__(self, size, evicted_seq=0):
+        self.deltas = collections.deque(maxlen=size)
+        # Deltas up to and including evicted_seq are no longer available.
+        self.evicted_seq = evicted_seq
+
+    def append(self, delta):
+        if len(self.deltas) == self.deltas.maxlen:
+            self.evicted_seq = self.deltas[0].seq
+        self.deltas.append(delta)
+
+    def since(self, seq):
+        if seq < self.evicted_seq:
+            return None
+        return [delta for delta in self.deltas if delta.seq > seq]
+
+
+class Client:
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(CLIENT_QUEUE_SIZE)
+        self.subscription = None
+        self.closing = False
+
+    def close(self, code, reason):
+        self.closing = True
+        asyncio.ensure_future(self.websocket.close(code=code, reason=reason))
+
+    def send(self, msg):
+        if self.closing:
+            return
+        try:
+            self.queue.put_nowait(msg)
+        except asyncio.QueueFull:
+            logging.warning(
+                "Client %s fell too far behind", self.websocket.remote_address
+            )
+            self.close(1013, "too far behind, resume")
+
+    async def write_messages(self):
+        while True:
+            msg = await self.queue.get()
+            await self.websocket.send(msg)
+
+
+class WebSocketHandler:
+    def __init__(self, epoch, seq=0):
+        self.epoch = epoch
+        self.seq = seq
+        # Deltas before this weren't seen by this handler.
+        self.start_seq = seq
+        # game_id -> {topic: TopicView}, maintained from applied deltas.
+        self.views = {}
+        # game_id -> {topic: ReplayRing}
+        self.history = {}
+        self.clients = set()
+        # (game_id, topic, player_id) -> set of Clients; None is a wildcard.
+        self.subscribers = collections.defaultdict(set)
+        # game_id -> seq of the last delta to change it.
+        self.game_versions = {}
+        # game_id -> (version, encoded body, gzipped body or None)
+        self._http_cache = {}
+        # game_id -> Event set when the game next changes, for long polls.
+        self._game_changed = {}
+        self.compression_stats = CompressionStats()
+        # Callables returning more Prometheus text lines for /metrics.
+        self.metrics = []
+
+    def reset(self, epoch, seq):
+        if epoch != self.epoch:
+            # Sequence numbers are meaningless now; make everyone start over.
+            for client in self.clients:
+                client.close(1012, "tracker restarted")
+        self.epoch = epoch
+        self.seq = self.start_seq = seq
+        self.views = {}
+        self.history = {}
+        self.game_versions = {}
+        self._http_cache = {}
+
+    def apply(self, deltas):
         try:
-            await self._broadcast_state_inner(state)
+            for delta in deltas:
+                self._apply_delta(delta)
         except:
-            logging.exception("broadcast_state failed")
+            logging.exception("apply failed")
+
+    def apply_frame(self, body):
+        if body[0] == _FRAME_HELLO:
+            _, seq = _HELLO_HEADER.unpack_from(body)
+            self.reset(body[_HELLO_HEADER.size :].decode("ascii"), seq)
+        elif body[0] == _FRAME_FORGET:
+            _, game_id = _FORGET_HEADER.unpack_from(body)
+            self.forget(game_id)
+        else:
+            self.apply([Delta.from_frame(body)])
+
+    def forget(self, game_id):
+        # Everything kept per game goes, once the tracker has forgotten it.
+        self.views.pop(game_id, None)
+        self.history.pop(game_id, None)
+        self.game_versions.pop(game_id, None)
+        self._http_cache.pop(game_id, None)
+        changed = self._game_changed.pop(game_id, None)
+        if changed:
+            # Long polls of the game then find it gone.
+            changed.set()
+
+    def _recipients(self, game_id, topic, player_id):
+        return self.subscribers.get(
+            (game_id, topic, player_id), set()
+        ) | self.subscribers.get((None, topic, player_id), set())
+
+    def _update_view(self, delta):
+        views = self.views.setdefault(delta.game_id, {})
+        old_view = views.get(delta.topic, None)
+        if delta.kind == "snapshot" or old_view is None:
+            players = dict(delta.players)
+        else:
+            players = dict(old_view.players)
+            players.update(delta.players)
+            for player_id in delta.removed:
+                players.pop(player_id, None)
+        views[delta.topic] = amongus.views.TopicView(
+            header=delta.header, players=players
+        )
+
+    def _record(self, delta):
+        rings = self.history.get(delta.game_id, None)
+        if rings is None:
+            rings = self.history[delta.game_id] = {
+                topic: ReplayRing(size, self.start_seq)
+                for topic, size in REPLAY_RING_SIZES.items()
+            }
+        rings[delta.topic].append(delta)
+
+    def _apply_delta(self, delta):
+        self.seq = max(self.seq, delta.seq)
+        self.game_versions[delta.game_id] = delta.seq
+        changed = self._game_changed.pop(delta.game_id, None)
+        if changed:
+            changed.set()
+        if delta.kind != "event":
+            self._update_view(delta)
+        if delta.kind != "snapshot":
+            self._record(delta)
+        for player_id in itertools.chain([None], delta.player_ids):
+            for client in self._recipients(delta.game_id, delta.topic, player_id):
+                client.send(delta.encode(player_id))
 
-    async def _broadcast_state_inner(self, state):
-        if self.last_state == state:
+    def _unsubscribe(self, client):
+        if not client.subscription:
             return
-        self.last_state = state
-        if not self.connected:
+        for key in client.subscription.keys():
+            self.subscribers[key].discard(client)
+            if not self.subscribers[key]:
+                del self.subscribers[key]
+        client.subscription = None
+
+    def _resume_seq(self, d):
+        if d.get("epoch", None) != self.epoch:
+            return None
+        return _parse_int(d.get("since", None))
+
+    def _catch_up(self, game_id, subscription, since):
+        deltas = []
+        rings = self.history.get(game_id, {})
+        for topic in subscription.topics:
+            replay = None
+            if since is not None:
+                if topic in rings:
+                    replay = rings[topic].since(since)
+                elif since >= self.start_seq:
+                    replay = []
+            if replay is not None:
+                deltas.extend(replay)
+            elif topic in self.views[game_id]:
+                # Either a fresh client or its position has been evicted.
+                deltas.append(
+                    Delta.snapshot(self.seq, game_id, topic, self.views[game_id][topic])
+                )
+        deltas.sort(key=lambda delta: delta.seq)
+        return deltas
+
+    def _subscribe(self, client, subscription, since=None):
+        self._unsubscribe(client)
+        client.subscription = subscription
+        for key in subscription.keys():
+            self.subscribers[key].add(client)
+
+        if subscription.game_id is None:
+            game_ids = list(self.views.keys())
+        elif subscription.game_id in self.views:
+            game_ids = [subscription.game_id]
+        else:
+            game_ids = []
+        for game_id in game_ids:
+            for delta in self._catch_up(game_id, subscription, since):
+                if delta.relevant_to(subscription.player_id):
+                    client.send(delta.encode(subscription.player_id))
+
+    def _version(self, game_id):
+        return "{}-{}".format(self.epoch, self.game_versions[game_id])
+
+    def _encoded_state(self, game_id, gzipped):
+        version = self.game_versions[game_id]
+        cached = self._http_cache.get(game_id, None)
+        if cached is None or cached[0] != version:
+            body = json.dumps(
+                {
+                    "game_id": game_id,
+                    "version": self._version(game_id),
+                    **{
+                        topic: view.asdict()
+                        for topic, view in self.views[game_id].items()
+                    },
+                }
+            ).encode("utf8")
+            cached = self._http_cache[game_id] = (version, body, None)
+        if not gzipped:
+            return cached[1]
+        if cached[2] is None:
+            cached = self._http_cache[game_id] = (
+                version,
+                cached[1],
+                gzip.compress(cached[1]),
+            )
+        return cached[2]
+
+    async def _wait_for_change(self, game_id, epoch, seq):
+        if epoch != self.epoch or seq != self.game_versions[game_id]:
             return
-        logging.debug("Broadcasting state to %d", len(self.connected))
-        await asyncio.wait([websocket.send(state) for websocket in self.connected])
+        changed = self._game_changed.get(game_id, None)
+        if changed is None:
+            changed = self._game_changed[game_id] = asyncio.Event()
+        try:
+            await asyncio.wait_for(changed.wait(), LONG_POLL_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+    async def process_request(self, path, request_headers):
+        # Serves plain HTTP GETs of /metrics, /state and /state/<game_id> on the
+        # websocket port. In workers, /metrics is only the worker's own.
+        url = urllib.parse.urlsplit(path)
+        if url.path == "/metrics":
+            lines = self.compression_stats.prometheus_lines()
+            for metrics in self.metrics:
+                lines.extend(metrics())
+            body = "\n".join(lines) + "\n"
+            return (
+                http.HTTPStatus.OK,
+                [("Content-Type", "text/plain; version=0.0.4")],
+                body.encode("utf8"),
+            )
+        if url.path != "/state" and not url.path.startswith("/state/"):
+            return None
+        game_id = url.path[len("/state") :].strip("/")
+        if not game_id:
+            body = json.dumps(
+                {
+                    "epoch": self.epoch,
+                    "games": {
+                        game_id: self._version(game_id)
+                        for game_id in self.game_versions
+                    },
+                }
+            ).encode("utf8")
+            return (
+                http.HTTPStatus.OK,
+                [("Content-Type", "application/json"), ("Cache-Control", "no-cache")],
+                body,
+            )
+        try:
+            game_id = _parse_int(game_id)
+        except ValueError:
+            return http.HTTPStatus.BAD_REQUEST, [], b"bad game_id\n"
+        params = _path_params(path)
+        if "since" in params:
+            since_epoch, _, since_seq = params["since"].partition("-")
+            try:
+                since_seq = _parse_int(since_seq)
+            except ValueError:
+                return http.HTTPStatus.BAD_REQUEST, [], b"bad since\n"
+        if game_id not in self.game_versions or game_id not in self.views:
+            return http.HTTPStatus.NOT_FOUND, [], b"no such game\n"
+
+        if "since" in params:
+            await self._wait_for_change(game_id, since_epoch, since_seq)
+            if game_id not in self.game_versions:
+                return http.HTTPStatus.NOT_FOUND, [], b"no such game\n"
+
+        etag = '"{}"'.format(self._version(game_id))
+        headers = [
+            ("ETag", etag),
+            ("Cache-Control", "no-cache"),
+            ("Vary", "Accept-Encoding"),
+        ]
+        not_modified_tags = [
+            tag.strip() for tag in request_headers.get("If-None-Match", "").split(",")
+        ]
+        if "since" in params:
+            # A long poll that timed out.
+            not_modified_tags.append('"{}"'.format(params["since"]))
+        if etag in not_modified_tags:
+            return http.HTTPStatus.NOT_MODIFIED, headers, b""
+
+        gzipped = "gzip" in request_headers.get("Accept-Encoding", "")
+        headers.append(("Content-Type", "application/json"))
+        if gzipped:
+            headers.append(("Content-Encoding", "gzip"))
+        return http.HTTPStatus.OK, headers, self._encoded_state(game_id, gzipped)
 
     async def handle_websocket(self, websocket, path):
-        # Register!
-        self.connected.add(websocket)
+        client = Client(websocket)
+        self.clients.add(client)
+        client.send(json.dumps({"type": "hello", "epoch": self.epoch, "seq": self.seq}))
+        writer = asyncio.ensure_future(client.write_messages())
+        try:
+            params = _path_params(path)
+            try:
+                self._subscribe(
+                    client, Subscription.from_dict(params), self._resume_seq(params)
+                )
+            except ValueError as e:
+                await websocket.close(code=1008, reason=str(e))
+                return
+            # Any message from the client replaces its subscription.
+            async for message in websocket:
+                try:
+                    params = json.loads(message)
+                    subscription = Subscription.from_dict(params)
+                    since = self._resume_seq(params)
+                except (ValueError, TypeError, AttributeError) as e:
+                    client.send(json.dumps({"error": str(e)}))
+                    continue
+                self._subscribe(client, subscription, since)
+        finally:
+            self._unsubscribe(client)
+            self.clients.discard(client)
+            writer.cancel()
+
+
+@dataclasses.dataclass(frozen=True)
+class DeflateSettings:
+    enabled: bool = True
+    window_bits: int = 15
+    mem_level: int = 8
+    level: int = 6
+    min_size: int = 256
+    no_context_takeover: bool = True
+
+    @classmethod
+    def from_flags(cls):
+        return cls(
+            enabled=FLAGS.deflate,
+            window_bits=FLAGS.deflate_window_bits,
+            mem_level=FLAGS.deflate_mem_level,
+            level=FLAGS.deflate_level,
+            min_size=FLAGS.deflate_min_size,
+            no_context_takeover=FLAGS.deflate_no_context_takeover,
+        )
+
+
+class CompressionStats:
+    def __init__(self):
+        # How many messages were compressed per connection, compressed once and
+        # shared, served from the shared cache, or too small to compress.
+        self.messages = collections.Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+
+    def record(self, result, bytes_in, bytes_out, cpu_seconds=0.0):
+        self.messages[result] += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.cpu_seconds += cpu_seconds
+
+    def prometheus_lines(self):
+        lines = [
+            "# TYPE amongus_ws_deflate_messages_total counter",
+        ]
+        for result in ("per_client", "compressed", "shared", "skipped"):
+            lines.append(
+                'amongus_ws_deflate_messages_total{{result="{}"}} {}'.format(
+                    result, self.messages[result]
+                )
+            )
+        saved = self.bytes_in - self.bytes_out
+        lines.extend(
+            [
+                "# TYPE amongus_ws_deflate_bytes_in_total counter",
+                "amongus_ws_deflate_bytes_in_total {}".format(self.bytes_in),
+                "# TYPE amongus_ws_deflate_bytes_out_total counter",
+                "amongus_ws_deflate_bytes_out_total {}".format(self.bytes_out),
+                "# TYPE amongus_ws_deflate_cpu_seconds_total counter",
+                "amongus_ws_deflate_cpu_seconds_total {:.6f}".format(self.cpu_seconds),
+                "# TYPE amongus_ws_deflate_cpu_seconds_per_byte_saved gauge",
+                "amongus_ws_deflate_cpu_seconds_per_byte_saved {:.3e}".format(
+                    self.cpu_seconds / saved if saved > 0 else 0.0
+                ),
+            ]
+        )
+        return lines
+
+
+class SharedPerMessageDeflate(
+    websockets.extensions.permessage_deflate.PerMessageDeflate
+):
+    # permessage-deflate which skips small messages and, without context
+    # takeover, shares each compressed message between connections.
+
+    def __init__(self, *args, min_size, cache, stats, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+        self.cache = cache
+        self.stats = stats
+        self.encoding_uncompressed = False
+        # Connections share compressed messages only with those which
+        # negotiated the same window and compress with the same settings.
+        self._cache_settings = (
+            self.local_max_window_bits,
+            tuple(sorted(self.compress_settings.items())),
+        )
+
+    def _compress(self, data):
+        encoder = zlib.compressobj(
+            wbits=-self.local_max_window_bits, **self.compress_settings
+        )
+        data = encoder.compress(data) + encoder.flush(zlib.Z_SYNC_FLUSH)
+        # Drop the empty uncompressed block, per RFC 7692.
+        return data[:-4]
+
+    def encode(self, frame):
+        if frame.opcode >= _OP_CLOSE:
+            return frame
+        if frame.opcode == _OP_CONT:
+            if self.encoding_uncompressed:
+                return frame
+            return super().encode(frame)
+        if len(frame.data) < self.min_size:
+            # Messages without rsv1 set are sent uncompressed.
+            self.encoding_uncompressed = not frame.fin
+            self.stats.record("skipped", len(frame.data), len(frame.data))
+            return frame
+        self.encoding_uncompressed = False
+
+        if not (self.local_no_context_takeover and frame.fin):
+            start = time.process_time()
+            encoded = super().encode(frame)
+            self.stats.record(
+                "per_client",
+                len(frame.data),
+                len(encoded.data),
+                time.process_time() - start,
+            )
+            return encoded
+
+        key = (self._cache_settings, frame.data)
+        data = self.cache.get(key, None)
+        if data is not None:
+            self.cache.move_to_end(key)
+            self.stats.record("shared", len(frame.data), len(data))
+        else:
+            start = time.process_time()
+            data = self._compress(frame.data)
+            self.stats.record(
+                "compressed", len(frame.data), len(data), time.process_time() - start
+            )
+            self.cache[key] = data
+            if len(self.cache) > DEFLATE_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return _replace_frame(frame, rsv1=True, data=data)
+
+
+def _replace_frame(frame, **kwargs):
+    if hasattr(frame, "_replace"):
+        return frame._replace(**kwargs)
+    return dataclasses.replace(frame, **kwargs)
+
+
+class SharedPerMessageDeflateFactory(
+    websockets.extensions.permessage_deflate.ServerPerMessageDeflateFactory
+):
+    def __init__(self, *args, min_size, stats, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+        self.stats = stats
+        # Shared by every connection negotiated by this factory.
+        self.cache = collections.OrderedDict()
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(
+            params, accepted_extensions
+        )
+        return (
+            response_params,
+            SharedPerMessageDeflate(
+                extension.remote_no_context_takeover,
+                extension.local_no_context_takeover,
+                extension.remote_max_window_bits,
+                extension.local_max_window_bits,
+                extension.compress_settings,
+                min_size=self.min_size,
+                cache=self.cache,
+                stats=self.stats,
+            ),
+        )
+
+
+def _serve_kwargs(wsh, deflate_settings):
+    kwargs = {"process_request": wsh.process_request, "compression": None}
+    if deflate_settings.enabled:
+        kwargs["extensions"] = [
+            SharedPerMessageDeflateFactory(
+                server_no_context_takeover=deflate_settings.no_context_takeover,
+                server_max_window_bits=deflate_settings.window_bits,
+                compress_settings={
+                    "memLevel": deflate_settings.mem_level,
+                    "level": deflate_settings.level,
+                },
+                min_size=deflate_settings.min_size,
+                stats=wsh.compression_stats,
+            )
+        ]
+    return kwargs
+
+
+class FramePublisher:
+    # Runs in the tracker process: encodes each delta once, for every worker.
+
+    def __init__(self, source):
+        self.source = source
+        self.workers = set()
+
+    def publish(self, game_id, views):
+        try:
+            if views is None:
+                self.source.forget(game_id)
+                frames = _forget_frame(game_id)
+            else:
+                deltas = self.source.update(game_id, views)
+                if not deltas:
+                    return
+                frames = b"".join(delta.to_frame() for delta in deltas)
+            if not self.workers:
+                return
+            for writer in list(self.workers):
+                if writer.transport.get_write_buffer_size() > WORKER_BUFFER_LIMIT:
+                    logging.warning("Worker fell too far behind, disconnecting")
+                    self.workers.discard(writer)
+                    writer.close()
+                    continue
+                writer.write(frames)
+        except:
+            logging.exception("publish failed")
+
+    async def handle_worker(self, reader, writer):
+        writer.write(_hello_frame(self.source.epoch, self.source.seq))
+        for delta in self.source.snapshots():
+            writer.write(delta.to_frame())
+        self.workers.add(writer)
+        logging.info("Worker connected (%d total)", len(self.workers))
+        try:
+            await reader.read()
+        finally:
+            self.workers.discard(writer)
+            writer.close()
+
+
+async def follow_tracker(wsh, socket_path):
+    backoff = 0.1
+    while True:
+        try:
+            reader, writer = await asyncio.open_unix_connection(socket_path)
+        except OSError:
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 5.0)
+            continue
+        backoff = 0.1
+        logging.info("Connected to tracker at %s", socket_path)
         try:
-            if self.last_state:
-                await websocket.send(self.last_state)
             while True:
-                await asyncio.sleep(10.0)
-                await websocket.ping()
+                (length,) = _FRAME_LENGTH.unpack(
+                    await reader.readexactly(_FRAME_LENGTH.size)
+                )
+                wsh.apply_frame(await reader.readexactly(length))
+        except asyncio.IncompleteReadError:
+            logging.warning("Lost connection to tracker")
         finally:
-            self.connected.remove(websocket)
+            writer.close()
+
+
+def worker_main(socket_path, host, port, deflate_settings):
+    worker_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(worker_loop)
+    wsh = WebSocketHandler(epoch=None)
+    start_server = websockets.serve(
+        wsh.handle_websocket,
+        host,
+        port,
+        reuse_port=True,
+        **_serve_kwargs(wsh, deflate_settings),
+    )
+    worker_loop.run_until_complete(start_server)
+    logging.info("websocket worker %d ready", os.getpid())
+    worker_loop.run_until_complete(follow_tracker(wsh, socket_path))
+
+
+class WebSocketSink(amongus.runtime.LoopSink):
+    # Serves the tracker's games to websocket clients, either itself or
+    # through worker processes. Views are built from snapshots on this sink's
+    # thread, so only for the latest when it falls behind, and diffed on the
+    # event loop.
+
+    name = "websocket"
+
+    def __init__(self, loop):
+        super().__init__(loop)
+        self.source = DeltaSource()
+        self.wsh = None
+        deflate_settings = DeflateSettings.from_flags()
+        if not FLAGS.workers:
+            self.wsh = WebSocketHandler(epoch=self.source.epoch)
+            self._start_server = websockets.serve(
+                self.wsh.handle_websocket,
+                FLAGS.host,
+                FLAGS.port,
+                **_serve_kwargs(self.wsh, deflate_settings),
+            )
+            self.publish = self._apply_locally
+        else:
+            publisher = FramePublisher(self.source)
+            self.publish = publisher.publish
+            if os.path.exists(FLAGS.tracker_socket):
+                os.unlink(FLAGS.tracker_socket)
+            self._start_server = asyncio.start_unix_server(
+                publisher.handle_worker, FLAGS.tracker_socket
+            )
+            ctx = multiprocessing.get_context("spawn")
+            for _ in range(FLAGS.workers):
+                ctx.Process(
+                    target=worker_main,
+                    args=(
+                        FLAGS.tracker_socket,
+                        FLAGS.host,
+                        FLAGS.port,
+                        deflate_settings,
+                    ),
+                    daemon=True,
+                ).start()
+
+    def _apply_locally(self, game_id, views):
+        if views is None:
+            self.source.forget(game_id)
+            self.wsh.forget(game_id)
+            return
+        self.wsh.apply(self.source.update(game_id, views))
+
+    def forget(self, game_id):
+        return (game_id, None)
+
+    def deliver(self, item):
+        # A game_state of None forgets the game.
+        game_id, game_state = item
+        views = None
+        if game_state is not None:
+            views = amongus.views.game_views(game_state)
+        super().deliver((game_id, views))
+
+    def apply(self, item):
+        self.publish(*item)
+
+    async def run(self):
+        await self._start_server
+        logging.info("websocket server ready")
+
 
+def main(argv):
+    if len(argv) != 1:
+        raise app.UsageError("Too many arguments.")
 
-def main():
-    logging.basicConfig(level=logging.DEBUG)
-    wsh = WebSocketHandler()
-    listener_thread = threading.Thread(target=listener, args=[wsh], daemon=True)
-    listener_thread.start()
-    start_server = websockets.serve(wsh.handle_websocket, "localhost", 8765)
-    loop.run_until_complete(start_server)
-    logging.info("websocket server ready")
+    sink = WebSocketSink(loop)
+    tracker = amongus.runtime.Tracker([sink])
+    if sink.wsh:
+        sink.wsh.metrics.append(tracker.prometheus_lines)
+    loop.run_until_complete(sink.run())
+    tracker.start()
     loop.run_forever()
 
 
 if __name__ == "__main__":
-    main()
+    app.run(main)